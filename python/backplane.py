@@ -0,0 +1,278 @@
+"""
+Lunar Rocks Backplane
+
+A publish/subscribe channel between servers, so that several of them behind a load balancer can
+share sessions. Each server owns the sessions it creates and handles every request about them,
+whichever server the client is connected to; messages for clients connected elsewhere are
+published to the server holding the client's connection, which sends them on to its own sockets.
+
+The LocalBackplane delivers within one process and is what a lone server uses. The BrokerBackplane
+connects to a Broker (run with `python backplane.py`) over TCP on localhost or a unix socket. Frames
+between the two are a uint32 length followed by an op (uint8), the channel name (uint16 length and
+UTF-8) and the data. A server that loses the broker keeps trying to reconnect, backing off up to
+RECONNECT_MAX seconds between attempts; messages published in the meantime are dropped.
+"""
+
+import abc
+import argparse
+import asyncio
+import logging
+import signal
+import struct
+import logpipe
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+OP_SUBSCRIBE = 1
+OP_UNSUBSCRIBE = 2
+OP_PUBLISH = 3
+LENGTH = struct.Struct('!I')
+HEADER = struct.Struct('!BH')       # op, channel length
+DEFAULT_ADDRESS = 'tcp://localhost:8797'
+RECONNECT_MIN = 0.5         # seconds before the first attempt to reconnect to a lost broker
+RECONNECT_MAX = 30          # most seconds between attempts
+
+LOGGER = logging.getLogger('lunar.backplane')
+
+class Remote:
+    """
+    Stands in for the websocket of a client connected to another server
+    """
+
+    open = True                     # until that server says the client has left
+
+    def __init__(self, node, cid):
+        self.node = node            # String, name of the server holding the connection
+        self.cid = cid              # UUID String of the client
+
+    def __repr__(self):
+        return "Remote({!r}, {!r})".format(self.node, self.cid)
+
+class Backplane(abc.ABC):
+
+    def __init__(self):
+        self.handlers = {}          # channel: [function(data)]
+        self.connected = []         # [function()] called whenever the backplane (re)connects
+
+    async def start(self):
+        """
+        Connects to the broker, if there is one
+        """
+        self.started()
+
+    def on_connect(self, func):
+        """
+        :param func: function() called on start and after every reconnection, e.g. to announce the
+            server again to those that may have missed messages while it was away
+        :return: None
+        """
+        self.connected.append(func)
+
+    def started(self):
+        for func in self.connected:
+            try:
+                func()
+            except Exception:
+                LOGGER.exception("Running a backplane connection callback failed")
+
+    def subscribe(self, channel, handler):
+        """
+        :param channel: String
+        :param handler: function(bytes) called with the data of every message published to channel
+        :return: None
+        """
+        self.handlers.setdefault(channel, []).append(handler)
+
+    @abc.abstractmethod
+    def publish(self, channel, data):
+        """
+        :param channel: String
+        :param data: bytes
+        :return: None
+        """
+
+    def deliver(self, channel, data):
+        for handler in self.handlers.get(channel, ()):
+            try:
+                handler(data)
+            except Exception:
+                LOGGER.exception("Handling a message on channel %s failed", channel)
+
+    def close(self):
+        pass
+
+class LocalBackplane(Backplane):
+    """
+    Delivers messages to subscribers in this process, on a later turn of the event loop as a
+    broker would
+    """
+
+    def publish(self, channel, data):
+        if channel in self.handlers:
+            asyncio.get_event_loop().call_soon(self.deliver, channel, data)
+
+class BrokerBackplane(Backplane):
+
+    def __init__(self, address=DEFAULT_ADDRESS):
+        super().__init__()
+        self.address = address      # String, tcp://host:port or unix:///path
+        self.writer = None          # StreamWriter to the broker
+        self.reader = None          # Task reading from the broker
+
+    async def start(self):
+        reader, self.writer = await open_connection(self.address)
+        for channel in self.handlers:
+            self.writer.write(frame(OP_SUBSCRIBE, channel))
+        self.reader = asyncio.ensure_future(self.read(reader))
+        LOGGER.info("Connected to backplane broker at %s", self.address)
+        self.started()
+
+    def subscribe(self, channel, handler):
+        if channel not in self.handlers and self.writer is not None:
+            self.writer.write(frame(OP_SUBSCRIBE, channel))
+        super().subscribe(channel, handler)
+
+    def publish(self, channel, data):
+        if self.writer is None:
+            LOGGER.error("Not connected to the backplane; message on %s dropped", channel)
+            return
+        self.writer.write(frame(OP_PUBLISH, channel, data))
+
+    async def read(self, reader):
+        try:
+            while True:
+                op, channel, data, _ = await read_frame(reader)
+                if op == OP_PUBLISH:
+                    self.deliver(channel, data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            LOGGER.error("Lost connection to backplane broker at %s", self.address)
+            self.writer = None
+        await self.reconnect()
+
+    async def reconnect(self):
+        """
+        Tries to connect to the broker again until it succeeds, waiting longer after each failure
+        """
+        delay = RECONNECT_MIN
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.start()
+                return
+            except OSError as e:
+                LOGGER.warning("Could not reconnect to backplane broker at %s (%s); retrying in %ss",
+                               self.address, e, min(delay * 2, RECONNECT_MAX))
+                delay = min(delay * 2, RECONNECT_MAX)
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+class Broker:
+    """
+    Passes every message published to a channel on to each connection subscribed to it
+    """
+
+    def __init__(self):
+        self.subscribers = {}       # channel: set(StreamWriter)
+
+    async def serve(self, reader, writer):
+        channels = set()
+        try:
+            while True:
+                op, channel, _, raw = await read_frame(reader)
+                if op == OP_SUBSCRIBE:
+                    channels.add(channel)
+                    self.subscribers.setdefault(channel, set()).add(writer)
+                elif op == OP_UNSUBSCRIBE:
+                    channels.discard(channel)
+                    self.subscribers.get(channel, set()).discard(writer)
+                elif op == OP_PUBLISH:
+                    for subscriber in self.subscribers.get(channel, ()):
+                        subscriber.write(raw)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for channel in channels:
+                subscribed = self.subscribers.get(channel)
+                subscribed.discard(writer)
+                if not subscribed:
+                    del self.subscribers[channel]
+            writer.close()
+
+def frame(op, channel, data=b''):
+    name = channel.encode('utf-8')
+    body = HEADER.pack(op, len(name)) + name + data
+    return LENGTH.pack(len(body)) + body
+
+async def read_frame(reader):
+    """
+    :return: (op, channel, data, the whole frame as read)
+    """
+    prefix = await reader.readexactly(LENGTH.size)
+    body = await reader.readexactly(LENGTH.unpack(prefix)[0])
+    op, length = HEADER.unpack_from(body)
+    start = HEADER.size + length
+    return op, body[HEADER.size:start].decode('utf-8'), body[start:], prefix + body
+
+def split_address(address):
+    """
+    :param address: String, tcp://host:port or unix:///path
+    :return: ('tcp', (host, port)) or ('unix', path)
+    """
+    scheme, _, rest = address.partition('://')
+    if scheme == 'unix':
+        return scheme, rest
+    if scheme == 'tcp':
+        host, _, port = rest.rpartition(':')
+        return scheme, (host or 'localhost', int(port))
+    raise ValueError("Backplane addresses look like tcp://host:port or unix:///path, not " + address)
+
+async def open_connection(address):
+    scheme, where = split_address(address)
+    if scheme == 'unix':
+        return await asyncio.open_unix_connection(where)
+    return await asyncio.open_connection(*where)
+
+async def listen(address, broker):
+    scheme, where = split_address(address)
+    if scheme == 'unix':
+        return await asyncio.start_unix_server(broker.serve, where)
+    return await asyncio.start_server(broker.serve, *where)
+
+def connect(address):
+    """
+    :param address: the broker's address, or None for a lone server
+    :return: a Backplane, not yet started
+    """
+    if address is None:
+        return LocalBackplane()
+    split_address(address)
+    return BrokerBackplane(address)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the backplane broker that lets servers share sessions")
+    parser.add_argument('-l', '--listen', default=DEFAULT_ADDRESS, help='tcp://host:port or unix:///path to listen on')
+    parser.add_argument('--log-file', default='backplane.log', help='File to write the log to')
+    parser.add_argument('--log-level', default=logging.getLevelName(logpipe.DEFAULT_LEVEL), help='Level of the log')
+    args = parser.parse_args()
+    listener = logpipe.configure(args.log_file, args.log_level.upper())
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(listen(args.listen, Broker()))
+    LOGGER.info("Backplane broker listening on %s", args.listen)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        listener.stop()
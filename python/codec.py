@@ -0,0 +1,227 @@
+"""
+Lunar Rocks JSON Codec
+
+Every JSON message, journal record and frame body is encoded and decoded here. The fastest backend
+installed is used: orjson, then ujson, then the standard library's json module. The backends'
+output is equivalent for everything the server sends, so clients can't tell which one is in use.
+
+This module also turns a decoded message into a Request, checking the fields every message must
+have once, on arrival, so that handlers can read the payload without checking its shape again.
+Top-level payload fields are type-checked as handlers read them, with Request.get(); the fields
+nested inside them are checked here, by the PAYLOAD_CHECKS of their msgID.
+"""
+
+import sys
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+import json
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+MAX_NAME_LENGTH = 256       # characters in a nickname or instrument; binary frames carry at most 65535 bytes
+
+def default(obj):
+    """
+    Serializes the numpy values that decoded binary frames carry, for backends that can't
+    """
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError("Object of type " + type(obj).__name__ + " is not JSON serializable")
+
+# dumps(obj) returns bytes of UTF-8 JSON; numpy arrays and scalars are written as lists and numbers.
+# loads(data) accepts str, bytes or memoryview and raises ValueError for malformed JSON.
+if orjson is not None:
+    BACKEND = 'orjson'
+    ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS)
+
+    loads = orjson.loads
+
+elif ujson is not None:
+    BACKEND = 'ujson'
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False, default=default).encode('utf-8')
+
+    def loads(data):
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return ujson.loads(data)
+
+else:
+    BACKEND = 'json'
+    ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=default)
+
+    def dumps(obj):
+        return ENCODER.encode(obj).encode('utf-8')
+
+    def loads(data):
+        if not isinstance(data, str):
+            data = bytes(data).decode('utf-8')
+        return json.loads(data)
+
+def dumps_text(obj):
+    """
+    :param obj: json-serializable object
+    :return: str of JSON, for websocket text frames
+    """
+    return dumps(obj).decode('utf-8')
+
+class MessageError(ValueError):
+    """
+    Raised for messages without the fields every message must have
+    """
+
+class Request:
+    """
+    An incoming message whose messageID, sourceID and payload are known to be well formed
+    """
+
+    __slots__ = ('msgID', 'srcID', 'payload', 'addr', 'socket')
+
+    def __init__(self, msgID, srcID='', payload=None):
+        self.msgID = msgID                  # Int
+        self.srcID = sys.intern(srcID)      # UUID String, or '' before the client has one; interned so
+                                            # the controller's tables share one copy of each clientID
+        self.payload = payload if payload is not None else {}   # dict
+        self.addr = None                    # peer address, filled in for msgID 112
+        self.socket = None                  # websocket, filled in for msgID 112
+
+    def get(self, key, kind=object, default=None):
+        """
+        Reads a payload field
+
+        :param key: name of the field
+        :param kind: type (or tuple of types) the value must be
+        :param default: returned when the field is missing or of another type
+        :return: the value, or default
+        """
+        value = self.payload.get(key)
+        if not isinstance(value, kind) or (kind is int and not is_int(value)):
+            return default
+        return value
+
+    def __repr__(self):
+        return "Request({!r}, {!r}, {!r})".format(self.msgID, self.srcID, self.payload)
+
+def is_int(value):
+    """
+    :return: boolean - whether value is an int, and not a bool
+    """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def check_name(value, field):
+    """
+    :param value: a nickname or instrument
+    :param field: the name of the field, for the error
+    :raises MessageError: if value isn't a string of at most MAX_NAME_LENGTH characters
+    """
+    if not isinstance(value, str) or len(value) > MAX_NAME_LENGTH:
+        raise MessageError("{} must be a string of at most {} characters".format(field, MAX_NAME_LENGTH))
+
+def check_track(track, field):
+    """
+    :param track: a track dict, as sent in a msgID 100 or 108
+    :param field: the name of the field, for errors
+    :raises MessageError: if the track's trackID isn't an int or its instrument isn't a name
+    """
+    if not is_int(track.get('trackID')):
+        raise MessageError(field + ".trackID must be an int")
+    if track.get('instrument') is not None:
+        check_name(track['instrument'], field + ".instrument")
+
+def check_session(payload):
+    """
+    Checks the session of a msgID 100, if it has one; handlers report a missing session themselves
+
+    :raises MessageError: if its sessionID isn't an int or its board isn't a list of well-formed tracks
+    """
+    sess = payload.get('session')
+    if not isinstance(sess, dict):
+        return
+    if 'sessionID' in sess and not is_int(sess['sessionID']):
+        raise MessageError("session.sessionID must be an int")
+    board = sess.get('board')
+    if board is None:
+        return
+    if not isinstance(board, list):
+        raise MessageError("session.board must be a list of tracks")
+    for track in board:
+        if not isinstance(track, dict):
+            raise MessageError("each track of session.board must be an object with an int trackID")
+        check_track(track, "session.board[]")
+
+def check_broadcast(payload):
+    """
+    Checks the track and sessionIDs of a msgID 108, where present
+
+    :raises MessageError: if the track is malformed or sessionIDs isn't a list of ints
+    """
+    track = payload.get('track')
+    if isinstance(track, dict):
+        check_track(track, "track")
+    sessionIDs = payload.get('sessionIDs')
+    if isinstance(sessionIDs, list) and not all(is_int(sid) for sid in sessionIDs):
+        raise MessageError("sessionIDs must be a list of ints")
+
+def check_connect(payload):
+    """
+    Checks the nickname of a msgID 112, where present
+
+    :raises MessageError: if the nickname is too long to send back to other clients
+    """
+    if payload.get('nickname') is not None:
+        check_name(payload['nickname'], "nickname")
+
+PAYLOAD_CHECKS = {
+    100: check_session,
+    108: check_broadcast,
+    112: check_connect
+}
+
+def parse(obj):
+    """
+    Checks a decoded message once, on arrival
+
+    :param obj: the message as decoded from its frame
+    :return: a Request
+    :raises MessageError: if messageID, sourceID or payload are missing or of the wrong type, or a
+        field nested in the payload is malformed
+    """
+    if not isinstance(obj, dict):
+        raise MessageError("message must be an object")
+
+    msgID = obj.get('messageID')
+    if not isinstance(msgID, int) or isinstance(msgID, bool):
+        raise MessageError("messageID must be provided")
+
+    srcID = obj.get('sourceID') or ''
+    if not isinstance(srcID, str):
+        raise MessageError("sourceID must be a string")
+
+    payload = obj.get('payload')
+    if payload is not None and not isinstance(payload, dict):
+        raise MessageError("payload must be an object")
+
+    check = PAYLOAD_CHECKS.get(msgID)
+    if check is not None and payload:
+        check(payload)
+
+    return Request(msgID, srcID, payload)
@@ -0,0 +1,130 @@
+"""
+Lunar Rocks Compression
+
+permessage-deflate that compresses each outgoing message once, however many connections it is sent
+to. Connections negotiate deflate without context takeover on the server's side, so a message
+compressed with a given window size is the same for every connection that agreed on that window,
+and the whole websocket frame is built once and written to each of them as it is. Messages below a
+size threshold are sent uncompressed, since compressing them costs more than it saves.
+"""
+
+import struct
+import zlib
+from websockets.extensions import permessage_deflate
+from websockets.frames import OP_BINARY, OP_TEXT
+from websockets.legacy.server import WebSocketServerProtocol
+import metrics
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+DEFAULT_THRESHOLD = 1024            # bytes; smaller messages are sent uncompressed
+WINDOW_BITS = 12                    # largest LZ77 window the server compresses with
+COMPRESS_SETTINGS = {'memLevel': 5}
+EMPTY_BLOCK = b'\x00\x00\xff\xff'   # end of every Z_SYNC_FLUSH, left off the wire
+
+DEFLATED = metrics.REGISTRY.counter('lunar_deflated_messages_total', "Outgoing messages compressed, once each")
+DEFLATED_BYTES = metrics.REGISTRY.counter('lunar_deflated_bytes_total', "Bytes of outgoing messages before and after compression",
+                                          ('stage',))
+
+class Deflated:
+    """
+    A message compressed and framed once, ready to be written to any connection that negotiated
+    the window it was compressed with
+    """
+
+    def __init__(self, frame):
+        self.frame = frame          # bytes, a whole websocket frame with rsv1 set
+
+    def __len__(self):
+        return len(self.frame)
+
+class SharedDeflate(permessage_deflate.PerMessageDeflate):
+    """
+    permessage-deflate for one connection, leaving small messages uncompressed
+    """
+
+    def __init__(self, extension, threshold):
+        super().__init__(extension.remote_no_context_takeover, extension.local_no_context_takeover,
+                         extension.remote_max_window_bits, extension.local_max_window_bits,
+                         extension.compress_settings)
+        self.threshold = threshold  # Int, bytes
+
+    def encode(self, frame):
+        if frame.opcode in (OP_TEXT, OP_BINARY) and frame.fin and len(frame.data) < self.threshold:
+            return frame
+        return super().encode(frame)
+
+class SharedDeflateFactory(permessage_deflate.ServerPerMessageDeflateFactory):
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        super().__init__(server_no_context_takeover=True, server_max_window_bits=WINDOW_BITS,
+                         client_max_window_bits=WINDOW_BITS, compress_settings=COMPRESS_SETTINGS)
+        self.threshold = threshold  # Int, bytes
+
+    def process_request_params(self, params, accepted_extensions):
+        response, extension = super().process_request_params(params, accepted_extensions)
+        return response, SharedDeflate(extension, self.threshold)
+
+class Protocol(WebSocketServerProtocol):
+    """
+    Server connections that can be sent a Deflated message
+    """
+
+    async def send_deflated(self, deflated):
+        """
+        :param deflated: a Deflated made for this connection's window
+        :return: None
+        """
+        await self.ensure_open()
+        self.transport.write(deflated.frame)
+        await self.drain()
+
+def negotiated(sock):
+    """
+    :param sock: a websocket object
+    :return: the connection's SharedDeflate, or None if it doesn't compress
+    """
+    for extension in getattr(sock, 'extensions', ()):
+        if isinstance(extension, SharedDeflate):
+            return extension
+    return None
+
+def deflate(frame, window_bits):
+    """
+    Compresses and frames a message the way SharedDeflate would for a single connection
+
+    :param frame: str for a text frame, bytes for a binary one
+    :param window_bits: the connection's local_max_window_bits
+    :return: Deflated
+    """
+    if isinstance(frame, str):
+        opcode, data = OP_TEXT, frame.encode('utf-8')
+    else:
+        opcode, data = OP_BINARY, bytes(frame)
+    encoder = zlib.compressobj(wbits=-window_bits, **COMPRESS_SETTINGS)
+    body = encoder.compress(data) + encoder.flush(zlib.Z_SYNC_FLUSH)
+    if body.endswith(EMPTY_BLOCK):
+        body = body[:-len(EMPTY_BLOCK)]
+
+    DEFLATED.inc()
+    DEFLATED_BYTES.inc(('in',), len(data))
+    DEFLATED_BYTES.inc(('out',), len(body))
+    return Deflated(header(opcode, len(body)) + body)
+
+def header(opcode, length):
+    """
+    :return: bytes, the header of an unmasked, unfragmented frame with rsv1 set
+    """
+    head = 0b11000000 | opcode
+    if length < 126:
+        return struct.pack('!BB', head, length)
+    if length < 65536:
+        return struct.pack('!BBH', head, 126, length)
+    return struct.pack('!BBQ', head, 127, length)
@@ -5,9 +5,12 @@ The classes in this module comprise the building blocks of the Lunar Rocks Serve
 """
 
 import numpy as np
-import random
+import collections
 import uuid
 import logging
+import math
+import secrets
+import sys
 import time
 
 __author__ = "Cody Shepherd & Brian Ginsburg"
@@ -27,21 +30,45 @@ MIN_SESS_ID = 1
 DEFAULT_TEMPO = 8
 LOG_NAME = "server.log"
 NUM_INITIAL_TRACKS = 2
-TRACK_IDS = list(range(NUM_INITIAL_TRACKS))
+MAX_TONES = 88
+MAX_BEATS = 256
+MAX_TRACKS = 16
+INLINE_CELLS = 4096        # boards with more cells than this leave their grids out of snapshots
+PAGE_CELLS = 4096          # most cells sent in one msgID 120 grid page
+HISTORY_LENGTH = 256       # cell changes each session keeps for clients catching up after a reconnect
+TIER_ALL = 'all'           # recipient tiers of a session; see Session.recipients()
+TIER_OWNERS = 'owners'
+TIER_OBSERVERS = 'observers'
 TIME_TO_LIVE = 1           # 2 minutes
+WHEEL_RESOLUTION = 1       # seconds per slot of the expiry timer wheel
+WHEEL_SLOTS = 64
+RESUME_TOKEN_BYTES = 16    # randomness in each client's resume token
 
-LOGGER = logging.getLogger('root')
+LOGGER = logging.getLogger('lunar.controller')
+
+def grid_dtype(dimensions):
+    """
+    Picks the smallest unsigned integer type that holds every value a grid of these dimensions allows
+
+    :param dimensions: (tones, beats) tuple
+    :return: a numpy dtype
+    """
+    if dimensions[1] <= 0xff:
+        return np.uint8
+    return np.uint16
 
 class Track:
 
+    __slots__ = ('trackID', 'clientID', 'grid', 'dimensions', 'instrument', 'gridVersion')
+
     def __init__(self, trackID, dimensions=(DEFAULT_TONES, DEFAULT_BEATS), tempo=DEFAULT_TEMPO, instrument=DEFAULT_INSTRUMENTS[0]):
-        LOGGER.debug("Track " + str(trackID) + " created")
+        LOGGER.debug("Track %s created", trackID)
         self.trackID = trackID                  # Int
-        self.clientID = ''                      # UUID String
-        self.clientNick = ''                    # String
-        self.grid = np.zeros(dimensions, dtype=int).tolist() # 2D list of ints
-        self.dimensions = dimensions            # tuple of ints
+        self.clientID = ''                      # UUID String; the nickname is the session's to look up
+        self.grid = np.zeros(dimensions, dtype=grid_dtype(dimensions)) # 2D array of small ints
+        self.dimensions = tuple(dimensions)     # tuple of ints
         self.instrument = instrument    # string
+        self.gridVersion = 0                    # Int, session version at which the grid last changed
 
     def update(self, trk):
         """
@@ -51,44 +78,183 @@ class Track:
         :return: boolean about success of funciton
         """
         LOGGER.debug("Track.update() started")
+        newinst = trk.get('instrument')
+        if newinst is not None and not isinstance(newinst, str):
+            LOGGER.error("Instrument provided to Track.update() is not a string")
+            return False
+
         newgrid = trk.get('grid')
         if newgrid is None:
             LOGGER.error("No new grid state provided to Track.update()")
             return False
 
-        if not self.check_dimensions(newgrid):
-            LOGGER.error("New grid has wrong dimensions in Track.update()")
+        newgrid = self.parse_grid(newgrid)
+        if newgrid is None:
+            LOGGER.error("New grid is invalid in Track.update()")
             return False
 
-        self.grid = newgrid 
-
-        newinst = trk.get('instrument')
+        self.grid = newgrid
         if newinst is not None:
             self.instrument = newinst
 
         return True
 
+    def set_cell(self, tone, beat, value):
+        """
+        Sets a single cell of the grid
+
+        :param tone: row index int
+        :param beat: column index int
+        :param value: 0 for a rest, otherwise the position of the beat within its note event
+        :return: boolean - whether the cell was valid and changed
+        """
+        if not all(type(x) is int for x in (tone, beat, value)):
+            LOGGER.error("Non-integer cell passed to Track.set_cell()")
+            return False
+
+        if not (0 <= tone < self.dimensions[0] and 0 <= beat < self.dimensions[1]):
+            LOGGER.error("Cell %s passed to Track.set_cell() is outside the grid", (tone, beat))
+            return False
+
+        if not 0 <= value <= self.dimensions[1]:
+            LOGGER.error("Value %s passed to Track.set_cell() is out of range", value)
+            return False
+
+        if self.grid[tone, beat] == value:
+            return False
+
+        self.grid[tone, beat] = value
+        return True
+
+    def set_region(self, tone, beat, grd):
+        """
+        Overwrites a rectangle of the grid
+
+        :param tone: index of the region's first row
+        :param beat: index of the region's first column
+        :param grd: a 2-D list of ints, the region's new values
+        :return: list of [tone, beat, value] lists for the cells that changed, or None if grd is invalid
+        """
+        arr = self.parse_grid(grd, (tone, beat))
+        if arr is None:
+            return None
+
+        rows, cols = arr.shape
+        region = self.grid[tone:tone + rows, beat:beat + cols]
+        tones, beats = np.nonzero(arr != region)
+        changed = np.column_stack((tones + tone, beats + beat, arr[tones, beats])).tolist()
+        region[...] = arr
+        return changed
+
+    def page(self, tone):
+        """
+        A run of whole rows of the grid, for clients fetching a grid that snapshots leave out
+
+        :param tone: index of the first row
+        :return: numpy array of at most PAGE_CELLS cells, empty if tone is past the last row
+        """
+        rows = max(1, PAGE_CELLS // self.dimensions[1])
+        return self.grid[tone:tone + rows]
+
+    def parse_grid(self, grd, origin=None):
+        """
+        Validates a whole grid, or a region of one, at once and converts it to this track's storage format
+
+        :param grd: a 2-D list of ints
+        :param origin: (tone, beat) of the region's first cell, or None for a whole grid
+        :return: a numpy array, or None if grd isn't a valid grid for this track
+        """
+        LOGGER.debug("Track.parse_grid() started")
+        try:
+            arr = np.array(grd)
+        except (TypeError, ValueError):
+            LOGGER.error("grid passed to Track.parse_grid() is not a 2-D list")
+            return None
+
+        if origin is None:
+            if not self.check_dimensions(arr):
+                return None
+        elif not self.check_region(arr, origin):
+            return None
+
+        if arr.dtype.kind not in 'iu':
+            LOGGER.error("grid passed to Track.parse_grid() contains non-integer values")
+            return None
+
+        if arr.min() < 0 or arr.max() > self.dimensions[1]:
+            LOGGER.error("grid passed to Track.parse_grid() contains out of range values")
+            return None
+
+        return arr.astype(self.grid.dtype)
+
     def check_dimensions(self, grd):
         """
         Ensures dimensions of given state matches those of self.dimensions
 
-        :param grd: a 2-D list
+        :param grd: a numpy array
         :return: boolean about success of function
         """
         LOGGER.debug("Track.check_dimensions() started")
-        rows = len(grd)
-        cols = len(grd[0])
 
-        if not (rows==self.dimensions[0] and cols==self.dimensions[1]):
+        if grd.shape != self.dimensions:
             LOGGER.error("grid passed to Task.check_dimensions is the wrong dimensions!")
             return False
 
         return True
 
-    def export(self):
+    def check_region(self, grd, origin):
+        """
+        Ensures a region lies within the grid
+
+        :param grd: a numpy array
+        :param origin: (tone, beat) of the region's first cell
+        :return: boolean about success of function
+        """
+        tone, beat = origin
+        if grd.ndim != 2 or grd.size == 0:
+            LOGGER.error("region passed to Track.check_region() is not a non-empty 2-D grid")
+            return False
+
+        if not (0 <= tone and tone + grd.shape[0] <= self.dimensions[0] and
+                0 <= beat and beat + grd.shape[1] <= self.dimensions[1]):
+            LOGGER.error("region at %s passed to Track.check_region() doesn't fit the grid", origin)
+            return False
+
+        return True
+
+    def record(self):
+        """
+        The track's contents, for journal records
+
+        :return: [trackID, instrument, grid as a list of lists]
+        """
+        return [self.trackID, self.instrument, self.grid.tolist()]
+
+    def dump(self, grids, nickname=''):
+        """
+        The track's full state, for snapshots
+
+        :param grids: dict of grid shape: list of grids, to which this track's grid is added
+        :param nickname: nickname of the track's owner
+        :return: dict like export(), with the grid given as (shape, index in grids[shape])
+        """
+        same = grids.setdefault(self.grid.shape, [])
+        same.append(self.grid)
+        return {
+            "trackID": self.trackID,
+            "clientID": self.clientID,
+            "nickname": nickname,
+            "instrument": self.instrument,
+            "gridVersion": self.gridVersion,
+            "grid": (self.grid.shape, len(same) - 1)
+        }
+
+    def export(self, inline=True, nickname=''):
         """
         exports internal parametrs as json-serializable dict
 
+        :param inline: whether to include the grid; clients fetch grids left out with msgID 119
+        :param nickname: nickname of the track's owner
         :return: well-formed dict according to the RFC
         """
         LOGGER.debug("Task.export() started")
@@ -96,21 +262,88 @@ class Track:
         return {
             "trackID": self.trackID,
             "clientID": self.clientID,
-            "nickname": self.clientNick,
+            "nickname": nickname,
             "instrument": self.instrument,
-            "grid": self.grid
+            "tones": self.dimensions[0],
+            "beats": self.dimensions[1],
+            "gridVersion": self.gridVersion,
+            "grid": self.grid.tolist() if inline else None
         }
 
 class Session:
 
-    def __init__(self, sessionID):
-        LOGGER.debug("Session " + str(sessionID) + " created")
-        self.clientlist = []                # list of (UUID, nickname) pairs
+    __slots__ = ('clients', 'owned', 'recipient_cache', 'sessionID', 'dimensions', 'trackIDs', 'tracks',
+                 'version', 'cache', 'history', 'inline')
+
+    def __init__(self, sessionID, dimensions=(DEFAULT_TONES, DEFAULT_BEATS), ntracks=NUM_INITIAL_TRACKS):
+        LOGGER.debug("Session %s created", sessionID)
+        self.clients = {}                   # UUID: nickname (the Controller's string), in order of joining
+        self.owned = {}                     # UUID: set(trackID), for clients owning tracks
+        self.recipient_cache = {}           # tier: [UUID], the clients of each tier
         self.sessionID = sessionID          # Int
-        self.trackIDs = TRACK_IDS           # [Int]
+        self.dimensions = tuple(dimensions) # (tones, beats) of every track
+        self.trackIDs = list(range(ntracks))    # [Int]
         self.tracks = {}                    # Int: Track
+        self.version = 0                    # Int, incremented on every change of state
+        self.cache = {}                     # Anything derived from the current version, by key
+        self.history = None                 # deque of (base version, [cell] or None) of recent changes, oldest first; None while empty
+        self.inline = ntracks * self.dimensions[0] * self.dimensions[1] <= INLINE_CELLS  # whether snapshots carry grids
         for num in self.trackIDs:
-            self.tracks[num] = Track(num, instrument=DEFAULT_INSTRUMENTS[num%len(DEFAULT_INSTRUMENTS)])
+            self.tracks[num] = Track(num, self.dimensions, instrument=DEFAULT_INSTRUMENTS[num%len(DEFAULT_INSTRUMENTS)])
+
+    def touch(self, tracks=(), cells=None):
+        """
+        Marks the session as changed: bumps its version and drops everything cached for the old one
+
+        :param tracks: the Tracks whose grids changed, if any
+        :param cells: the change as [trackID, tone, beat, value] lists, or None for changes that
+            can't be expressed as cells
+        :return: the new version (int)
+        """
+        if cells is not None and len(cells) > PAGE_CELLS:
+            cells = None
+        if cells is not None and self.history is None:
+            self.history = collections.deque(maxlen=HISTORY_LENGTH)
+        if self.history is not None:
+            # Other changes, like clients joining or claiming tracks, are kept as markers: clients
+            # that missed one need a snapshot, but those that saw it can still catch up with cells
+            self.history.append((self.version, cells))
+        self.version += 1
+        self.cache = {}
+        for track in tracks:
+            track.gridVersion = self.version
+        return self.version
+
+    def changes_since(self, version):
+        """
+        The cells changed after a version, merged into one update, if the history goes back that far
+
+        :param version: the last version a client saw
+        :return: list of [trackID, tone, beat, value] lists (empty if the client is up to date), or
+            None if the client needs a snapshot
+        """
+        if version == self.version:
+            return []
+        if version > self.version or not self.history or self.history[0][0] > version:
+            return None
+
+        merged = {}
+        for base, cells in self.history:
+            if base >= version:
+                if cells is None:
+                    return None
+                for tid, tone, beat, value in cells:
+                    merged[(tid, tone, beat)] = value
+        return [[tid, tone, beat, value] for (tid, tone, beat), value in merged.items()]
+
+    def get_track(self, tid):
+        """
+        :param tid: trackID as sent by a client, of any type
+        :return: the Track, or None if tid isn't the ID of one of the session's tracks
+        """
+        if type(tid) is not int:
+            return None
+        return self.tracks.get(tid)
 
     def update(self, sess):
         """
@@ -122,26 +355,31 @@ class Session:
         LOGGER.debug("Session.update() started")
 
         trackslist = sess.get('board')
-        if trackslist is None:
+        if not isinstance(trackslist, list):
             LOGGER.error("No tracklist provided to Session.update() by sess argument")
             return None
 
-        LOGGER.debug("Trackslist: " + str(trackslist))
+        LOGGER.debug("Trackslist: %s", trackslist)
         '''
         for (new, trackobj) in zip(trackslist, self.tracks):
             if not trackobj.update(new):
                 LOGGER.error("Session.update() quitting because of error in Track.update()")
                 return None
         '''
+        changed = []
         for newtrack in trackslist:
-            trackID = int(newtrack.get('trackID'))
-            if trackID not in self.tracks.keys():
+            trackID = newtrack.get('trackID') if isinstance(newtrack, dict) else None
+            oldtrack = self.get_track(trackID)
+            if oldtrack is None:
                 LOGGER.error("trackID provided not in session's tracks.keys()")
                 continue
-            oldtrack = self.tracks[trackID]
             if not oldtrack.update(newtrack):
-                LOGGER.error("Session.update() skipping track " + str(trackID) + " because of error in Track.update()")
+                LOGGER.error("Session.update() skipping track %s because of error in Track.update()", trackID)
                 continue
+            changed.append(oldtrack)
+
+        if changed:
+            self.touch(changed)
 
         return self
 
@@ -155,47 +393,116 @@ class Session:
         """
         LOGGER.debug("Session.update_track() started")
 
-        tid = trk['trackID']
+        tid = trk.get('trackID')
 
-        track = self.tracks.get(tid)
+        track = self.get_track(tid)
 
         if track is None:
-            LOGGER.error("No track by id " + str(tid) + " found")
+            LOGGER.error("No track by id %s found", tid)
             return False
 
         if track.clientID != cid:
-            LOGGER.error("Client " + str(cid) + " doesn't own track " + str(tid))
+            LOGGER.error("Client %s doesn't own track %s", cid, tid)
             return False
 
         if not track.update(trk):
             LOGGER.error("Track update failed")
             return False
 
+        self.touch([track])
         return True
 
-    def request_track(self, cid, nick, tid):
+    def update_cells(self, cid, cells):
+        """
+        Applies cell-level changes to the tracks the client owns
+
+        Cells on tracks the client doesn't own, and malformed cells, are skipped.
+
+        :param cid: clientID
+        :param cells: list of [trackID, tone, beat, value] lists
+        :return: list of the cells that changed, in the same format
+        """
+        LOGGER.debug("Session.update_cells() started")
+
+        changed = []
+        tracks = set()
+        for cell in cells:
+            if not isinstance(cell, list) or len(cell) != 4 or not all(type(x) is int for x in cell):
+                LOGGER.error("Malformed cell passed to Session.update_cells(): %s", cell)
+                continue
+
+            tid, tone, beat, value = cell
+            track = self.tracks.get(tid)
+
+            if track is None:
+                LOGGER.error("No track by id %s found", tid)
+                continue
+
+            if track.clientID != cid:
+                LOGGER.error("Client %s doesn't own track %s", cid, tid)
+                continue
+
+            if track.set_cell(tone, beat, value):
+                changed.append(cell)
+                tracks.add(track)
+
+        if changed:
+            self.touch(tracks, changed)
+
+        return changed
+
+    def update_region(self, cid, tid, tone, beat, grd):
+        """
+        Overwrites a rectangle of a track the client owns
+
+        :param cid: clientID
+        :param tid: trackID
+        :param tone: index of the region's first row
+        :param beat: index of the region's first column
+        :param grd: a 2-D list of ints, the region's new values
+        :return: list of the cells that changed, as [trackID, tone, beat, value] lists, or None if
+            the region couldn't be applied
+        """
+        LOGGER.debug("Session.update_region() started")
+
+        track = self.get_track(tid)
+
+        if track is None:
+            LOGGER.error("No track by id %s found", tid)
+            return None
+
+        if track.clientID != cid:
+            LOGGER.error("Client %s doesn't own track %s", cid, tid)
+            return None
+
+        changed = track.set_region(tone, beat, grd)
+        if changed is None:
+            return None
+
+        changed = [[tid] + cell for cell in changed]
+        if changed:
+            self.touch([track], changed)
+
+        return changed
+
+    def request_track(self, cid, tid):
         """
         Adds cid as owner to specified track if that track is available
 
         :param cid: clientID string
-        :param nick: client nickname string
         :param tid: trackID int
         :return: trackID, sessionID, boolean - the first two fields are None if last is False
         """
         LOGGER.debug("Session.request_track() started")
 
-        if cid not in [x[0] for x in self.clientlist]:
-            LOGGER.error("clientID passed to Session.request_track() not in session clientlist")
-            return (None, None, False)
-
-        if tid not in self.trackIDs:
-            LOGGER.error("trackID passed to Session.request_track() not in trackIDs")
+        if cid not in self.clients:
+            LOGGER.error("clientID passed to Session.request_track() not in session clients")
             return (None, None, False)
 
-        t = self.tracks.get(tid)
+        t = self.get_track(tid)
 
         if t is None:
-            LOGGER.error("For some reason the trackID passed to Session.request_track() can't find a track!")
+            LOGGER.error("trackID passed to Session.request_track() not in trackIDs")
             return (None, None, False)
 
         if t.clientID != '':
@@ -203,9 +510,10 @@ class Session:
             return (None, None, False)
 
         t.clientID = cid
-        t.clientNick = nick
-        self.tracks[tid] = t
-        LOGGER.debug("Session.request_track() returning " + str(t.trackID) + ", " + str(self.sessionID) + ", " + str(True))
+        self.owned.setdefault(cid, set()).add(tid)
+        self.recipient_cache = {}
+        self.touch()
+        LOGGER.debug("Session.request_track() returning %s, %s, %s", t.trackID, self.sessionID, True)
         return (t.trackID, self.sessionID, True)
 
     def relinquish_track(self, cid, tid):
@@ -218,25 +526,24 @@ class Session:
         """
         LOGGER.debug("Session.relinquish_track() started")
 
-        if cid not in [x[0] for x in self.clientlist]:
-            LOGGER.error("clientID " + str(cid) + " passed to Session.relinquish_track() not in session's clientlist")
-            LOGGER.error("clientlist: " + str(self.clientlist))
-            return False
-
-        if tid not in self.trackIDs:
-            LOGGER.error("trackID " + str(tid) + " provided to Session.relinquish_track() not in Session's trackIDs")
+        if cid not in self.clients:
+            LOGGER.error("clientID %s passed to Session.relinquish_track() not in session's clients", cid)
             return False
 
-        t = self.tracks.get(tid)
+        t = self.get_track(tid)
 
         if t is None:
-            LOGGER.error("For some reason the trackID " + str(tid) + " passed to Session.relinquish_track() can't find a track!")
+            LOGGER.error("trackID %s provided to Session.relinquish_track() not in Session's trackIDs", tid)
             return False
 
         if t.clientID == cid:
             t.clientID = ''
-            t.clientNick = ''
-            self.tracks[tid] = t
+            owned = self.owned.get(cid)
+            owned.discard(tid)
+            if not owned:
+                del self.owned[cid]
+                self.recipient_cache = {}
+            self.touch()
 
         return True
 
@@ -250,10 +557,10 @@ class Session:
         """
         LOGGER.debug("Session.add_client() started")
 
-        if cid not in [x[0] for x in self.clientlist]:
-            self.clientlist.append((cid, nick))
-
-        #LOGGER.debug("Session clientlist after adding: " + str(self.clientlist))
+        if cid not in self.clients:
+            self.clients[cid] = nick
+            self.recipient_cache = {}
+            self.touch()
 
         return True
 
@@ -266,14 +573,16 @@ class Session:
         """
         LOGGER.debug("Session.remove_client() started")
 
-        if cid not in [x[0] for x in self.clientlist]:
+        if cid not in self.clients:
             LOGGER.error("id provided to Session.remove_client() is not a member of the session")
             return False
 
-        for tid in self.trackIDs:
+        for tid in list(self.owned.get(cid, ())):
             self.relinquish_track(cid, tid)
 
-        self.clientlist = [x for x in self.clientlist if x[0] != cid]
+        del self.clients[cid]
+        self.recipient_cache = {}
+        self.touch()
 
         return True
 
@@ -285,82 +594,289 @@ class Session:
         :return: boolean - whether function was successful or not
         """
         LOGGER.debug("Session.is_empty() started")
-        if not self.clientlist:
+        if not self.clients:
             return True
 
         return False
 
+    def recipients(self, tier=TIER_ALL):
+        """
+        Lists the clients to send the session's updates to; the lists are rebuilt only when membership
+        or track ownership changes, so callers must not modify them.
+
+        :param tier: TIER_ALL, TIER_OWNERS for the clients owning a track, or TIER_OBSERVERS for the rest
+        :return: list of clientIDs
+        """
+        clients = self.recipient_cache.get(tier)
+        if clients is None:
+            if tier == TIER_OWNERS:
+                clients = [cid for cid in self.clients if cid in self.owned]
+            elif tier == TIER_OBSERVERS:
+                clients = [cid for cid in self.clients if cid not in self.owned]
+            else:
+                clients = list(self.clients.keys())
+            self.recipient_cache[tier] = clients
+        return clients
+
+    def dump(self, grids):
+        """
+        The session's full state, for snapshots
+
+        :param grids: see Track.dump()
+        :return: dict
+        """
+        return {
+            "sessionID": self.sessionID,
+            "version": self.version,
+            "dimensions": self.dimensions,
+            "clients": list(self.clients.items()),
+            "tracks": [x.dump(grids, self.clients.get(x.clientID, '')) for x in self.tracks.values()]
+        }
+
     def export(self):
         """
         Exports pertinent contents as a json-serializable dict
 
+        The dict is built once per version; callers must not modify it.
+
         :return: session as dict according to RFC
         """
         LOGGER.debug("Session.export() started")
-        return {
-            "clients": [x[1] for x in self.clientlist],  # export only client nicknames
-            "sessionID": self.sessionID,
-            "tempo": DEFAULT_TEMPO,
-            "board": [x.export() for x in self.tracks.values()]
-        }
+        exported = self.cache.get('export')
+        if exported is None:
+            exported = {
+                "clients": list(self.clients.values()),  # export only client nicknames
+                "sessionID": self.sessionID,
+                "version": self.version,
+                "tempo": DEFAULT_TEMPO,
+                "board": [x.export(self.inline, self.clients.get(x.clientID, '')) for x in self.tracks.values()]
+            }
+            self.cache['export'] = exported
+        return exported
+
+class TimerWheel:
+    """
+    A hashed timer wheel of deadlines by key.
+
+    Scheduling, postponing and cancelling a timer are O(1). Postponed and cancelled timers are left
+    in their old slot and only moved or discarded when the wheel comes round to it.
+    """
+
+    def __init__(self, resolution=WHEEL_RESOLUTION, slots=WHEEL_SLOTS, clock=time.monotonic):
+        self.resolution = resolution                # Float, seconds per slot
+        self.slots = [set() for _ in range(slots)]  # [set(key)]
+        self.deadlines = {}                         # key: deadline
+        self.clock = clock                          # function returning the current time
+        self.tick = int(clock() // resolution)      # Int, last tick advanced to
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def tick_of(self, t):
+        return int(math.ceil(t / self.resolution))
+
+    def slot_of(self, t):
+        # Deadlines the wheel has already turned past go in the next slot it visits, rather than
+        # waiting a whole turn for their own to come round again
+        return self.slots[max(self.tick_of(t), self.tick + 1) % len(self.slots)]
+
+    def schedule(self, key, deadline):
+        """
+        Sets the deadline of key, replacing any earlier one
+
+        :param key: hashable
+        :param deadline: time as returned by the wheel's clock
+        :return: None
+        """
+        old = self.deadlines.get(key)
+        self.deadlines[key] = deadline
+        if old is None or deadline < old:
+            self.slot_of(deadline).add(key)
+
+    def cancel(self, key):
+        """
+        Removes the deadline of key, if it has one
+
+        :param key: hashable
+        :return: boolean - whether key had a deadline
+        """
+        return self.deadlines.pop(key, None) is not None
+
+    def advance(self):
+        """
+        Turns the wheel to the current time
+
+        :return: list of keys whose deadlines have passed
+        """
+        # Timers sit in the slot of the tick at or after their deadline, and fire once that tick
+        # has fully passed, so never early
+        current = int(self.clock() // self.resolution)
+        due = []
+
+        # Each slot needs visiting at most once, however long it's been since the last call
+        start = max(self.tick + 1, current - len(self.slots) + 1)
+        for tick in range(start, current + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key in list(slot):
+                deadline = self.deadlines.get(key)
+                if deadline is None:
+                    slot.discard(key)
+                elif self.tick_of(deadline) <= current:
+                    slot.discard(key)
+                    del self.deadlines[key]
+                    due.append(key)
+                elif self.slot_of(deadline) is not slot:
+                    slot.discard(key)
+                    self.slot_of(deadline).add(key)
+
+        self.tick = current
+        return due
+
+class IDAllocator:
+    """
+    Hands out integer IDs from a fixed range in O(1).
+
+    Released IDs are reused first-in, first-out, so a recently released ID is the last to be handed
+    out again.
+    """
+
+    def __init__(self, low=MIN_SESS_ID, high=MAX_SESS_ID):
+        self.low = low                      # Int, lowest ID in the range
+        self.high = high                    # Int, highest ID in the range
+        self.fresh = low                    # Int, lowest ID never handed out
+        self.released = collections.deque() # [Int]
+        self.used = 0                       # Int
+
+    def allocate(self):
+        """
+        :return: an unused ID, or None if the range is exhausted
+        """
+        if self.released:
+            new = self.released.popleft()
+        elif self.fresh <= self.high:
+            new = self.fresh
+            self.fresh += 1
+        else:
+            return None
+
+        self.used += 1
+        return new
+
+    def release(self, old):
+        """
+        Returns an ID handed out by allocate() to the pool
+
+        :param old: Int
+        :return: None
+        """
+        self.released.append(old)
+        self.used -= 1
+
+    def capacity(self):
+        return self.high - self.low + 1
+
+    def dump(self):
+        return {"fresh": self.fresh, "released": list(self.released), "used": self.used}
+
+    def restore(self, state):
+        """
+        Picks up where the allocator that produced state by dump() left off
+
+        :param state: dict
+        :return: None
+        """
+        self.fresh = state["fresh"]
+        self.released = collections.deque(state["released"])
+        self.used = state["used"]
+
+    def occupancy(self):
+        """
+        :return: fraction of the range currently in use
+        """
+        if self.capacity() <= 0:
+            return 1.0
+        return self.used / self.capacity()
 
 class Controller:
 
-    def __init__(self):
+    def __init__(self, max_sess_id=MAX_SESS_ID):
         LOGGER.debug("Controller.__init__() started")
         self.clients = {}           # (UUID: String)
-        self.client_sessions = {}   # (UUID: List(SessionID))
-        self.client_TTL = {}        # (UUID: timestamp)
+        self.client_sessions = {}   # (UUID: set(SessionID)) for clients in any session
+        self.expiry = TimerWheel()  # (UUID: deadline) for clients who have lost their connection
         self.sessions = {}          # (SessionID: Session)
+        self.session_ids = IDAllocator(MIN_SESS_ID, max_sess_id)
         self.sockets = {}           # UUID: websocket
-        self.addrs = {}             # host: clientID, port
+        self.socket_clients = {}    # websocket: UUID, the reverse of sockets
+        self.tokens = {}            # UUID: resume token the client proves its identity with on reconnecting
+        self.journal = None         # Journal that changes of state are recorded to, if any
+
+    def record(self, *entry):
+        """
+        Records a change of state to the journal, to be replayed by replay() after a restart
+        """
+        if self.journal is not None:
+            self.journal.append(list(entry))
 
     def set_TTL(self, cid):
         """
-        Sets Time-To-Live for a given client's "login."
+        Starts the Time-To-Live of a client that has lost its connection: it will be dropped unless
+        it reconnects within TIME_TO_LIVE minutes.
         """
-        self.client_TTL[cid] = time.time()
+        self.expiry.schedule(cid, self.expiry.clock() + 60 * TIME_TO_LIVE)
 
     def check_TTL(self, cid):
         """
-        Checks the client time against the global time to live value.
+        Checks whether a client is connected or still within its time to live.
 
         returns True if client still has time to live, false if the client isn't found or if the
         client has exceeded its time to live
         """
         sock = self.sockets.get(cid)
         if sock and sock.open:
-            self.set_TTL(cid)
             return True
 
-        if self.client_TTL.get(cid) and time.time() - self.client_TTL.get(cid) < (60 * TIME_TO_LIVE):
-            return True
-        return False
+        deadline = self.expiry.deadlines.get(cid)
+        return deadline is not None and self.expiry.clock() < deadline
 
-    def log_cid_by_address(self, cid, addr):
+    def expire(self):
         """
-        Tracks clientIDs and port numbers by host address,
-        to assist in handling of Duplicate 112 messages from
-        the same client.
+        Collects the clients whose time to live has run out without them reconnecting.
 
-        :param cid: clientID
-        :param addr: (host, port) tuple
-        :return: None
+        :return: list of clientIDs, to be exited by the caller
         """
-        LOGGER.debug("Controller.log_cid_by_address() started")
-
-        self.addrs[str(addr)] = cid
-
-    def get_cid_by_address(self, addr):
+        expired = []
+        for cid in self.expiry.advance():
+            sock = self.sockets.get(cid)
+            if cid in self.clients and not (sock and sock.open):
+                expired.append(cid)
+        return expired
+
+    def get_cid_by_socket(self, sock):
         """
-        Allows for retrieval of (host,port) address by clientID
+        Finds the client a connection belongs to, to assist in handling of Duplicate 112 messages
+        and lost connections.
 
-        :param addr: a host,port tuple
+        :param sock: a websocket object
         :return: clientID or None
         """
-        LOGGER.debug("Controller.get_cid_by_address() started")
+        return self.socket_clients.get(sock)
+
+    def resume(self, cid, token):
+        """
+        Checks a reconnecting client's claim to the clientID it had before
 
-        return self.addrs.get(str(addr))
+        :param cid: the clientID claimed
+        :param token: the resume token the client was given with cid
+        :return: boolean - whether the client exists, the token is its own, and its time to live hasn't run out
+        """
+        expected = self.tokens.get(cid)
+        if expected is None or not isinstance(token, str) or not secrets.compare_digest(expected, token):
+            return False
+        return self.check_TTL(cid)
 
     def log_socket(self, cid, sock):
         """
@@ -371,9 +887,14 @@ class Controller:
         """
         LOGGER.debug("Controller.log_socket() started")
 
-        LOGGER.debug("Logging socket for clientID " + str(cid))
+        LOGGER.debug("Logging socket for clientID %s", cid)
 
+        old = self.sockets.get(cid)
+        if old is not None and old is not sock:
+            self.socket_clients.pop(old, None)
         self.sockets[cid] = sock
+        self.socket_clients[sock] = cid
+        self.expiry.cancel(cid)
 
     def get_socket(self, cid):
         """
@@ -396,39 +917,65 @@ class Controller:
         sess = self.sessions.get(sid)
 
         if sess is None:
-            LOGGER.error("No session " + str(sid) + " found by Controller.get_session()")
+            LOGGER.error("No session %s found by Controller.get_session()", sid)
             return None
 
         return sess.export()
 
-    def new_session(self):
+    def new_session(self, dimensions=(DEFAULT_TONES, DEFAULT_BEATS), ntracks=NUM_INITIAL_TRACKS):
         """
         Start a new session
 
-        :return: sessionID (int) of new session
+        :param dimensions: (tones, beats) of the session's tracks
+        :param ntracks: number of tracks
+        :return: sessionID (int) of new session, or None if no more sessions can be created
         """
         LOGGER.debug("Controller.new_session() started")
-        sid = MIN_SESS_ID
-        while sid in self.sessions.keys():
-            sid = random.randint(MIN_SESS_ID, MAX_SESS_ID)
-        
-        self.sessions[sid] = Session(sid)
+        sid = self.session_ids.allocate()
+        if sid is None:
+            LOGGER.error("Session IDs exhausted: %s sessions exist", len(self.sessions))
+            return None
+
+        self.sessions[sid] = Session(sid, dimensions, ntracks)
+        self.record('session', sid, list(dimensions), ntracks)
+        LOGGER.debug("Session ID occupancy: %s", self.session_ids.occupancy())
         return sid
 
-    def new_client(self, nick):
+    def end_session(self, sid):
+        """
+        Deletes a session and frees its ID for reuse
+
+        :param sid: sessionID int
+        :return: None
+        """
+        LOGGER.debug("Controller.end_session() started")
+        del self.sessions[sid]
+        self.session_ids.release(sid)
+
+    def new_client(self, nick, cid=None, token=None):
         """
         Client joins server
 
         :param nick: String specifying client nickname (human readable name)
+        :param cid: uuid string already assigned to the client elsewhere (e.g. by a router), or None
+        :param token: the client's resume token, when replaying; a new one is made otherwise
         :return: uuid string for new client
         """
         LOGGER.debug("Controller.new_client() started")
-        cid = uuid.uuid4()
-        while cid in self.clients.keys():
-            cid = uuid.uuid4()
+        if token is None:
+            token = secrets.token_urlsafe(RESUME_TOKEN_BYTES)
+
+        if cid is None:
+            cid = str(uuid.uuid4())
+            while cid in self.clients:
+                cid = str(uuid.uuid4())
 
-        self.clients[str(cid)] = nick
-        return str(cid)
+        # Every table keyed by clientID shares this one string; see codec.Request
+        cid = sys.intern(cid)
+        self.clients[cid] = nick
+        self.tokens[cid] = token
+        self.record('client', cid, nick, token)
+        return cid
 
     def client_exit(self, cid):
         """
@@ -444,24 +991,37 @@ class Controller:
             nick = "NOT FOUND"
 
         if cid not in self.clients.keys():
-            LOGGER.error("nick/cid " + nick + '--' + str(cid[:3]) + " provided to Controller.client_exit() not in clients.keys()")
+            LOGGER.error("nick/cid %s--%s provided to Controller.client_exit() not in clients.keys()", nick, cid[:3])
             return False
 
-        c_sessions = self.client_sessions[cid]
+        # Leaving each session relinquishes the client's tracks in it
+        c_sessions = self.client_sessions.pop(cid, ())
         for sid in c_sessions:
             session = self.sessions.get(sid)
             if session is None:
-                LOGGER.error("client_sessions had a sessionID -- " + str(sid) + " -- for which no session existed!")
+                LOGGER.error("client_sessions had a sessionID -- %s -- for which no session existed!", sid)
                 continue
             session.remove_client(cid)
             if session.is_empty():
-                del self.sessions[session.sessionID]
+                self.end_session(session.sessionID)
 
-        self.client_sessions[cid] = []
         del self.clients[cid]
-        del self.sockets[cid]
+        self.tokens.pop(cid, None)
+        sock = self.sockets.pop(cid, None)
+        if sock is not None:
+            self.socket_clients.pop(sock, None)
+        self.expiry.cancel(cid)
+        self.record('exit', cid)
         return True
 
+    def is_member(self, cid, sid):
+        """
+        :param cid: clientID
+        :param sid: sessionID as sent by a client, of any type
+        :return: boolean - whether sid is an int naming a session the client has joined
+        """
+        return type(sid) is int and sid in self.client_sessions.get(cid, ())
+
     def client_join(self, cid, sid):
         """
         Adds client to a session
@@ -474,33 +1034,17 @@ class Controller:
 
         sess = self.sessions.get(sid)
         if sess is None:
-            LOGGER.error("Provided sessionID " + str(sid) + " returns no session")
+            LOGGER.error("Provided sessionID %s returns no session", sid)
             return False
 
         nick = self.clients.get(cid)
         if nick is None:
-            LOGGER.error("Provided clientID " + str(cid) + " returns no nick")
+            LOGGER.error("Provided clientID %s returns no nick", cid)
             return False
 
-        # Check for disconnected Clients
-        to_check = [x[0] for x in sess.clientlist]
-        for c_id in to_check:
-            sock = self.get_socket(c_id)
-            if sock is None:
-                LOGGER.debug("client_join() discovered no socket for clientID " + str(c_id) + ". calling client exit")
-                self.client_exit(c_id)
-            else:
-                try:
-                    sock.ping()
-                except Exception as e:
-                    LOGGER.debug("client_joing() detected closed socket for clientID " + str(cid) + ". calling client exit and removing socket")
-                    self.client_exit(c_id)
-                    del self.sockets[c_id]
-
         sess.add_client(cid, nick)
-        if self.client_sessions.get(cid) is None:
-            self.client_sessions[cid] = []
-        self.client_sessions[cid].append(sess.sessionID)
+        self.client_sessions.setdefault(cid, set()).add(sess.sessionID)
+        self.record('join', cid, sid)
         return True
 
     def client_leave(self, cid, sid):
@@ -515,25 +1059,29 @@ class Controller:
 
         sess = self.sessions.get(sid)
         if sess is None:
-            LOGGER.error("Session " + str(sid) + " not found by Controller.client_leave()")
+            LOGGER.error("Session %s not found by Controller.client_leave()", sid)
             return False
 
         if self.clients.get(cid) is None:
-            LOGGER.error("Client " + str(cid) + " not found by Controller.client_leave()")
+            LOGGER.error("Client %s not found by Controller.client_leave()", cid)
             return False
 
         if not sess.remove_client(cid):
             LOGGER.error("Removing client failed in Controller.client_leave()")
             return False
 
-        c_sessions = self.client_sessions[cid]
-        self.client_sessions[cid] = [x for x in c_sessions if x != sid]
+        sessionIDs = self.client_sessions.get(cid)
+        if sessionIDs is not None:
+            sessionIDs.discard(sid)
+            if not sessionIDs:
+                del self.client_sessions[cid]
 
         #LOGGER.debug("Session " + str(sid) + " after remove_client(): " + str(sess.export()))
 
         if sess.is_empty():
-            del self.sessions[sid]
+            self.end_session(sid)
 
+        self.record('leave', cid, sid)
         return True
 
     def update_session(self, cid, sess):
@@ -552,21 +1100,108 @@ class Controller:
             LOGGER.error("No session ID provided to Controller.update_session()!")
             return None
 
-        sessionIDs = self.client_sessions.get(cid)
-        if not sessionIDs:
-            LOGGER.error("client " + str(cid) + " not in any sessions!")
+        if cid not in self.client_sessions:
+            LOGGER.error("client %s not in any sessions!", cid)
             return None
 
-        if sid not in sessionIDs:
-            LOGGER.error("Client " + str(cid) + " trying to update session it isn't a member of: " + str(sid))
+        if not self.is_member(cid, sid):
+            LOGGER.error("Client %s trying to update session it isn't a member of: %s", cid, sid)
             return None
 
         session = self.sessions.get(sid)
         if not session:
-            LOGGER.error("Session " + str(sid) + " not found by Controller.update_session()")
+            LOGGER.error("Session %s not found by Controller.update_session()", sid)
             return None
 
-        return session.update(sess)
+        version = session.version
+        session = session.update(sess)
+        if session is not None and session.version != version:
+            tids = sorted(set(t['trackID'] for t in sess['board']
+                              if isinstance(t, dict) and session.get_track(t.get('trackID')) is not None))
+            self.record('tracks', sid, [session.tracks[tid].record() for tid in tids])
+        return session
+
+    def update_cells(self, cid, sid, cells):
+        """
+        Cell-level update from client
+
+        :param cid: string - clientID
+        :param sid: sessionID
+        :param cells: list of [trackID, tone, beat, value] lists
+        :return: session, base version, list of changed cells -- session is None if update failed
+        """
+        LOGGER.debug("Controller.update_cells() started")
+
+        if not self.is_member(cid, sid):
+            LOGGER.error("Client %s trying to update session it isn't a member of: %s", cid, sid)
+            return None, None, []
+
+        session = self.sessions.get(sid)
+        if not session:
+            LOGGER.error("Session %s not found by Controller.update_cells()", sid)
+            return None, None, []
+
+        base = session.version
+        changed = session.update_cells(cid, cells)
+        if changed:
+            self.record('cells', cid, sid, changed)
+        return session, base, changed
+
+    def update_region(self, cid, sid, tid, tone, beat, grd):
+        """
+        Region update from client
+
+        :param cid: string - clientID
+        :param sid: sessionID
+        :param tid: trackID
+        :param tone: index of the region's first row
+        :param beat: index of the region's first column
+        :param grd: a 2-D list of ints, the region's new values
+        :return: session, base version, list of changed cells -- session is None if update failed
+        """
+        LOGGER.debug("Controller.update_region() started")
+
+        if not self.is_member(cid, sid):
+            LOGGER.error("Client %s trying to update session it isn't a member of: %s", cid, sid)
+            return None, None, []
+
+        session = self.sessions.get(sid)
+        if not session:
+            LOGGER.error("Session %s not found by Controller.update_region()", sid)
+            return None, None, []
+
+        base = session.version
+        changed = session.update_region(cid, tid, tone, beat, grd)
+        if changed is None:
+            return None, None, []
+        if len(changed) > PAGE_CELLS:
+            # Far smaller as the whole grid than as a list of cells
+            self.record('tracks', sid, [session.tracks[tid].record()])
+        elif changed:
+            self.record('cells', cid, sid, changed)
+        return session, base, changed
+
+    def get_page(self, cid, sid, tid, tone):
+        """
+        A page of a track's grid, for a member of its session
+
+        :param cid: string - clientID
+        :param sid: sessionID
+        :param tid: trackID
+        :param tone: index of the page's first row
+        :return: session, numpy array of the page's rows -- both None if the page can't be read
+        """
+        if not self.is_member(cid, sid):
+            LOGGER.error("Client %s requested a grid of session it isn't a member of: %s", cid, sid)
+            return None, None
+
+        session = self.sessions.get(sid)
+        track = session.get_track(tid) if session else None
+        if track is None or not 0 <= tone < track.dimensions[0]:
+            LOGGER.error("No page at tone %s of track %s:%s", tone, sid, tid)
+            return None, None
+
+        return session, track.page(tone)
 
     def request_track(self, cid, sid, tid):
         """
@@ -582,7 +1217,7 @@ class Controller:
         sess = self.sessions.get(sid)
 
         if not sess:
-            LOGGER.error("sid " + str(sid) + " does not return a session")
+            LOGGER.error("sid %s does not return a session", sid)
             return None, None, False
 
         nick = self.clients.get(cid)
@@ -590,22 +1225,10 @@ class Controller:
             LOGGER.error("cid provided does not exist")
             return None, None, False
 
-        # Check for disconnected Clients
-        to_check = [x[0] for x in sess.clientlist]
-        for c_id in to_check:
-            sock = self.get_socket(c_id)
-            if sock is None:
-                LOGGER.debug("request_track() discovered no socket for clientID " + str(c_id) + ". calling client exit")
-                self.client_exit(c_id)
-            else:
-                try:
-                    sock.ping()
-                except Exception as e:
-                    LOGGER.debug("request_track() detected closed socket for clientID " + str(cid) + ". calling client exit and removing socket")
-                    self.client_exit(c_id)
-                    del self.sockets[c_id]
-
-        return sess.request_track(cid, nick, tid)
+        trid, ssid, yn = sess.request_track(cid, tid)
+        if yn:
+            self.record('own', cid, sid, tid)
+        return trid, ssid, yn
 
     def relinquish_track(self, cid, sid, tid):
         """
@@ -624,7 +1247,11 @@ class Controller:
             LOGGER.error("sid provided does not exist")
             return False
 
-        return sess.relinquish_track(cid, tid)
+        if not sess.relinquish_track(cid, tid):
+            return False
+
+        self.record('disown', cid, sid, tid)
+        return True
 
     def broadcast(self, cid, sids, trk):
         """
@@ -642,28 +1269,131 @@ class Controller:
             LOGGER.error("No trackID given")
             return None
 
-        client_sessions = self.client_sessions.get(cid)
         sessions = []
 
         for id in sids:
-            if id not in client_sessions:
-                LOGGER.error("Client " + str(cid) + " not in session " + str(id))
+            if not self.is_member(cid, id):
+                LOGGER.error("Client %s not in session %s", cid, id)
                 continue
 
             sess = self.sessions.get(id)
 
             if sess is None:
-                LOGGER.error("No session found for sessionID " + str(id))
+                LOGGER.error("No session found for sessionID %s", id)
                 continue
 
             if not sess.update_track(cid, trk):
-                LOGGER.error("Update track failed for client " + str(cid) + " session " + str(id) + " track " + str(tid))
+                LOGGER.error("Update track failed for client %s session %s track %s", cid, id, tid)
                 continue
 
+            self.record('tracks', id, [sess.tracks[tid].record()])
             sessions.append(sess)
 
         return sessions
 
+    def dump(self):
+        """
+        The controller's full state, for snapshots. Connections and timers aren't included.
+
+        Grids of the same shape are stacked into one array, which is far quicker to write and read
+        back than thousands of small ones.
+
+        :return: dict
+        """
+        grids = {}
+        sessions = [x.dump(grids) for x in self.sessions.values()]
+        return {
+            "clients": dict(self.clients),
+            "tokens": dict(self.tokens),
+            "sessions": sessions,
+            "grids": {shape: np.stack(same) for shape, same in grids.items()},
+            "session_ids": self.session_ids.dump()
+        }
+
+    def restore(self, state, records):
+        """
+        Rebuilds the state of a previous run from its latest snapshot and the journal records made
+        after it. Nothing is recorded while replaying.
+
+        :param state: dict as returned by dump(), or None
+        :param records: list of records, as passed to record()
+        :return: None
+        """
+        if state is not None:
+            self.clients = {sys.intern(cid): nick for cid, nick in state["clients"].items()}
+            self.client_sessions = {}
+            self.tokens = dict(state.get("tokens", {}))
+            for cid in self.clients:
+                self.tokens.setdefault(cid, secrets.token_urlsafe(RESUME_TOKEN_BYTES))
+            self.session_ids.restore(state["session_ids"])
+            for dumped in state["sessions"]:
+                sid = dumped["sessionID"]
+                sess = Session(sid, dumped.get("dimensions", (DEFAULT_TONES, DEFAULT_BEATS)), len(dumped["tracks"]))
+                sess.version = dumped["version"]
+                for cid, nick in dumped["clients"]:
+                    cid = sys.intern(cid)
+                    sess.clients[cid] = self.clients.get(cid, nick)
+                    self.client_sessions.setdefault(cid, set()).add(sid)
+                for trk in dumped["tracks"]:
+                    track = sess.tracks.get(trk["trackID"])
+                    if track is None:
+                        track = sess.tracks[trk["trackID"]] = Track(trk["trackID"])
+                    shape, index = trk["grid"]
+                    track.clientID = sys.intern(trk["clientID"])
+                    track.instrument = trk["instrument"]
+                    track.gridVersion = trk.get("gridVersion", 0)
+                    track.grid = state["grids"][shape][index]
+                    track.dimensions = tuple(shape)
+                    if track.clientID:
+                        sess.owned.setdefault(track.clientID, set()).add(track.trackID)
+                self.sessions[sid] = sess
+
+        journal, self.journal = self.journal, None
+        try:
+            for entry in records:
+                self.replay(entry)
+        finally:
+            self.journal = journal
+
+    def replay(self, entry):
+        """
+        Repeats a change of state recorded by record()
+
+        :param entry: list, the record
+        :return: None
+        """
+        kind, args = entry[0], entry[1:]
+        if kind == 'client':
+            self.new_client(args[1], args[0], *args[2:3])
+        elif kind == 'exit':
+            self.client_exit(*args)
+        elif kind == 'session':
+            sid = self.new_session(*args[1:])
+            if sid != args[0]:
+                LOGGER.error("Replayed session was created as %s instead of %s", sid, args[0])
+        elif kind == 'join':
+            self.client_join(*args)
+        elif kind == 'leave':
+            self.client_leave(*args)
+        elif kind == 'own':
+            self.request_track(*args)
+        elif kind == 'disown':
+            self.relinquish_track(*args)
+        elif kind == 'cells':
+            self.update_cells(*args)
+        elif kind == 'tracks':
+            sess = self.sessions.get(args[0])
+            if sess is not None:
+                tracks = []
+                for tid, instrument, grid in args[1]:
+                    track = sess.tracks[tid]
+                    track.instrument = instrument
+                    track.grid = np.array(grid, dtype=track.grid.dtype)
+                    tracks.append(track)
+                sess.touch(tracks)
+        else:
+            LOGGER.error("Unknown journal record %s", kind)
+
 
 
 
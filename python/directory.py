@@ -0,0 +1,110 @@
+"""
+Lunar Rocks Session Directory
+
+The Directory is the versioned list of sessions sent to clients. Changes to the list are collected
+over a short window and then published once, both as the whole list (msgID 105) and as the
+sessions added and removed since the previous version (msgID 117), so a burst of creates and
+disconnects costs one update rather than one per event.
+
+Each client chooses how it follows the directory: the whole list on every change (the default,
+and all that older clients understand), diffs only, or not at all.
+"""
+
+import asyncio
+import logging
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+MODE_LIST = 'list'          # whole list (msgID 105) on every change
+MODE_DIFF = 'diff'          # added and removed sessions (msgID 117) on every change
+MODE_NONE = 'none'          # no directory updates
+MODES = [MODE_LIST, MODE_DIFF, MODE_NONE]
+DEFAULT_WINDOW = 0.1        # seconds over which changes are merged into one update
+
+LOGGER = logging.getLogger('lunar.directory')
+
+class Directory:
+
+    def __init__(self, sessions, publish, window=DEFAULT_WINDOW):
+        self.sessions = sessions    # function returning the current sessionIDs
+        self.publish = publish      # coroutine function(version, sessionIDs, added, removed)
+        self.window = window        # Float, seconds
+        self.version = 0            # Int, incremented on every published change
+        self.listed = set()         # sessionIDs as of self.version
+        self.modes = {}             # clientID: one of MODES, for clients not following MODE_LIST
+        self.timer = None           # TimerHandle of the pending update, if any
+
+    def changed(self):
+        """
+        Notes that sessions may have been created or deleted; an update follows within the window
+
+        :return: None
+        """
+        if self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.window, self.fire)
+
+    def fire(self):
+        """
+        Publishes the changes made since the last version, if there were any
+        """
+        self.timer = None
+        current = set(self.sessions())
+        added = sorted(current - self.listed)
+        removed = sorted(self.listed - current)
+        if not added and not removed:
+            return
+
+        self.version += 1
+        self.listed = current
+        LOGGER.debug("Directory version %s: %s added, %s removed", self.version, len(added), len(removed))
+        asyncio.ensure_future(self.publish(self.version, sorted(current), added, removed))
+
+    def listing(self):
+        """
+        :return: (version, sorted list of sessionIDs) for a client starting to follow the directory
+        """
+        return self.version, sorted(self.listed)
+
+    def mode(self, cid):
+        return self.modes.get(cid, MODE_LIST)
+
+    def follow(self, cid, mode):
+        """
+        Sets how a client follows the directory
+
+        :param cid: clientID
+        :param mode: one of MODES
+        :return: None
+        """
+        if mode == MODE_LIST:
+            self.modes.pop(cid, None)
+        else:
+            self.modes[cid] = mode
+
+    def forget(self, cid):
+        self.modes.pop(cid, None)
+
+    def recipients(self, cids):
+        """
+        Sorts clients by the kind of update they follow
+
+        :param cids: iterable of clientIDs
+        :return: (clients following MODE_LIST, clients following MODE_DIFF)
+        """
+        if not self.modes:
+            return list(cids), []
+        lists, diffs = [], []
+        for cid in cids:
+            mode = self.modes.get(cid, MODE_LIST)
+            if mode == MODE_LIST:
+                lists.append(cid)
+            elif mode == MODE_DIFF:
+                diffs.append(cid)
+        return lists, diffs
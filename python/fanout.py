@@ -0,0 +1,238 @@
+"""
+Lunar Rocks Fan-out Engine
+
+The classes in this module decouple handlers from the websockets they send to. Every connection
+gets an Outbox: a bounded queue drained by its own writer task, so that a slow or stalled client
+only ever delays itself.
+"""
+
+import asyncio
+import collections
+import logging
+from websockets.exceptions import ConnectionClosed
+import compress
+import metrics
+import wire
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+POLICY_DROP = 'drop'                # drop the oldest stale snapshot when full, or else the oldest message
+POLICY_COALESCE = 'coalesce'        # overwrite queued snapshots in place, then drop
+POLICY_DISCONNECT = 'disconnect'    # close connections that fall behind
+POLICIES = [POLICY_DROP, POLICY_COALESCE, POLICY_DISCONNECT]
+
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_POLICY = POLICY_COALESCE
+CLOSE_CODE = 1013                   # "Try Again Later"
+ERROR_CODE = 1011                   # "Internal Error"
+
+LOGGER = logging.getLogger('lunar.fanout')
+
+DROPPED = metrics.REGISTRY.counter('lunar_outbox_dropped_total', "Stale messages dropped from full outboxes")
+COALESCED = metrics.REGISTRY.counter('lunar_outbox_coalesced_total', "Queued snapshots replaced by newer ones")
+SLOW_DISCONNECTS = metrics.REGISTRY.counter('lunar_slow_disconnects_total', "Connections closed for falling behind")
+
+class Outbox:
+
+    def __init__(self, sock, maxsize=DEFAULT_QUEUE_SIZE, policy=DEFAULT_POLICY):
+        self.sock = sock                    # websocket
+        self.maxsize = maxsize              # Int
+        self.policy = policy                # one of POLICIES
+        self.encoding = wire.ENCODING_JSON  # one of wire.ENCODINGS
+        self.deflate = compress.negotiated(sock)    # SharedDeflate, or None if the connection doesn't compress
+        self.queue = collections.deque()    # [key, msg] entries
+        self.keyed = {}                     # key: entry, for queued entries that may be replaced
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.dropped = 0                    # Int, messages discarded for this connection
+        self.task = asyncio.ensure_future(self.writer())
+
+    def push(self, msg, key=None):
+        """
+        Queues msg for delivery without waiting for the socket.
+
+        Messages sharing a key (e.g. snapshots of the same session) supersede one another: a newer
+        message makes any queued older one stale.
+
+        :param msg: a wire.Message, or an already serialized frame
+        :param key: hashable identifying what msg is a snapshot of, or None if it must not be dropped
+        :return: boolean - whether msg was queued
+        """
+        if self.closed:
+            return False
+
+        if isinstance(msg, wire.Message):
+            try:
+                frame = msg.frame(self.encoding)
+                if self.deflate is not None and msg.size(self.encoding) >= self.deflate.threshold:
+                    frame = msg.deflated(self.encoding, self.deflate.local_max_window_bits)
+            except Exception:
+                # Only this encoding of the message is affected; the rest of a broadcast goes ahead
+                LOGGER.exception("Could not encode msgID %s as %s for %s", msg.msgID, self.encoding,
+                                 self.sock.remote_address)
+                return False
+            msg = frame
+
+        old = self.keyed.get(key) if key is not None else None
+
+        if old is not None and self.policy == POLICY_COALESCE:
+            old[1] = msg
+            COALESCED.inc()
+            return True
+
+        if old is not None and self.policy == POLICY_DROP:
+            self.queue.remove(old)
+            self.dropped += 1
+            DROPPED.inc()
+
+        if len(self.queue) >= self.maxsize and not self.overflow():
+            return False
+
+        entry = [key, msg]
+        self.queue.append(entry)
+        if key is not None:
+            self.keyed[key] = entry
+        self.wakeup.set()
+        return True
+
+    def overflow(self):
+        """
+        Applies the slow-consumer policy to a full queue.
+
+        Under the drop and coalesce policies a snapshot is dropped if one is queued, since a newer
+        one will follow. Otherwise the oldest message goes: most are cell updates, and a client that
+        misses one sees the gap in versions and catches up with a msgID 116.
+
+        :return: boolean - whether room was made for another message
+        """
+        if self.policy != POLICY_DISCONNECT:
+            for entry in self.queue:
+                if entry[0] is not None:
+                    self.queue.remove(entry)
+                    del self.keyed[entry[0]]
+                    break
+            else:
+                self.queue.popleft()
+            self.dropped += 1
+            DROPPED.inc()
+            return True
+
+        LOGGER.info("Outbox for %s is full; disconnecting slow client", self.sock.remote_address)
+        SLOW_DISCONNECTS.inc()
+        self.close()
+        asyncio.ensure_future(self.sock.close(code=CLOSE_CODE, reason="client too slow"))
+        return False
+
+    async def writer(self):
+        """
+        Drains the queue onto the socket, one message at a time.
+        """
+        try:
+            while True:
+                while not self.queue:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                key, msg = entry = self.queue.popleft()
+                if key is not None and self.keyed.get(key) is entry:
+                    del self.keyed[key]
+                if isinstance(msg, compress.Deflated):
+                    await self.sock.send_deflated(msg)
+                else:
+                    await self.sock.send(msg)
+        except ConnectionClosed:
+            LOGGER.debug("Outbox writer stopped by closed connection at %s", self.sock.remote_address)
+            self.closed = True
+        except Exception:
+            # Nothing more can be sent, so the client is better off reconnecting than left waiting
+            LOGGER.exception("Outbox writer for %s failed; closing the connection", self.sock.remote_address)
+            self.close()
+            asyncio.ensure_future(self.sock.close(code=ERROR_CODE, reason="server error"))
+
+    def close(self):
+        """
+        Discards queued messages and stops accepting new ones.
+        """
+        self.closed = True
+        self.queue.clear()
+        self.keyed.clear()
+
+class FanOut:
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, policy=DEFAULT_POLICY):
+        self.maxsize = maxsize      # Int
+        self.policy = policy        # one of POLICIES
+        self.outboxes = {}          # websocket: Outbox
+
+    def register(self, sock):
+        """
+        Starts a writer for a new connection
+
+        :param sock: a websocket object
+        :return: the connection's Outbox
+        """
+        outbox = self.outboxes.get(sock)
+        if outbox is None:
+            outbox = Outbox(sock, self.maxsize, self.policy)
+            self.outboxes[sock] = outbox
+        return outbox
+
+    def unregister(self, sock):
+        """
+        Stops the writer of a closed connection
+
+        :param sock: a websocket object
+        :return: None
+        """
+        outbox = self.outboxes.pop(sock, None)
+        if outbox is not None:
+            outbox.close()
+            outbox.task.cancel()
+
+    def set_encoding(self, sock, encoding):
+        """
+        Switches the encoding of messages sent on a connection from now on
+
+        :param sock: a websocket object
+        :param encoding: one of wire.ENCODINGS
+        :return: None
+        """
+        outbox = self.outboxes.get(sock)
+        if outbox is not None:
+            outbox.encoding = encoding
+
+    def send(self, sock, msg, key=None):
+        """
+        Queues msg on a single connection
+
+        :param sock: a websocket object
+        :param msg: a wire.Message, or an already serialized frame
+        :param key: see Outbox.push()
+        :return: boolean - whether msg was queued
+        """
+        outbox = self.outboxes.get(sock)
+        if outbox is None:
+            LOGGER.debug("No outbox registered for socket; message not sent")
+            return False
+        return outbox.push(msg, key)
+
+    def broadcast(self, socks, msg, key=None):
+        """
+        Queues msg on every connection in socks
+
+        :param socks: an iterable of websocket objects
+        :param msg: a wire.Message, or an already serialized frame
+        :param key: see Outbox.push()
+        :return: Int - how many connections msg was queued on
+        """
+        sent = 0
+        for sock in socks:
+            if self.send(sock, msg, key):
+                sent += 1
+        return sent
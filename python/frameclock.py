@@ -0,0 +1,128 @@
+"""
+Lunar Rocks Frame Clock
+
+The FrameClock merges the changes made to a session within one tick, so that a session sends at most
+one update per tick however many of its clients are editing.
+
+Clients that only listen to a session are sent its updates by a second FrameClock with a longer tick,
+so they get the session's latest state a few times a second rather than every version of it.
+"""
+
+import asyncio
+import logging
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+DEFAULT_TICK = 0            # seconds; 0 sends every update immediately
+DEFAULT_OBSERVER_TICK = 0.25    # seconds between updates to clients that own no track; 0 sends them every update
+
+LOGGER = logging.getLogger('lunar.frameclock')
+
+class Frame:
+
+    def __init__(self, sess, base):
+        self.sess = sess            # Session
+        self.base = base            # Int, version the first change in the frame was applied to
+        self.full = False           # Boolean, whether a full snapshot is needed
+        self.cells = {}             # (trackID, tone, beat): value
+
+class FrameClock:
+
+    def __init__(self, publish, tick=DEFAULT_TICK):
+        self.publish = publish      # coroutine function(sess, base, cells, skip), cells None for a snapshot
+                                    # and skip a set of clientIDs that already have the session's state
+        self.tick = tick            # Float, seconds
+        self.frames = {}            # sessionID: Frame
+        self.current = {}           # sessionID: {clientID: version sent to it outside the clock}
+
+    async def snapshot(self, sess):
+        """
+        Schedules a full snapshot of sess
+
+        :param sess: a Session object that changed
+        :return: None
+        """
+        if not self.tick:
+            await self.publish(sess, None, None, ())
+            return
+
+        self.frame(sess, sess.version).full = True
+
+    async def cells(self, sess, base, cells):
+        """
+        Schedules a cell update of sess; cells changed again within the tick are sent once
+
+        :param sess: a Session object that changed
+        :param base: the version cells were applied to
+        :param cells: list of [trackID, tone, beat, value] lists
+        :return: None
+        """
+        if not self.tick:
+            await self.publish(sess, base, cells, ())
+            return
+
+        frame = self.frame(sess, base)
+        for tid, tone, beat, value in cells:
+            frame.cells[(tid, tone, beat)] = value
+
+    def sent(self, sess, cid):
+        """
+        Notes that a client has just been sent the current version of sess some other way, so the
+        next update the clock sends is skipped for it if the session hasn't changed since
+
+        :param sess: a Session object
+        :param cid: clientID
+        :return: None
+        """
+        if self.tick:
+            self.current.setdefault(sess.sessionID, {})[cid] = sess.version
+
+    def frame(self, sess, base):
+        """
+        Finds the pending frame of sess, starting a new one (and its timer) if there is none
+
+        :return: Frame
+        """
+        frame = self.frames.get(sess.sessionID)
+        if frame is None:
+            frame = Frame(sess, base)
+            self.frames[sess.sessionID] = frame
+            asyncio.get_event_loop().call_later(self.tick, self.fire, sess.sessionID)
+        return frame
+
+    def fire(self, sid):
+        """
+        Sends the merged update for a session at the end of its tick
+        """
+        frame = self.frames.pop(sid, None)
+        current = self.current.pop(sid, {})
+        if frame is None:
+            return
+        skip = {cid for cid, version in current.items() if version == frame.sess.version}
+
+        if frame.full:
+            LOGGER.debug("Frame clock sending snapshot of session %s", sid)
+            task = asyncio.ensure_future(self.publish(frame.sess, None, None, skip))
+        else:
+            cells = [[tid, tone, beat, value] for (tid, tone, beat), value in frame.cells.items()]
+            LOGGER.debug("Frame clock sending %s cells of session %s", len(cells), sid)
+            task = asyncio.ensure_future(self.publish(frame.sess, frame.base, cells, skip))
+        task.add_done_callback(lambda t: self.published(t, sid))
+
+    def published(self, task, sid):
+        """
+        Logs a failed publish, which would otherwise only surface when the task is collected
+        """
+        if task.cancelled():
+            return
+        try:
+            task.result()
+        except Exception:
+            LOGGER.exception("Frame clock could not publish the update of session %s", sid)
@@ -0,0 +1,80 @@
+"""
+Lunar Rocks Heartbeat Service
+
+The Heartbeat pings every open connection on a schedule, keeps track of how long pongs take to come
+back, and evicts connections that stop answering, so that request handlers never have to check
+whether the other clients in a session are still alive.
+"""
+
+import asyncio
+import logging
+from websockets.exceptions import ConnectionClosed
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+DEFAULT_INTERVAL = 15       # seconds between pings
+DEFAULT_TIMEOUT = 10        # seconds to wait for a pong
+
+LOGGER = logging.getLogger('lunar.heartbeat')
+
+class Heartbeat:
+
+    def __init__(self, connections, evict, interval=DEFAULT_INTERVAL, timeout=DEFAULT_TIMEOUT):
+        self.connections = connections  # function returning the websockets to ping
+        self.evict = evict              # function(websocket) called for connections that don't answer
+        self.interval = interval        # Float, seconds
+        self.timeout = timeout          # Float, seconds
+        self.latency = {}               # websocket: round trip time of the last pong, in seconds
+        self.pending = set()            # websockets pinged whose pong or timeout hasn't come yet
+
+    async def run(self):
+        """
+        Pings all connections once per interval, forever. Each ping waits for its pong on its own,
+        so slow connections delay neither the next beat nor anyone else's ping; a connection still
+        waiting for a pong when the next beat comes is skipped until it answers or times out.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time()
+        while True:
+            deadline += self.interval
+            await asyncio.sleep(max(0, deadline - loop.time()))
+            socks = list(self.connections())
+            for gone in set(self.latency) - set(socks):
+                del self.latency[gone]
+            for sock in socks:
+                if sock not in self.pending:
+                    self.pending.add(sock)
+                    asyncio.ensure_future(self.beat(sock))
+
+    async def beat(self, sock):
+        """
+        Pings one connection and waits for its pong
+
+        :param sock: a websocket object
+        :return: None
+        """
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        try:
+            pong = await sock.ping()
+            await asyncio.wait_for(pong, self.timeout)
+        except ConnectionClosed:
+            # The connection's own handler cleans up after closed connections
+            self.latency.pop(sock, None)
+            return
+        except asyncio.TimeoutError:
+            LOGGER.info("No pong from %s within %ss; evicting", sock.remote_address, self.timeout)
+            self.latency.pop(sock, None)
+            self.evict(sock)
+            return
+        finally:
+            self.pending.discard(sock)
+
+        self.latency[sock] = loop.time() - start
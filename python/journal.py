@@ -0,0 +1,165 @@
+"""
+Lunar Rocks Journal
+
+Keeps the controller's state on disk so that a restarted server picks up where the last one left
+off. Every change of state is appended to a journal as one line of JSON; every so often the whole
+state is written as a snapshot and the journal is started afresh. On startup the state is rebuilt
+from the latest snapshot plus whatever the journal recorded after it.
+
+Records are encoded on the event loop, where the state they describe is consistent, but written,
+fsync'd and compacted in batches by a single background thread, in the order they were made.
+"""
+
+import asyncio
+import codec
+import concurrent.futures
+import logging
+import os
+import pickle
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+JOURNAL_NAME = "journal.log"
+SNAPSHOT_NAME = "snapshot.pickle"
+DEFAULT_INTERVAL = 0.05         # seconds records may wait before being written
+DEFAULT_COMPACT_EVERY = 100000  # records between snapshots
+
+LOGGER = logging.getLogger('lunar.journal')
+
+class Journal:
+
+    def __init__(self, directory, dump, interval=DEFAULT_INTERVAL, compact_every=DEFAULT_COMPACT_EVERY):
+        self.directory = directory          # String
+        self.dump = dump                    # function returning the state to snapshot
+        self.interval = interval            # Float, seconds
+        self.compact_every = compact_every  # Int, records
+        self.seq = 0                        # Int, sequence number of the last record
+        self.since_snapshot = 0             # Int, records appended since the last snapshot
+        self.pending = []                   # encoded records not yet handed to the writer
+        self.flushing = None                # TimerHandle of the next flush, if one is scheduled
+        self.file = None                    # the journal file, used only by the writer thread
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load(self):
+        """
+        Reads what a previous server left behind
+
+        :return: (state from the latest snapshot or None, list of journal records made after it)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        state, self.seq = None, 0
+        try:
+            with open(self.path(SNAPSHOT_NAME), 'rb') as f:
+                self.seq, state = pickle.load(f)
+        except FileNotFoundError:
+            pass
+
+        records = []
+        try:
+            with open(self.path(JOURNAL_NAME), 'rb') as f:
+                for line in f:
+                    try:
+                        record = codec.loads(line)
+                    except ValueError:
+                        # The last write before a crash may be incomplete
+                        LOGGER.error("Ignoring unreadable journal record: %r", line)
+                        break
+                    if record[0] > self.seq:
+                        records.append(record[1:])
+                        self.seq = record[0]
+        except FileNotFoundError:
+            pass
+
+        self.since_snapshot = len(records)
+        self.file = open(self.path(JOURNAL_NAME), 'ab')
+        LOGGER.info("Loaded %s snapshot and %s journal records", "a" if state else "no", len(records))
+        return state, records
+
+    def append(self, record):
+        """
+        Adds a record to the journal; it is written within the flush interval
+
+        :param record: json-serializable list
+        :return: None
+        """
+        self.seq += 1
+        self.since_snapshot += 1
+        self.pending.append(codec.dumps([self.seq] + record) + b'\n')
+        if self.flushing is None:
+            self.flushing = asyncio.get_event_loop().call_later(self.interval, self.flush)
+
+    def flush(self):
+        """
+        Hands the pending records to the writer thread, taking a snapshot too if one is due
+
+        :return: Future of the write
+        """
+        if self.flushing is not None:
+            self.flushing.cancel()
+            self.flushing = None
+        batch, self.pending = self.pending, []
+        done = asyncio.get_event_loop().run_in_executor(self.writer, self.write, batch)
+        if self.since_snapshot >= self.compact_every:
+            done = self.snapshot()
+        return done
+
+    def snapshot(self):
+        """
+        Writes the whole state out and starts a new journal after it
+
+        :return: Future of the write
+        """
+        if self.pending:
+            self.flush()
+        self.since_snapshot = 0
+        return asyncio.get_event_loop().run_in_executor(self.writer, self.write_snapshot, self.seq, self.dump())
+
+    def write(self, batch):
+        """
+        Appends records to the journal file; runs on the writer thread
+        """
+        if not batch:
+            return
+        self.file.write(b''.join(batch))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def write_snapshot(self, seq, state):
+        """
+        Replaces the snapshot and empties the journal; runs on the writer thread
+
+        :param seq: sequence number of the last record reflected in state
+        :param state: the controller's state
+        """
+        tmp = self.path(SNAPSHOT_NAME + '.tmp')
+        with open(tmp, 'wb') as f:
+            pickle.dump((seq, state), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path(SNAPSHOT_NAME))
+
+        # Everything in the journal so far is in the snapshot; the writer thread is the only one
+        # that touches the file, so nothing newer can have been written yet
+        self.file.close()
+        self.file = open(self.path(JOURNAL_NAME), 'wb')
+        LOGGER.debug("Snapshot written at record %s", seq)
+
+    def close(self):
+        """
+        Writes out everything still pending and stops the writer thread
+        """
+        self.flush()
+        self.writer.shutdown(wait=True)
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,434 @@
+"""
+Lunar Rocks Load Generator
+
+Starts a server locally (or targets a running one), connects a crowd of synthetic clients, and has
+them edit their sessions at a steady rate. Reports throughput and the end-to-end fan-out latency of
+each kind of edit -- the time from a client sending it to another client in the session seeing it --
+and saves the results as JSON so runs can be compared.
+
+Every edit carries a marker the receivers can recognize: msgID 100 and 108 edits set the track's
+instrument to a unique token, and msgID 115 edits flip a single cell. Each receiver records the
+first time it sees each marker; markers that never arrive (e.g. because a newer snapshot superseded
+them) are counted as superseded.
+
+Example:
+
+    python loadgen.py --clients 200 --session-size 4 --rate 5 --duration 30 --mix 115=8,100=1,108=1
+
+Python >= 3.5 required.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import numpy as np
+import websockets
+from websockets.exceptions import ConnectionClosed
+import wire
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+DEFAULT_PORT = 8796
+DEFAULT_CLIENTS = 20
+DEFAULT_SESSION_SIZE = 4
+DEFAULT_RATE = 5.0          # edits per second per track owner
+DEFAULT_DURATION = 10.0     # seconds
+DEFAULT_MIX = "115=8,100=1,108=1"
+EDIT_MSG_IDS = (100, 108, 115)
+TOKEN_PREFIX = "bench:"
+SETUP_TIMEOUT = 10          # seconds to wait for each reply while setting up
+DRAIN_TIME = 2              # seconds to keep listening after the last edit
+PERCENTILES = (50, 95, 99)
+
+class Stats:
+
+    def __init__(self):
+        self.sent = {mid: 0 for mid in EDIT_MSG_IDS}          # msgID: edits sent
+        self.marked = {mid: 0 for mid in EDIT_MSG_IDS}        # msgID: deliveries expected
+        self.latency = {mid: [] for mid in EDIT_MSG_IDS}      # msgID: [seconds]
+        self.received = {}                                    # msgID: messages received
+        self.bytes_received = 0                               # Int
+        self.errors = 0                                       # Int, msgID 114 replies
+        self.disconnects = 0                                  # Int, connections closed by the server
+        self.pending = {}                                     # marker: (msgID, send time)
+
+    def mark(self, marker, mid, receivers):
+        """
+        Records the sending of an edit that receivers other clients should see
+
+        :param marker: hashable identifying the edit
+        :param mid: msgID of the edit
+        :param receivers: Int, how many clients should see it
+        :return: None
+        """
+        self.sent[mid] += 1
+        self.marked[mid] += receivers
+        self.pending[marker] = (mid, time.perf_counter())
+
+    def seen(self, marker):
+        """
+        Records a client seeing an edit for the first time
+
+        :return: None
+        """
+        sent = self.pending.get(marker)
+        if sent is not None:
+            mid, start = sent
+            self.latency[mid].append(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        """
+        :param elapsed: seconds the edits were sent over
+        :return: json-serializable dict
+        """
+        types = {}
+        for mid in EDIT_MSG_IDS:
+            samples = np.array(self.latency[mid]) * 1000
+            entry = {
+                "sent": self.sent[mid],
+                "sent_per_sec": self.sent[mid] / elapsed,
+                "deliveries": len(samples),
+                "superseded": max(0, self.marked[mid] - len(samples))
+            }
+            if len(samples):
+                entry["latency_ms"] = {"p" + str(p): float(np.percentile(samples, p)) for p in PERCENTILES}
+                entry["latency_ms"]["mean"] = float(samples.mean())
+                entry["latency_ms"]["max"] = float(samples.max())
+            types[str(mid)] = entry
+
+        received = sum(self.received.values())
+        return {
+            "elapsed": elapsed,
+            "sent_per_sec": sum(self.sent.values()) / elapsed,
+            "received_per_sec": received / elapsed,
+            "received_bytes_per_sec": self.bytes_received / elapsed,
+            "received": {str(mid): n for mid, n in sorted(self.received.items())},
+            "errors": self.errors,
+            "disconnects": self.disconnects,
+            "types": types
+        }
+
+class Client:
+
+    def __init__(self, num, url, encoding, stats):
+        self.num = num              # Int
+        self.url = url              # String
+        self.encoding = encoding    # one of wire.ENCODINGS
+        self.stats = stats          # Stats
+        self.sock = None            # websocket
+        self.cid = None             # UUID String
+        self.sid = None             # Int, the session joined
+        self.tid = None             # Int, the track owned, or None for listeners
+        self.grid = None            # list of lists, the owned track's grid
+        self.others = 0             # Int, clients in the session besides this one
+        self.board = None           # list of track dicts, as of joining the session
+        self.replies = {}           # msgID: Future, replies awaited during setup
+        self.last = {}              # (sessionID, trackID) or cell: newest marker seen
+        self.reader = None          # Task
+
+    async def connect(self):
+        self.sock = await websockets.connect(self.url, max_size=None)
+        self.reader = asyncio.ensure_future(self.read())
+        offered = [self.encoding]
+        self.encoding = wire.ENCODING_JSON
+        reply = await self.request(112, {'nickname': "bench" + str(self.num), 'encodings': offered}, 113)
+        self.cid = reply['clientID']
+        self.encoding = reply.get('encoding', wire.ENCODING_JSON)
+
+    async def create(self):
+        reply = await self.request(101, {}, 102)
+        return reply['session']['sessionID']
+
+    async def join(self, sid, others):
+        self.sid = sid
+        self.others = others
+        reply = await self.request(103, {'sessionID': sid}, 100)
+        self.board = reply['session']['board']
+
+    async def own(self, tid):
+        reply = await self.request(109, {'sessionID': self.sid, 'trackID': tid}, 111)
+        if not reply.get('status'):
+            return False
+        for trk in self.board:
+            if trk['trackID'] == tid:
+                self.grid = np.asarray(trk['grid']).tolist()
+        self.tid = tid
+        return True
+
+    async def request(self, mid, payload, reply):
+        """
+        Sends a message and waits for the reply of type reply
+
+        :return: the reply's payload
+        """
+        future = asyncio.get_event_loop().create_future()
+        self.replies[reply] = future
+        await self.send(mid, payload)
+        return await asyncio.wait_for(future, SETUP_TIMEOUT)
+
+    async def send(self, mid, payload):
+        await self.sock.send(wire.Message(self.cid or '', mid, payload).frame(self.encoding))
+
+    async def edit(self, mid, seq):
+        """
+        Sends one edit of the owned track
+
+        :param mid: one of EDIT_MSG_IDS
+        :param seq: Int, unique among the edits sent by all clients
+        :return: None
+        """
+        tones, beats = len(self.grid), len(self.grid[0])
+        cell = seq % (tones * beats)
+        tone, beat = cell // beats, cell % beats
+        value = 1 - self.grid[tone][beat]
+        self.grid[tone][beat] = value
+
+        if mid == 115:
+            marker = (self.sid, self.tid, tone, beat, value)
+            self.stats.mark(marker, mid, self.others)
+            await self.send(115, {'sessionID': self.sid, 'cells': [[self.tid, tone, beat, value]]})
+            return
+
+        token = TOKEN_PREFIX + str(seq)
+        track = {'trackID': self.tid, 'grid': self.grid, 'instrument': token}
+        self.stats.mark(token, mid, self.others)
+        if mid == 100:
+            await self.send(100, {'session': {'sessionID': self.sid, 'board': [track]}})
+        else:
+            await self.send(108, {'sessionIDs': [self.sid], 'track': track})
+
+    async def read(self):
+        """
+        Receives messages until the connection closes, noting the markers they carry
+        """
+        try:
+            async for frame in self.sock:
+                self.stats.bytes_received += len(frame)
+                msg = wire.decode(frame)
+                mid = msg['messageID']
+                payload = msg['payload']
+                self.stats.received[mid] = self.stats.received.get(mid, 0) + 1
+
+                future = self.replies.pop(mid, None)
+                if future is not None and not future.done():
+                    future.set_result(payload)
+                elif mid == 114:
+                    self.stats.errors += 1
+                elif mid == 100:
+                    self.snapshot(payload['session'])
+                elif mid == 115:
+                    self.cells(payload)
+        except ConnectionClosed:
+            pass
+        if self.sock.close_code not in (1000, 1001):
+            self.stats.disconnects += 1
+
+    def snapshot(self, sess):
+        for trk in sess['board']:
+            if trk['trackID'] == self.tid:
+                continue
+            token = trk.get('instrument', '')
+            if token.startswith(TOKEN_PREFIX):
+                key = (sess['sessionID'], trk['trackID'])
+                if self.last.get(key) != token:
+                    self.last[key] = token
+                    self.stats.seen(token)
+
+    def cells(self, payload):
+        sid = payload['sessionID']
+        for tid, tone, beat, value in payload['cells']:
+            if tid == self.tid:
+                continue
+            marker = (sid, tid, tone, beat, value)
+            if self.last.get(marker[:4]) != value:
+                self.last[marker[:4]] = value
+                self.stats.seen(marker)
+
+    async def close(self):
+        await self.sock.close()
+        await self.reader
+
+def parse_mix(spec):
+    """
+    :param spec: String of the form "115=8,100=1,108=1"
+    :return: (msgIDs, weights)
+    """
+    mids, weights = [], []
+    for item in spec.split(','):
+        mid, _, weight = item.partition('=')
+        mid = int(mid)
+        if mid not in EDIT_MSG_IDS:
+            raise argparse.ArgumentTypeError("Edits must be one of " + str(EDIT_MSG_IDS))
+        mids.append(mid)
+        weights.append(float(weight or 1))
+    return mids, weights
+
+async def setup(args, url, stats):
+    """
+    Connects every client and arranges them into sessions
+
+    :return: (all clients, track owners)
+    """
+    clients = [Client(n, url, args.encoding, stats) for n in range(args.clients)]
+    for start in range(0, len(clients), args.connect_batch):
+        await asyncio.gather(*[c.connect() for c in clients[start:start + args.connect_batch]])
+
+    owners = []
+    for start in range(0, len(clients), args.session_size):
+        group = clients[start:start + args.session_size]
+        sid = await group[0].create()
+        await asyncio.gather(*[c.join(sid, len(group) - 1) for c in group])
+        for tid, client in enumerate(group[:args.owners]):
+            if await client.own(tid):
+                owners.append(client)
+    return clients, owners
+
+async def drive(args, owners, stats):
+    """
+    Has every owner send edits at args.rate per second for args.duration seconds
+
+    :return: seconds taken
+    """
+    mids, weights = args.mix
+    rng = random.Random(args.seed)
+    counter = iter(range(sys.maxsize))
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    end = start + args.duration
+
+    async def editor(client, offset):
+        due = start + offset
+        while due < end:
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await client.edit(weighted(rng, mids, weights), next(counter))
+            except ConnectionClosed:
+                return
+            due += 1 / args.rate
+
+    await asyncio.gather(*[editor(c, rng.random() / args.rate) for c in owners])
+    return loop.time() - start
+
+def weighted(rng, items, weights):
+    """
+    Picks one of items, with probability proportional to its weight
+    """
+    pick = rng.random() * sum(weights)
+    for item, weight in zip(items, weights):
+        pick -= weight
+        if pick < 0:
+            return item
+    return items[-1]
+
+def start_server(args):
+    """
+    Runs server.py in a subprocess and waits for it to accept connections
+
+    :return: Popen
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, os.path.join(here, 'server.py'), '-p', str(args.port)] + args.server_args
+    proc = subprocess.Popen(cmd, cwd=here)
+
+    async def ready():
+        for _ in range(50):
+            try:
+                sock = await websockets.connect('ws://localhost:' + str(args.port))
+                await sock.close()
+                return
+            except OSError:
+                await asyncio.sleep(0.1)
+        raise RuntimeError("server did not start on port " + str(args.port))
+
+    asyncio.get_event_loop().run_until_complete(ready())
+    return proc
+
+async def bench(args, url):
+    stats = Stats()
+    clients, owners = await setup(args, url, stats)
+    print("{} clients connected, {} in {} sessions own a track".format(
+        len(clients), len(owners), -(-len(clients) // args.session_size)))
+    elapsed = await drive(args, owners, stats)
+    await asyncio.sleep(DRAIN_TIME)
+    await asyncio.gather(*[c.close() for c in clients])
+    return stats.report(elapsed)
+
+def show(results):
+    print("{:>5} {:>8} {:>9} {:>10} {:>10} {:>9} {:>9} {:>9}".format(
+        "msgID", "sent", "sent/s", "delivered", "superseded", "p50 ms", "p95 ms", "p99 ms"))
+    for mid, entry in results["types"].items():
+        lat = entry.get("latency_ms", {})
+        print("{:>5} {:>8} {:>9.1f} {:>10} {:>10} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            mid, entry["sent"], entry["sent_per_sec"], entry["deliveries"], entry["superseded"],
+            lat.get("p50", float('nan')), lat.get("p95", float('nan')), lat.get("p99", float('nan'))))
+    print("received {:.1f} msgs/s ({:.1f} KiB/s), {} errors, {} disconnects".format(
+        results["received_per_sec"], results["received_bytes_per_sec"] / 1024,
+        results["errors"], results["disconnects"]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test the websocket server")
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, help='Port to start the server on')
+    parser.add_argument('--url', help='Benchmark an already running server instead of starting one')
+    parser.add_argument('-c', '--clients', type=int, default=DEFAULT_CLIENTS, help='Number of clients')
+    parser.add_argument('-s', '--session-size', type=int, default=DEFAULT_SESSION_SIZE,
+                        help='Clients per session')
+    parser.add_argument('--owners', type=int, default=2,
+                        help='Clients per session that own a track and send edits; the rest only listen')
+    parser.add_argument('-r', '--rate', type=float, default=DEFAULT_RATE, help='Edits per second per owner')
+    parser.add_argument('-d', '--duration', type=float, default=DEFAULT_DURATION, help='Seconds to send edits for')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help='Relative weights of the edit msgIDs, e.g. 115=8,100=1,108=1')
+    parser.add_argument('-e', '--encoding', choices=wire.ENCODINGS, default=wire.ENCODING_JSON,
+                        help='Encoding the clients negotiate')
+    parser.add_argument('--connect-batch', type=int, default=50, help='Clients connected at a time')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the edit schedule')
+    parser.add_argument('-o', '--output', help='File to save the results to (default: loadgen-<time>.json)')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help='Arguments after -- are passed on to server.py')
+    args = parser.parse_args()
+    if args.server_args[:1] == ['--']:
+        args.server_args = args.server_args[1:]
+
+    proc = None
+    url = args.url
+    if url is None:
+        proc = start_server(args)
+        url = 'ws://localhost:' + str(args.port)
+    try:
+        results = asyncio.get_event_loop().run_until_complete(bench(args, url))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    results["config"] = {
+        "url": url,
+        "clients": args.clients,
+        "session_size": args.session_size,
+        "owners": args.owners,
+        "rate": args.rate,
+        "duration": args.duration,
+        "mix": dict(zip(map(str, args.mix[0]), args.mix[1])),
+        "encoding": args.encoding,
+        "server_args": args.server_args,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+    show(results)
+    output = args.output or time.strftime("loadgen-%Y%m%d-%H%M%S.json")
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("results saved to " + output)
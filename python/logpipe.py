@@ -0,0 +1,105 @@
+"""
+Lunar Rocks Logging
+
+Every module logs to a child of the 'lunar' logger (lunar.server, lunar.controller, ...), so that
+each subsystem's level can be set on its own. Records are handed to a queue on the event loop and
+written to the log file by a listener thread, which keeps file I/O and rotation off the loop.
+"""
+
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+ROOT = 'lunar'
+LOG_NAME = "server.log"
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+DEFAULT_LEVEL = logging.INFO
+EXC_FORMATTER = logging.Formatter()
+
+class LoopQueueHandler(QueueHandler):
+    """
+    Renders the message of a record before queueing it, since its arguments may have changed by
+    the time the listener thread gets to it. Records below the logger's level never get this far.
+    """
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        msg = record.getMessage()
+        if record.exc_info:
+            msg = msg + '\n' + EXC_FORMATTER.formatException(record.exc_info)
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+class Sample(logging.Filter):
+    """
+    Lets through one in every `every` records, for loggers too chatty to keep in full
+    """
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, every)  # Int
+        self.seen = 0               # Int, records offered so far
+
+    def filter(self, record):
+        self.seen += 1
+        return (self.seen - 1) % self.every == 0
+
+def parse_levels(spec):
+    """
+    Parses per-subsystem settings given on the command line
+
+    :param spec: String of the form "name=value,name=value", or None
+    :return: dict of name: value Strings
+    """
+    settings = {}
+    if not spec:
+        return settings
+    for item in spec.split(','):
+        name, sep, value = item.partition('=')
+        if not sep or not name.strip():
+            raise ValueError("Expected name=value, got " + repr(item))
+        settings[name.strip()] = value.strip()
+    return settings
+
+def configure(filename=LOG_NAME, level=DEFAULT_LEVEL, levels=None, sample=None):
+    """
+    Sets up the 'lunar' loggers and starts the thread that writes them to filename
+
+    :param filename: path of the log file
+    :param level: level of the 'lunar' logger, inherited by subsystems without their own
+    :param levels: dict of subsystem name (e.g. 'controller'): level
+    :param sample: dict of subsystem name (e.g. 'traffic'): Int, keep one record in that many
+    :return: the running QueueListener; call stop() on it to flush the log at exit
+    """
+    file_handler = RotatingFileHandler(filename, mode='w+', maxBytes=1000000, backupCount=2)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    records = queue.Queue()
+    listener = QueueListener(records, file_handler)
+
+    root = logging.getLogger(ROOT)
+    root.setLevel(level)
+    root.propagate = False
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(LoopQueueHandler(records))
+
+    for name, lvl in (levels or {}).items():
+        logging.getLogger(ROOT + '.' + name).setLevel(lvl)
+    for name, every in (sample or {}).items():
+        logging.getLogger(ROOT + '.' + name).addFilter(Sample(int(every)))
+
+    listener.start()
+    return listener
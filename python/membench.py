@@ -0,0 +1,105 @@
+"""
+Lunar Rocks Memory Benchmark
+
+Builds the controller's state for a crowd of connected clients and idle sessions in-process, without
+a network, and reports the memory it takes per client and per session, as traced by tracemalloc.
+Each session is joined by one client and has one track owned; nothing is edited. The websockets
+library's own per-connection buffers are not included, and neither are the journal or the outboxes.
+
+Example:
+
+    python membench.py --clients 100000 --sessions 100000 -o after.json
+
+Python >= 3.5 required.
+"""
+
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+import controller
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+DEFAULT_CLIENTS = 100000
+DEFAULT_SESSIONS = 100000
+
+class Connection:
+    """
+    Stands in for a websocket; the controller only keeps a reference to it
+    """
+
+    __slots__ = ('open',)
+
+    def __init__(self):
+        self.open = True
+
+def traced():
+    """
+    :return: bytes currently allocated, after a full collection
+    """
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+def measure(nclients, nsessions):
+    """
+    :param nclients: Int, clients to connect
+    :param nsessions: Int, sessions to create; each is joined by one of the clients
+    :return: json-serializable dict
+    """
+    ctrl = controller.Controller(max_sess_id=max(nsessions, controller.MIN_SESS_ID))
+    tracemalloc.start()
+
+    start = time.perf_counter()
+    base = traced()
+    cids = []
+    for num in range(nclients):
+        cid = ctrl.new_client("client{}".format(num))
+        ctrl.log_socket(cid, Connection())
+        cids.append(cid)
+    # The list of clientIDs is the benchmark's, not the controller's
+    clients = traced() - base - sys.getsizeof(cids)
+
+    base = traced()
+    for num in range(nsessions):
+        sid = ctrl.new_session()
+        cid = cids[num % len(cids)] if cids else ctrl.new_client("owner")
+        ctrl.client_join(cid, sid)
+        ctrl.request_track(cid, sid, 0)
+    sessions = traced() - base
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+
+    return {
+        "clients": nclients,
+        "sessions": nsessions,
+        "bytes_per_client": clients / nclients if nclients else None,
+        "bytes_per_session": sessions / nsessions if nsessions else None,
+        "total_mib": (clients + sessions) / 2 ** 20,
+        "seconds": elapsed
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the memory taken by idle clients and sessions")
+    parser.add_argument('--clients', type=int, default=DEFAULT_CLIENTS, help='Connected clients to create')
+    parser.add_argument('--sessions', type=int, default=DEFAULT_SESSIONS, help='Idle sessions to create')
+    parser.add_argument('-o', '--output', help='File to save the results to as JSON')
+    args = parser.parse_args()
+
+    results = measure(args.clients, args.sessions)
+    print("{clients} clients: {bytes_per_client:.0f} bytes each".format(**results))
+    print("{sessions} sessions: {bytes_per_session:.0f} bytes each".format(**results))
+    print("{total_mib:.1f} MiB in all, built in {seconds:.1f} s".format(**results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("results saved to", args.output)
@@ -0,0 +1,192 @@
+"""
+Lunar Rocks Metrics
+
+A small metrics registry: counters, gauges and histograms, labelled by a fixed tuple of label names
+and rendered in the Prometheus text exposition format by a minimal HTTP endpoint.
+
+Recording an event costs a dict lookup and an addition (plus a bisect for histograms) and never
+allocates a string; everything else happens when the endpoint is scraped. Gauges that mirror server
+state (e.g. the number of sessions) are read from callbacks at scrape time rather than kept up to date.
+"""
+
+import asyncio
+import bisect
+import logging
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+# seconds; handler and broadcast latencies are expected to be well under a millisecond
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LOGGER = logging.getLogger('lunar.metrics')
+
+def format_labels(names, values, extra=''):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name            # String
+        self.doc = doc              # String
+        self.labels = labels        # tuple of label names
+        self.values = {}            # tuple of label values: value
+
+    def render(self):
+        """
+        :return: list of lines in the Prometheus text format
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.doc), '# TYPE {} {}'.format(self.name, self.kind)]
+        for values, value in sorted(self.collect().items()):
+            lines.append(self.name + format_labels(self.labels, values) + ' ' + format_value(value))
+        return lines
+
+    def collect(self):
+        return self.values
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        """
+        :param labels: tuple of label values, in the order of the metric's label names
+        :param amount: Number to add
+        :return: None
+        """
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=(), func=None):
+        super().__init__(name, doc, labels)
+        self.func = func            # function returning the value, or a dict of label values: value
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def collect(self):
+        if self.func is None:
+            return self.values
+        value = self.func()
+        return value if isinstance(value, dict) else {(): value}
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)   # upper bounds, ascending; +Inf is implied
+
+    def observe(self, value, labels=()):
+        """
+        :param value: Number observed
+        :param labels: tuple of label values, in the order of the metric's label names
+        :return: None
+        """
+        entry = self.values.get(labels)
+        if entry is None:
+            # [count per bucket (last one is +Inf), sum]
+            entry = [[0] * (len(self.buckets) + 1), 0]
+            self.values[labels] = entry
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc), '# TYPE {} {}'.format(self.name, self.kind)]
+        for values, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="' + format_value(bound) + '"'
+                lines.append(self.name + '_bucket' + format_labels(self.labels, values, le) + ' ' + str(cumulative))
+            lines.append(self.name + '_sum' + format_labels(self.labels, values) + ' ' + format_value(total))
+            lines.append(self.name + '_count' + format_labels(self.labels, values) + ' ' + str(cumulative))
+        return lines
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}           # name: Metric
+
+    def register(self, metric):
+        """
+        :param metric: a Metric whose name isn't registered yet
+        :return: metric
+        """
+        if metric.name in self.metrics:
+            raise ValueError("Metric " + metric.name + " is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        return self.register(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=(), func=None):
+        return self.register(Gauge(name, doc, labels, func))
+
+    def histogram(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, doc, labels, buckets))
+
+    def render(self):
+        """
+        :return: String - every metric in the Prometheus text format
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            try:
+                lines.extend(self.metrics[name].render())
+            except Exception:
+                LOGGER.exception("Collecting metric %s failed", name)
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+async def serve(host, port, registry=REGISTRY):
+    """
+    Starts an HTTP endpoint that answers every GET with the registry's metrics
+
+    :return: asyncio Server
+    """
+    async def scrape(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            if request.split(b' ')[0] == b'GET':
+                status, body = "200 OK", registry.render().encode('utf-8')
+            else:
+                status, body = "405 Method Not Allowed", b''
+            writer.write("HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n".format(
+                status, CONTENT_TYPE, len(body)).encode('ascii') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(scrape, host, port)
+    LOGGER.info("Serving metrics on %s:%s", host, port)
+    return server
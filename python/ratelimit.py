@@ -0,0 +1,162 @@
+"""
+Lunar Rocks Rate Limiting
+
+Token buckets that keep any one client, or any one session, from taking more than its share of the
+server. Every client has a bucket per messageID, and so does every session for the messages that
+change it; a message is admitted only if both of its buckets hold a token. Buckets refill
+continuously at their rate, up to their burst size, and are created on first use and dropped once
+they have refilled, so idle clients and sessions cost nothing.
+
+New connections are only limited while the server is overloaded, which the LagMonitor judges by
+how late the event loop wakes up from a short sleep.
+"""
+
+import asyncio
+import time
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+# msgID: (messages per second, burst)
+CLIENT_LIMITS = {100: (10, 20), 108: (10, 20), 115: (60, 120), 119: (200, 400), 121: (20, 40)}
+SESSION_LIMITS = {100: (30, 60), 115: (200, 400), 121: (60, 120)}
+DEFAULT_CLIENT_LIMIT = (20, 40)     # every msgID without its own client limit
+DEFAULT_ADMISSION = (20, 20)        # msgID 112 connects per second, burst, while overloaded
+LAG_INTERVAL = 0.1                  # seconds between event loop lag measurements
+LAG_THRESHOLD = 0.05                # seconds of lag beyond which the server counts as overloaded
+
+class TokenBucket:
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate            # Float, tokens added per second
+        self.burst = burst          # Float, most tokens the bucket holds
+        self.tokens = burst         # Float
+        self.stamp = now            # Float, time tokens was last brought up to date
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self, now):
+        """
+        :return: seconds until the bucket holds a token, 0 if it holds one now
+        """
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """
+        Takes a token if there is one
+
+        :return: seconds until a token would be available, 0 if one was taken
+        """
+        wait = self.wait(now)
+        if not wait:
+            self.tokens -= 1
+        return wait
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+class RateLimiter:
+
+    def __init__(self, client_limits=CLIENT_LIMITS, session_limits=SESSION_LIMITS,
+                 default=DEFAULT_CLIENT_LIMIT, clock=time.monotonic):
+        self.client_limits = dict(client_limits)    # msgID: (rate, burst)
+        self.session_limits = dict(session_limits)  # msgID: (rate, burst)
+        self.default = default                      # (rate, burst) for msgIDs not in client_limits, or None
+        self.clock = clock                          # function returning the time in seconds
+        self.buckets = {}                           # (clientID or sessionID, msgID): TokenBucket
+
+    def bucket(self, key, msgID, limit, now):
+        bucket = self.buckets.get((key, msgID))
+        if bucket is None:
+            bucket = self.buckets[(key, msgID)] = TokenBucket(limit[0], limit[1], now)
+        return bucket
+
+    def check(self, cid, msgID, sid=None):
+        """
+        Admits a message if its client, and its session if it has one, are both within their limits
+
+        :param cid: clientID of the sender
+        :param msgID: the message's messageID
+        :param sid: sessionID the message changes, or None
+        :return: seconds until the message would be admitted, 0 if it was admitted now
+        """
+        now = self.clock()
+        buckets = []
+        limit = self.client_limits.get(msgID, self.default)
+        if limit is not None:
+            buckets.append(self.bucket(('client', cid), msgID, limit, now))
+        limit = self.session_limits.get(msgID)
+        if limit is not None and sid is not None:
+            buckets.append(self.bucket(('session', sid), msgID, limit, now))
+
+        wait = max([bucket.wait(now) for bucket in buckets] or [0])
+        if not wait:
+            for bucket in buckets:
+                bucket.take(now)
+        return wait
+
+    def prune(self):
+        """
+        Drops the buckets that have refilled; they are recreated, full, on next use
+
+        :return: None
+        """
+        now = self.clock()
+        for key in [key for key, bucket in self.buckets.items() if bucket.full(now)]:
+            del self.buckets[key]
+
+class LagMonitor:
+
+    def __init__(self, interval=LAG_INTERVAL, threshold=LAG_THRESHOLD):
+        self.interval = interval    # Float, seconds
+        self.threshold = threshold  # Float, seconds
+        self.lag = 0                # Float, seconds the last wake-up was late by
+
+    async def run(self):
+        """
+        Measures the event loop's lag once per interval, forever
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0, loop.time() - start - self.interval)
+
+    def overloaded(self):
+        return self.lag > self.threshold
+
+def parse_limit(spec):
+    """
+    :param spec: String "rate/burst" or "rate", in messages per second; burst defaults to rate
+    :return: (rate, burst)
+    """
+    rate, _, burst = spec.partition('/')
+    rate, burst = float(rate), float(burst or rate)
+    if rate <= 0 or burst < 1:
+        raise ValueError("Limits must allow at least one message: " + spec)
+    return rate, burst
+
+def parse_limits(spec):
+    """
+    Parses a list of per-messageID limits
+
+    :param spec: String such as "100=10/20,115=60/120" (messages per second/burst)
+    :return: dict of msgID: (rate, burst)
+    """
+    limits = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        msgID, limit = item.split('=')
+        limits[int(msgID)] = parse_limit(limit)
+    return limits
@@ -9,10 +9,24 @@ Python >= 3.5 required.
 import asyncio
 import websockets
 from websockets.exceptions import ConnectionClosed
-import json
+import backplane
+import codec
+import compress
 import controller
+import directory
+import fanout
+import gc
+import frameclock
+import heartbeat
+import journal
+import metrics
+import ratelimit
+import wire
 import logging
-from logging.handlers import RotatingFileHandler
+import logpipe
+import shard
+import signal
+import time
 import uuid
 import argparse
 
@@ -27,14 +41,8 @@ __status__ = "Alpha"
 
 SERVER_ID = str(uuid.uuid1())
 
-LOG_NAME = "server.log"
-
-log_handler = RotatingFileHandler(LOG_NAME, mode='w+', maxBytes = 1000000, backupCount=2, encoding=None, delay=0)
-log_handler.setLevel(logging.DEBUG)
-
-LOGGER = logging.getLogger('root')
-LOGGER.setLevel(logging.DEBUG)
-LOGGER.addHandler(log_handler)
+LOGGER = logging.getLogger('lunar.server')
+TRAFFIC = logging.getLogger('lunar.traffic')      # every message in and out; sample it with --log-sample
 
 DISPATCH_TABLE = {
     100: lambda x: handle_100(x),
@@ -45,92 +53,494 @@ DISPATCH_TABLE = {
     108: lambda x: handle_108(x),
     109: lambda x: handle_109(x),
     110: lambda x: handle_110(x),
-    112: lambda x: handle_112(x)
+    112: lambda x: handle_112(x),
+    115: lambda x: handle_115(x),
+    116: lambda x: handle_116(x),
+    118: lambda x: handle_118(x),
+    119: lambda x: handle_119(x),
+    121: lambda x: handle_121(x)
 }
 
 CTRL = controller.Controller()
-D_CONNS = []                    # List for timing out connections
+FANOUT = fanout.FanOut()
+CLOCK = frameclock.FrameClock(lambda *x: publish(*x))
+OBSERVERS = frameclock.FrameClock(lambda sess, base, cells, skip: publish_tier(sess, base, cells, controller.TIER_OBSERVERS, skip),
+                                  frameclock.DEFAULT_OBSERVER_TICK)
+DIRECTORY = directory.Directory(lambda: all_sessions(), lambda *x: publish_directory(*x))
+HEARTBEAT = heartbeat.Heartbeat(lambda: FANOUT.outboxes.keys(), lambda x: evict(x))
+LIMITER = ratelimit.RateLimiter()   # None to turn rate limiting off
+LAG = ratelimit.LagMonitor()
+ADMISSION = ratelimit.TokenBucket(*ratelimit.DEFAULT_ADMISSION, time.monotonic())   # applies while LAG is overloaded
+HELD = {}               # (clientID, msgID, key): (websocket, Request) for over-limit messages awaiting their turn
 UUID_SLICE = 4
+TRUST_PROXY = False     # True for a worker behind shard.py, which may assign clientIDs and addresses
+ROUTERS = set()         # control connections of routers, told about session list changes instead of clients
+NODE = SERVER_ID        # this server's name on the backplane
+BACKPLANE = backplane.LocalBackplane()
+NODES = {}              # name: (lowest sessionID, highest sessionID, [sessionIDs]) of the other servers on the backplane
+
+MESSAGES = metrics.REGISTRY.counter('lunar_messages_received_total', "Messages received, by msgID", ('msgID',))
+REJECTED = metrics.REGISTRY.counter('lunar_messages_rejected_total', "Messages answered with a msgID 114 error, by msgID", ('msgID',))
+LIMITED = metrics.REGISTRY.counter('lunar_rate_limited_total', "Messages over their rate limit, by msgID and whether they were held or rejected",
+                                   ('msgID', 'action'))
+RESYNCS = metrics.REGISTRY.counter('lunar_resyncs_total', "msgID 116 requests, by whether they were answered with missed cells or a snapshot",
+                                   ('reply',))
+RECEIVED_BYTES = metrics.REGISTRY.counter('lunar_received_bytes_total', "Bytes of incoming frames")
+HANDLER_SECONDS = metrics.REGISTRY.histogram('lunar_handler_seconds', "Time spent in each message handler, by msgID", ('msgID',))
+BROADCAST_SIZE = metrics.REGISTRY.histogram('lunar_broadcast_recipients', "Clients each broadcast was sent to, by msgID",
+                                            ('msgID',), metrics.SIZE_BUCKETS)
+BROADCAST_SECONDS = metrics.REGISTRY.histogram('lunar_broadcast_seconds', "Time taken to queue each broadcast, by msgID", ('msgID',))
+metrics.REGISTRY.gauge('lunar_clients', "Clients known to the server", func=lambda: len(CTRL.clients))
+metrics.REGISTRY.gauge('lunar_sessions', "Open sessions", func=lambda: len(CTRL.sessions))
+metrics.REGISTRY.gauge('lunar_sockets', "Clients with a websocket on record", func=lambda: len(CTRL.sockets))
+metrics.REGISTRY.gauge('lunar_connections', "Open websocket connections", func=lambda: len(FANOUT.outboxes))
+metrics.REGISTRY.gauge('lunar_expiring_clients', "Disconnected clients waiting out their time to live", func=lambda: len(CTRL.expiry))
+metrics.REGISTRY.gauge('lunar_session_id_occupancy', "Fraction of session IDs in use", func=lambda: CTRL.session_ids.occupancy())
+metrics.REGISTRY.gauge('lunar_outbox_queued', "Messages waiting in all outboxes",
+                       func=lambda: sum(len(o.queue) for o in FANOUT.outboxes.values()))
+metrics.REGISTRY.gauge('lunar_outbox_queued_max', "Messages waiting in the fullest outbox",
+                       func=lambda: max([len(o.queue) for o in FANOUT.outboxes.values()] or [0]))
+metrics.REGISTRY.gauge('lunar_held_messages', "Over-limit messages held back to be sent later", func=lambda: len(HELD))
+metrics.REGISTRY.gauge('lunar_event_loop_lag_seconds', "How late the event loop last woke up", func=lambda: LAG.lag)
+metrics.REGISTRY.gauge('lunar_heartbeat_latency_max_seconds', "Slowest round trip of the last heartbeat",
+                       func=lambda: max(list(HEARTBEAT.latency.values()) or [0]))
 
 async def handle(websocket, path):
     LOGGER.debug("handle called")
-    global D_CONNS
+    if TRUST_PROXY and path == shard.CONTROL_PATH:
+        await control(websocket)
+        return
+
+    FANOUT.register(websocket)
     try:
         async for message in websocket:
-            LOGGER.debug("Message received: " + str(message))
+            TRAFFIC.debug("Message received: %s", message)
+            RECEIVED_BYTES.inc((), len(message))
 
-            await prune_dc()
-
-            addr = websocket.remote_address
+            addr = peer_address(websocket)
             #LOGGER.debug("Address of socket: " + str(addr[0]) + ':' + str(addr[1]))
 
-            obj = json.loads(message)
-            msgID = obj.get("messageID")
-            srcID = obj.get("sourceID")
-            #LOGGER.debug("Type of msgID: " + str(type(msgID)))
+            try:
+                msg = codec.parse(wire.decode(message))
+            except (wire.WireError, codec.MessageError) as e:
+                LOGGER.error("Undecodable message received: %s", e)
+                FANOUT.send(websocket, error_msg("Error: " + str(e)))
+                continue
+
+            msgID = msg.msgID
+            srcID = msg.srcID
+            handler = DISPATCH_TABLE.get(msgID)
 
-            if obj is None or msgID is None:
-                LOGGER.debug("Error sent")
-                await websocket.send(error_msg("ERROR: messageID must be provided"))
+            if handler is None:
+                LOGGER.debug("Unknown messageID %s", msgID)
+                FANOUT.send(websocket, error_msg("Error: unknown messageID " + str(msgID)))
             elif ((not srcID) or (srcID == "clown shoes")) and msgID != 112:
                 LOGGER.debug("No sourceID provided")
                 errmsg = error_msg("Error: SrcID must be provided")
-                LOGGER.debug("Message sent: " + str(errmsg))
-                await websocket.send(errmsg)
+                TRAFFIC.debug("Message sent: %s", errmsg)
+                FANOUT.send(websocket, errmsg)
+            elif msgID != 112 and srcID != CTRL.get_cid_by_socket(websocket):
+                # Connections are bound to a client by its 112, new or resumed, and only then
+                LOGGER.debug("sourceID %s isn't the client of this connection", srcID[:UUID_SLICE])
+                FANOUT.send(websocket, error_msg("Error: sourceID is not this connection's client; send a 112 to resume it"))
 
             else:
                 if msgID == 112:
-                    obj['addr'] = addr
-                else:
-                    CTRL.set_TTL(srcID)
+                    msg.addr = addr
+                    msg.socket = websocket
 
                 LOGGER.debug("Dispatch table called")
-                if srcID != "clown shoes":
-                    CTRL.log_socket(srcID, websocket)
-                msg = await DISPATCH_TABLE[msgID](obj)
-                if msg:
-                    #await websocket.send(DISPATCH_TABLE[msgID](obj))
-                    LOGGER.debug("Message sent: " + str(msg))
-                    await websocket.send(msg)
+                await dispatch(websocket, msg)
 
     except ConnectionClosed as e:
-        addr = websocket.remote_address
-        LOGGER.debug("Connection closed at: " + str(addr))
+        LOGGER.debug("Connection closed with code %s", e.code)
+
+    finally:
+        # Clean closes end the loop above without raising, and anything unexpected raises something
+        # else; the client is set to time out however the connection ended
+        FANOUT.unregister(websocket)
+        disconnected(websocket)
+
+def disconnected(websocket):
+    """
+    Starts the time to live of the client bound to a connection that has closed, unless it has
+    already resumed on another one
+
+    :param websocket: the closed connection
+    :return: None
+    """
+    addr = peer_address(websocket)
+    LOGGER.debug("Connection closed at: %s", addr)
+
+    cid = CTRL.get_cid_by_socket(websocket)
+    nick = CTRL.clients.get(cid)
+    if nick is None:
+        nick = "NOT FOUND"
+
+    if cid is None:
+        # Never connected as a client, or its client has resumed on another connection
+        LOGGER.debug("No clientID bound to connection at address %s", addr)
+        return
+
+    # The connection may not be closed yet if the handler is ending with an error, so only whether
+    # the client is already timing out matters here
+    if cid in CTRL.expiry:
+        LOGGER.debug("Client %s--%s is already timing out", nick, cid[:UUID_SLICE])
+        return
+
+    CTRL.set_TTL(cid)
+    LOGGER.info("Client %s--%s dropped websocket connection.", nick, cid[:UUID_SLICE])
+
+async def dispatch(websocket, msg):
+    """
+    Handles a message, or forwards it to the servers owning the sessions it is about, if the rate
+    limits let it through now
+
+    :param websocket: the connection msg arrived on
+    :param msg: a codec.Request
+    :return: None
+    """
+    if not admit(websocket, msg):
+        return
+
+    for node, part in route(msg):
+        if node is None:
+            await run(websocket, part)
+        else:
+            forward(node, part)
+
+async def run(websocket, msg):
+    """
+    Runs a message's handler and sends its reply. A handler that fails unexpectedly gets the client
+    a msgID 114 rather than taking its connection down.
+
+    :param websocket: the connection msg arrived on, or a backplane.Remote for forwarded messages
+    :param msg: a codec.Request
+    :return: None
+    """
+    labels = (msg.msgID,)
+    MESSAGES.inc(labels)
+    start = time.perf_counter()
+    try:
+        reply = await DISPATCH_TABLE[msg.msgID](msg)
+    except Exception:
+        LOGGER.exception("Handling msgID %s from %s failed", msg.msgID, msg.srcID[:UUID_SLICE])
+        reply = error_msg("Error: msgID {} could not be handled".format(msg.msgID))
+    HANDLER_SECONDS.observe(time.perf_counter() - start, labels)
+    if reply:
+        if reply.msgID == 114:
+            REJECTED.inc(labels)
+        #await websocket.send(DISPATCH_TABLE[msgID](obj))
+        TRAFFIC.debug("Message sent: %s", reply)
+        send(websocket, reply)
+
+def admit(websocket, msg):
+    """
+    Checks a message against the rate limits of its client and session, and new connections against
+    the admission limit while the server is overloaded.
+
+    An over-limit message that carries a whole session or track is held back until the limit lets
+    it through, and replaced by any newer one of the same kind, since each supersedes the last. Any
+    other over-limit message is refused with a msgID 114.
+
+    :param websocket: the connection msg arrived on
+    :param msg: a codec.Request
+    :return: boolean - whether msg may be handled now
+    """
+    if msg.msgID == 112:
+        if ADMISSION is None or not LAG.overloaded() or not ADMISSION.take(time.monotonic()):
+            return True
+        LOGGER.warning("Refusing new client while overloaded (event loop lag %.3fs)", LAG.lag)
+        LIMITED.inc((112, 'rejected'))
+        FANOUT.send(websocket, error_msg("Error: Server is busy; try connecting again later"))
+        return False
+
+    if LIMITER is None:
+        return True
+
+    wait = LIMITER.check(msg.srcID, msg.msgID, session_of(msg))
+    if not wait:
+        return True
+
+    key = coalesce_key(msg)
+    if key is not None:
+        LIMITED.inc((msg.msgID, 'held'))
+        hold(websocket, msg, key, wait)
+    else:
+        LIMITED.inc((msg.msgID, 'rejected'))
+        LOGGER.debug("Client %s is over its limit for msgID %s", msg.srcID[:UUID_SLICE], msg.msgID)
+        FANOUT.send(websocket, error_msg("Error: Too many messages with msgID {}; wait {:.0f} ms".format(
+            msg.msgID, wait * 1000)))
+    return False
+
+def session_of(msg):
+    """
+    :param msg: a codec.Request
+    :return: the sessionID msg changes, or None
+    """
+    if msg.msgID == 100:
+        return msg.get("session", dict, {}).get("sessionID")
+    return msg.get("sessionID", int)
+
+def coalesce_key(msg):
+    """
+    :param msg: a codec.Request
+    :return: what a newer message must match to supersede msg, or None if msg can't be superseded
+    """
+    if msg.msgID == 100:
+        return session_of(msg)
+    if msg.msgID == 108:
+        return repr((msg.get("track", dict, {}).get("trackID"), msg.get("sessionIDs")))
+    return None
+
+def hold(websocket, msg, key, wait):
+    """
+    Holds an over-limit message back for wait seconds, replacing one held with the same key
+
+    :return: None
+    """
+    slot = (msg.srcID, msg.msgID, key)
+    if slot not in HELD:
+        asyncio.get_event_loop().call_later(wait, lambda: asyncio.ensure_future(release(slot)))
+    HELD[slot] = (websocket, msg)
+
+async def release(slot):
+    """
+    Dispatches the newest message held in a slot; it is held again if still over the limit
+    """
+    held = HELD.pop(slot, None)
+    if held is not None:
+        await dispatch(*held)
 
-        cid = CTRL.get_cid_by_address(addr)
-        nick = CTRL.clients.get(cid)
-        if nick is None:
-            nick = "NOT FOUND"
+def send(sock, msg, key=None):
+    """
+    Queues msg for a client, wherever it is connected
+
+    :param sock: a websocket object, or a backplane.Remote for a client connected to another server
+    :param msg: a wire.Message
+    :param key: see fanout.Outbox.push()
+    :return: None
+    """
+    if isinstance(sock, backplane.Remote):
+        relay(sock.node, [sock.cid], msg, key)
+    else:
+        FANOUT.send(sock, msg, key)
+
+def all_sessions():
+    """
+    :return: set of the sessionIDs of this server and every other server on the backplane
+    """
+    sessionIDs = set(CTRL.sessions)
+    for _, _, remote in NODES.values():
+        sessionIDs.update(remote)
+    return sessionIDs
+
+def owner_of(sid):
+    """
+    :param sid: sessionID, or None
+    :return: name of the server on the backplane owning sid, or None if it is this one (or nobody)
+    """
+    if sid is None or CTRL.session_ids.low <= sid <= CTRL.session_ids.high:
+        return None
+    for node, (low, high, _) in NODES.items():
+        if low <= sid <= high:
+            return node
+    return None
+
+def route(msg):
+    """
+    Splits a message between the servers owning the sessions it is about
+
+    :param msg: a codec.Request
+    :return: list of (name of a server, or None for this one, codec.Request)
+    """
+    if not NODES:
+        return [(None, msg)]
+
+    if msg.msgID == 108:
+        groups = {}
+        for sid in msg.get("sessionIDs", list, []):
+            groups.setdefault(owner_of(sid), []).append(sid)
+        if len(groups) <= 1:
+            return [(next(iter(groups), None), msg)]
+        return [(node, codec.Request(108, msg.srcID, dict(msg.payload, sessionIDs=sids)))
+                for node, sids in groups.items()]
+
+    return [(owner_of(session_of(msg)), msg)]
+
+def forward(node, msg):
+    """
+    Hands a message to the server that owns its session, which replies to the client through us
+
+    :param node: name of the owning server
+    :param msg: a codec.Request
+    :return: None
+    """
+    BACKPLANE.publish('node.' + node, codec.dumps({
+        'kind': 'request',
+        'home': NODE,
+        'nickname': CTRL.clients.get(msg.srcID),
+        'msg': [msg.msgID, msg.srcID, msg.payload]
+    }))
+
+def relay(node, cids, msg, key=None):
+    """
+    Asks another server to send msg to those of cids connected to it
+
+    :return: None
+    """
+    BACKPLANE.publish('node.' + node, codec.dumps({
+        'kind': 'deliver',
+        'cids': cids,
+        'key': key,
+        'msg': [msg.srcID, msg.msgID, msg.payload]
+    }))
+
+def announce():
+    """
+    Tells the other servers on the backplane which sessions this one owns
+
+    :return: None
+    """
+    BACKPLANE.publish('directory', codec.dumps({
+        'node': NODE,
+        'low': CTRL.session_ids.low,
+        'high': CTRL.session_ids.high,
+        'sessionIDs': sorted(CTRL.sessions)
+    }))
+
+def on_directory(data):
+    """
+    Merges another server's sessions into the directory
+    """
+    entry = codec.loads(data)
+    node = entry['node']
+    if node == NODE:
+        return
+    if node not in NODES:
+        LOGGER.info("Server %s joined the backplane with sessionIDs %s to %s", node, entry['low'], entry['high'])
+        # The newcomer doesn't know about us yet either
+        announce()
+    NODES[node] = (entry['low'], entry['high'], entry['sessionIDs'])
+    DIRECTORY.changed()
+
+def on_message(data):
+    """
+    Handles a request forwarded by another server, or sends on messages for clients connected here
+    """
+    entry = codec.loads(data)
+    if entry['kind'] == 'request':
+        msgID, cid, payload = entry['msg']
+        sock = CTRL.get_socket(cid)
+        if not isinstance(sock, backplane.Remote) or sock.node != entry['home']:
+            sock = backplane.Remote(entry['home'], cid)
+        if cid not in CTRL.clients:
+            CTRL.new_client(entry['nickname'] or "NOT FOUND", cid)
+        CTRL.log_socket(cid, sock)
+        asyncio.ensure_future(run(sock, codec.Request(msgID, cid, payload)))
+    elif entry['kind'] == 'deliver':
+        srcID, msgID, payload = entry['msg']
+        msg = wire.Message(srcID, msgID, payload)
+        key = tuple(entry['key']) if isinstance(entry['key'], list) else entry['key']
+        for cid in entry['cids']:
+            sock = CTRL.get_socket(cid)
+            if sock is not None and not isinstance(sock, backplane.Remote):
+                FANOUT.send(sock, msg, key)
+
+def on_exit(data):
+    """
+    Drops a client that left another server from the sessions here
+    """
+    cid = codec.loads(data)['clientID']
+    if isinstance(CTRL.get_socket(cid), backplane.Remote):
+        asyncio.ensure_future(handle_106(codec.Request(106, cid)))
 
-        if cid is None:
-            LOGGER.error("No clientID found for connection at address " + str(addr))
-            return
+def peer_address(websocket):
+    """
+    The address of the client at the other end of a connection, as reported by the router for
+    connections it forwards
 
-        if CTRL.check_TTL(cid):
-            D_CONNS.append(cid)
-            LOGGER.info("Client " + nick + '--' + str(cid[:UUID_SLICE]) + " dropped websocket connection.")
-            return
+    :param websocket: a websocket object
+    :return: (host, port) tuple, or the router's String for it
+    """
+    if TRUST_PROXY:
+        forwarded = websocket.request_headers.get(shard.FORWARDED_HEADER)
+        if forwarded:
+            return forwarded
+    return websocket.remote_address
 
-        LOGGER.debug("Closed connection thrown by client " + nick + '--' + cid[:UUID_SLICE] + ". Exiting client now.")
-        msg = {'sourceID': cid}
-        await handle_106(msg)
+async def control(websocket):
+    """
+    Serves a router's control connection: sends it this worker's session list now and whenever it
+    changes, until the router disconnects.
 
-async def prune_dc():
+    :param websocket: a websocket object
+    :return: None
     """
-    This function repeatedly checks the list of "timing out" connections to ensure that timed
-    out connections get dropped.
+    LOGGER.info("Router subscribed to session list")
+    FANOUT.register(websocket)
+    ROUTERS.add(websocket)
+    try:
+        version, sessionIDs = DIRECTORY.listing()
+        FANOUT.send(websocket, make_msg(SERVER_ID, 105, {'sessionIDs': sessionIDs, 'version': version}), 105)
+        await websocket.wait_closed()
+    finally:
+        ROUTERS.discard(websocket)
+        FANOUT.unregister(websocket)
+
+async def publish_directory(version, sessionIDs, added, removed):
+    """
+    Sends a new version of the session directory to the clients following it, or to the router
+    that merges it with those of the other workers.
+
+    :param version: the directory's new version
+    :param sessionIDs: sorted list of every sessionID
+    :param added: sessionIDs created since the previous version
+    :param removed: sessionIDs deleted since the previous version
+    :return: None
     """
-    global D_CONNS
-    if D_CONNS == []:
+    listmsg = make_msg(SERVER_ID, 105, {'sessionIDs': sessionIDs, 'version': version})
+    if TRUST_PROXY:
+        FANOUT.broadcast(ROUTERS, listmsg, 105)
         return
 
-    for cid in D_CONNS:
-        if not CTRL.check_TTL(cid):
-            LOGGER.info(str(cid) + " has timed out and is being dropped.")
-            msg = {'sourceID': cid}
-            D_CONNS = [x for x in D_CONNS if x != cid]
-            await handle_106(msg)
-        
+    announce()
+    # Clients connected to other servers get the directory from those
+    local = [cid for cid in CTRL.clients if not isinstance(CTRL.sockets.get(cid), backplane.Remote)]
+    lists, diffs = DIRECTORY.recipients(local)
+    await broadcast(listmsg, lists, 105)
+    if diffs:
+        # Diffs build on one another, so unlike whole lists they must never be dropped
+        diffmsg = make_msg(SERVER_ID, 117, {'version': version, 'added': added, 'removed': removed})
+        await broadcast(diffmsg, diffs)
+
+def evict(sock):
+    """
+    Closes a connection that stopped answering pings. Its handler then treats the client like any
+    other client that lost its connection.
+
+    :param sock: a websocket object
+    :return: None
+    """
+    FANOUT.unregister(sock)
+    asyncio.ensure_future(sock.close(code=1001, reason="heartbeat timeout"))
+
+async def reap():
+    """
+    Background task which drops clients whose connection has been gone for longer than their
+    time to live, once per slot of the controller's timer wheel.
+    """
+    while True:
+        await asyncio.sleep(CTRL.expiry.resolution)
+        if LIMITER is not None:
+            LIMITER.prune()
+        for cid in CTRL.expire():
+            LOGGER.info("%s has timed out and is being dropped.", cid)
+            try:
+                await handle_106(codec.Request(106, cid))
+            except Exception:
+                LOGGER.exception("Dropping client %s failed", cid)
+
 def make_msg(srcID, msgID, payload):
     """
     Helper function for generating well-formed json messages.
@@ -138,77 +548,139 @@ def make_msg(srcID, msgID, payload):
     :param srcID: the ID of this server, ideally
     :param msgID: the msgID as dictated by the RFC
     :param payload: The stuff to put in the payload, if any
-    :return: a json-serialized message
+    :return: a wire.Message, serialized for each client's encoding when sent
     """
     LOGGER.debug("make_msg() started")
-    msg = json.dumps({
-        "sourceID": srcID,
-        "messageID": msgID,
-        "payload": payload
-    })
-    return msg
+    return wire.Message(srcID, msgID, payload)
 
 def error_msg(txt):
     """
     A Helper function for generating well-formed json error messages
 
     :param txt: the error string
-    :return: a json-serialized message
+    :return: a wire.Message
     """
     LOGGER.debug("error_msg() started")
-    msg = json.dumps({
-        "sourceID": SERVER_ID,
-        "messageID": 114,
-        "payload": {'error': txt}
+    return wire.Message(SERVER_ID, 114, {'error': txt})
 
-    })
+def session_msg(sess):
+    """
+    Helper function for the msgID 100 update of a session.
+
+    The message is serialized once per session version and reused until the session changes.
+
+    :param sess: a Session object
+    :return: a wire.Message
+    """
+    msg = sess.cache.get(100)
+    if msg is None:
+        msg = make_msg(SERVER_ID, 100, {'session': sess.export()})
+        sess.cache[100] = msg
     return msg
 
-async def broadcast(msg, clients):
+async def broadcast(msg, clients, key=None):
     """
     Broadcast a message to all clients
+
+    Sends are queued on each client's outbox and go out concurrently, so a slow client never holds
+    up the others or the calling handler. Clients connected to other servers are sent msg by those
+    servers, with one message over the backplane to each.
+
     :param msg: the well-formed json object to be broadcast
     :param clients: the list of UUIDs to which to send msg
+    :param key: identifies msg as a snapshot that newer messages with the same key supersede
     :return: None
     """
     LOGGER.debug("broadcast started")
-    LOGGER.debug("broadcasting message: " + msg)
-    LOGGER.debug("broadcasting to: " + str(clients))
+    TRAFFIC.debug("broadcasting message: %s", msg)
+    TRAFFIC.debug("broadcasting to: %s", clients)
+    start = time.perf_counter()
+    sent = 0
+    remote = {}         # server name: [clientID]
 
     # Loop through all clients, sending 105, or 102 & 105 for the 101 initiator
     for cid in clients:
-        nick = CTRL.clients.get(cid)
-        if nick is None:
-            nick = "NOT FOUND"
         sock = CTRL.get_socket(cid)
         if sock:
+            sent += 1
             #addr = sock.remote_address
-            LOGGER.debug("Sending to client: " + nick + '--' + cid[:UUID_SLICE])
-            await sock.send(msg)
+            if TRAFFIC.isEnabledFor(logging.DEBUG):
+                TRAFFIC.debug("Sending to client: %s--%s", CTRL.clients.get(cid, "NOT FOUND"), cid[:UUID_SLICE])
+            if isinstance(sock, backplane.Remote):
+                remote.setdefault(sock.node, []).append(cid)
+            else:
+                FANOUT.send(sock, msg, key)
             #crock = websockets.connect("ws://" + str(addr[0]) + ':' + str(addr[1]))
             #crock.send(msg)
 
+    for node, cids in remote.items():
+        relay(node, cids, msg, key)
+
+    labels = (msg.msgID,)
+    BROADCAST_SIZE.observe(sent, labels)
+    BROADCAST_SECONDS.observe(time.perf_counter() - start, labels)
     LOGGER.debug("Broadcast finished")
 
+async def publish(sess, base, cells, skip=()):
+    """
+    Sends an update of a session to the clients owning its tracks right away, and hands it to the
+    OBSERVERS clock, which merges it with the next few for the rest. With an observer tick of 0
+    every client is sent every update.
+
+    :param sess: a Session object
+    :param base: the version cells were applied to
+    :param cells: list of changed cells for a msgID 115, or None for a full msgID 100 snapshot
+    :param skip: see publish_tier()
+    :return: None
+    """
+    if not OBSERVERS.tick:
+        await publish_tier(sess, base, cells, controller.TIER_ALL, skip)
+        return
+
+    await publish_tier(sess, base, cells, controller.TIER_OWNERS, skip)
+    if cells is None:
+        await OBSERVERS.snapshot(sess)
+    else:
+        await OBSERVERS.cells(sess, base, cells)
+
+async def publish_tier(sess, base, cells, tier, skip=()):
+    """
+    Sends an update of a session to one tier of its clients
+
+    :param sess: a Session object
+    :param base: the version cells were applied to
+    :param cells: list of changed cells for a msgID 115, or None for a full msgID 100 snapshot
+    :param tier: see Session.recipients()
+    :param skip: clientIDs already sent the session's current state
+    :return: None
+    """
+    clients = sess.recipients(tier)
+    if skip:
+        clients = [cid for cid in clients if cid not in skip]
+    if not clients:
+        return
+
+    if cells is None:
+        newmsg = session_msg(sess)
+        LOGGER.debug("Broadcasting %s to session's %s", newmsg, tier)
+        await broadcast(newmsg, clients, (100, sess.sessionID))
+    else:
+        newmsg = make_msg(SERVER_ID, 115, {'sessionID': sess.sessionID, 'baseVersion': base, 'version': sess.version, 'cells': cells})
+        await broadcast(newmsg, clients)
+
 async def handle_100(msg):
     """
     Handler for msg code 101: Update Session
 
-    Sends updates to all clients in the session's clientlists
+    Sends updates to all clients in the session's clients
 
-    :param msg: the message dict
-    :return: a json-serialized object
+    :param msg: a codec.Request
+    :return: a wire.Message
     """
     LOGGER.debug("handle_100() started")
 
-    cid = msg.get("sourceID")
-    payload = msg.get("payload")
-
-    if payload is None:
-        LOGGER.error("No payload provided to handle_100")
-        return error_msg("Error: no payload provided for msgID 100")
-
-    sess = msg.get("payload").get("session")
+    cid = msg.srcID
+    sess = msg.get("session", dict)
     if sess is None:
         LOGGER.error("No session provided to handle_100()")
         return error_msg("Error: no session object provided for msgID 100")
@@ -216,40 +688,47 @@ async def handle_100(msg):
     newsess =  CTRL.update_session(cid, sess)
 
     if newsess is not None:
-        newmsg = make_msg(SERVER_ID, 100, {'session': newsess.export()})
-        LOGGER.debug("Broadcasting " + newmsg + " to all of session's clients")
-
-        await broadcast(newmsg, [x[0] for x in newsess.clientlist])
+        await CLOCK.snapshot(newsess)
 
 async def handle_101(msg):
     """
     Handler for msgID 101: Create Session
 
-    :param msg: the message dict
-    :return: a json-serialized object
+    :param msg: a codec.Request
+    :return: a wire.Message
     """
     LOGGER.debug("handle_101(): Create Session started")
-    cid = msg.get("sourceID")
+    cid = msg.srcID
     nick = CTRL.clients.get(cid)
     if nick is None:
         nick = "NOT FOUND"
 
-    sessID = CTRL.new_session()
+    tones = msg.get("tones", int, controller.DEFAULT_TONES)
+    beats = msg.get("beats", int, controller.DEFAULT_BEATS)
+    ntracks = msg.get("tracks", int, controller.NUM_INITIAL_TRACKS)
+
+    if not (0 < tones <= controller.MAX_TONES and 0 < beats <= controller.MAX_BEATS and 0 < ntracks <= controller.MAX_TRACKS):
+        LOGGER.error("Client %s--%s asked for a %sx%s board with %s tracks", nick, cid[:UUID_SLICE], tones, beats, ntracks)
+        return error_msg("Error: Sessions may have at most {} tones, {} beats and {} tracks".format(
+            controller.MAX_TONES, controller.MAX_BEATS, controller.MAX_TRACKS))
 
-    LOGGER.info("Client " + nick + '--' + cid[:UUID_SLICE] + " created session " + str(sessID))
+    sessID = CTRL.new_session((tones, beats), ntracks)
+
+    if sessID is None:
+        LOGGER.error("Client %s--%s could not create a session: server is full", nick, cid[:UUID_SLICE])
+        return error_msg("Error: No more sessions can be created right now")
+
+    LOGGER.info("Client %s--%s created session %s", nick, cid[:UUID_SLICE], sessID)
 
     sess = CTRL.get_session(sessID)
     newmsg = make_msg(SERVER_ID, 102, {'session': sess})
 
     sock = CTRL.get_socket(cid)
-    LOGGER.debug("Sending " + str(newmsg) + " to client " + nick + '--' + str(cid[:UUID_SLICE]))
-    await sock.send(newmsg)
+    LOGGER.debug("Sending %s to client %s--%s", newmsg, nick, cid[:UUID_SLICE])
+    send(sock, newmsg)
 
     # For broadcasting session list to clients
-    clients = list([x for x in CTRL.clients.keys()])       # UUIDs list
-    sessionIDs = list(CTRL.sessions.keys())   # sessionIDs list
-
-    await broadcast(make_msg(SERVER_ID, 105, {'sessionIDs': sessionIDs}), clients)
+    DIRECTORY.changed()
     """
     if CTRL.client_join(cid, sessID):
         LOGGER.debug("Client " + nick + '--' + cid[:UUID_SLICE] + " joined session " + str(sessID))
@@ -275,43 +754,44 @@ async def handle_103(msg):
     """
     Handler for msgID 103: Join Session
 
-    :param msg: the message dict
-    :return: a json-serialized object
+    :param msg: a codec.Request
+    :return: a wire.Message
     """
     LOGGER.debug("handle_103(): Join Session started")
 
-    cid = msg.get("sourceID")
-    sid = msg.get("payload").get("sessionID")
+    cid = msg.srcID
+    sid = msg.get("sessionID", int)
 
     if sid is None:
         LOGGER.error("sid not provided")
         return error_msg("Error: sessionID must be provided in payload")
 
     if CTRL.client_join(cid, sid):
-        LOGGER.debug("Client " + cid + " joined session " + str(sid))
+        LOGGER.debug("Client %s joined session %s", cid, sid)
 
         sess = CTRL.sessions.get(sid)
-
-        newmsg = make_msg(SERVER_ID, 100, {'session': sess.export()})
-        LOGGER.debug("Broadcasting " + newmsg + " to all of session's clients")
-
-        await broadcast(newmsg, [x[0] for x in sess.clientlist])
+        await CLOCK.snapshot(sess)
+        if OBSERVERS.tick:
+            # New members own no track yet, so they would otherwise wait for the next observer update,
+            # which then only needs to reach them if the session changes again before it goes out
+            OBSERVERS.sent(sess, cid)
+            return session_msg(sess)
 
     else:
-        LOGGER.error("Client " + cid + " attempt to join session " + str(sid) + " failed")
+        LOGGER.error("Client %s attempt to join session %s failed", cid, sid)
         return error_msg("Error: Could not join session")
 
 async def handle_104(msg):
     """
     Handler for msgID 104: Leave Session
 
-    :param msg: the message dict
-    :return: a json-serialized object
+    :param msg: a codec.Request
+    :return: a wire.Message
     """
     LOGGER.debug("handle_104(): Leave Session started")
 
-    cid = msg.get("sourceID")
-    sid = msg.get("payload").get("sessionID")
+    cid = msg.srcID
+    sid = msg.get("sessionID", int)
 
     if sid is None:
         LOGGER.error("sid not provided")
@@ -323,74 +803,68 @@ async def handle_104(msg):
     else:
         LOGGER.error("104: Leave session failed")
 
-    clients = list(CTRL.clients.keys())       # UUIDs list
-    sessionIDs = list(CTRL.sessions.keys())   # sessionIDs list
-    newmsg = make_msg(SERVER_ID, 105, {'sessionIDs': sessionIDs})
-    await broadcast(newmsg, clients)
+    DIRECTORY.changed()
 
     newsess = CTRL.sessions.get(sid)
 
     if newsess:
-        newmsg = make_msg(SERVER_ID, 100, {'session': newsess.export()})
-        LOGGER.debug("Broadcasting " + newmsg + " to all of session's clients")
-
-        await broadcast(newmsg, [x[0] for x in newsess.clientlist])
+        await CLOCK.snapshot(newsess)
 
 async def handle_106(msg):
     """
     Handler for msgID 106: Client Disconnect
 
-    :param msg: the message dict
-    :return: a json-serialized object
+    :param msg: a codec.Request
+    :return: a wire.Message
     """
     LOGGER.debug("handle_106(): Client Disconnect started")
 
-    cid = msg.get("sourceID")
+    cid = msg.srcID
     nick = CTRL.clients.get(cid)
     if nick is None:
         nick = "NOT FOUND"
 
-    if cid is None:
+    if not cid:
         LOGGER.error("No clientID provided to handle_106()")
         return error_msg("Error: sourceID must be provided.")
 
-    client_sessionIDs = CTRL.client_sessions.get(cid)
+    client_sessionIDs = CTRL.client_sessions.get(cid, ())
+    local = not isinstance(CTRL.get_socket(cid), backplane.Remote)
 
     if CTRL.client_exit(cid):
-        LOGGER.debug(nick + ": Client disconnect successful")
+        LOGGER.debug("%s: Client disconnect successful", nick)
     else:
-        LOGGER.error(nick + ": Client disconnect failed")
+        LOGGER.error("%s: Client disconnect failed", nick)
 
-    clients = list(CTRL.clients.keys())       # UUIDs list
-    sessionIDs = list(CTRL.sessions.keys())   # sessionIDs list
-    newmsg = make_msg(SERVER_ID, 105, {'sessionIDs': sessionIDs})
-
-    await broadcast(newmsg, clients)
+    DIRECTORY.forget(cid)
+    DIRECTORY.changed()
+    if local and NODES:
+        # The servers owning the sessions this client joined through us drop it too
+        BACKPLANE.publish('clients', codec.dumps({'clientID': cid}))
 
     for sid in client_sessionIDs:
         sess = CTRL.sessions.get(sid)
         if sess is not None:
-            upd = make_msg(SERVER_ID, 100, {'session': sess.export()})
-            await broadcast(upd, [x[0] for x in sess.clientlist])
+            await CLOCK.snapshot(sess)
 
 async def handle_108(msg):
     """
     Handler for msgID 108: Broadcast
 
-    :param msg: the message dict
-    :return: a json-serialized object, or None
+    :param msg: a codec.Request
+    :return: a wire.Message, or None
     """
     LOGGER.debug("handle_108(): Broadcast started")
 
-    cid = msg.get("sourceID")
+    cid = msg.srcID
 
-    track = msg.get('payload').get("track")
+    track = msg.get("track", dict)
 
     if track is None:
         LOGGER.error("No track provided")
         return error_msg("Error: track must be provided")
 
-    sids = msg.get('payload').get("sessionIDs")
+    sids = msg.get("sessionIDs", list)
 
     if sids is None:
         LOGGER.error("No list of sessionIDs provided")
@@ -398,22 +872,24 @@ async def handle_108(msg):
 
     sessions = CTRL.broadcast(cid, sids, track)
 
+    if sessions is None:
+        return error_msg("Error: track must have a trackID")
+
     for sess in sessions:
-        newmsg = make_msg(SERVER_ID, 100, {'session': sess.export()})
-        await broadcast(newmsg, [x[0] for x in sess.clientlist])
+        await CLOCK.snapshot(sess)
 
 async def handle_109(msg):
     """
     Handler for msgID 109: Request Track
 
-    :param msg: the message dict
-    :return: a json-serialized object
+    :param msg: a codec.Request
+    :return: a wire.Message
     """
     LOGGER.debug("handle_109(): Request Track started")
 
-    cid = msg.get("sourceID")
-    sid = msg.get("payload").get("sessionID")
-    tid = msg.get("payload").get("trackID")
+    cid = msg.srcID
+    sid = msg.get("sessionID", int)
+    tid = msg.get("trackID", int)
 
     trid, ssid, yn = CTRL.request_track(cid, sid, tid)
 
@@ -423,28 +899,27 @@ async def handle_109(msg):
         newmsg = make_msg(SERVER_ID, 111, {'status': yn, 'sessionID': ssid, 'trackID': trid})
 
     sock = CTRL.get_socket(cid)
-    await sock.send(newmsg)
+    send(sock, newmsg)
 
     session = CTRL.sessions.get(sid)
 
     if session is None:
-        LOGGER.error("session " + str(sid) + " not found by handle_109() after calling CTRL.request_track()")
+        LOGGER.error("session %s not found by handle_109() after calling CTRL.request_track()", sid)
     else:
-        bmsg = make_msg(SERVER_ID, 100, {'session': session.export()})
-        await broadcast(bmsg, [x[0] for x in session.clientlist])
+        await CLOCK.snapshot(session)
 
 async def handle_110(msg):
     """
     Handler for msgID 110: Relinquish Track
 
-    :param msg: the message dict
-    :return: a json-serialized object
+    :param msg: a codec.Request
+    :return: a wire.Message
     """
     LOGGER.debug("handle_110(): Relinquish Track started")
 
-    cid = msg.get("sourceID")
-    sid = msg.get("payload").get("sessionID")
-    tid = msg.get("payload").get("trackID")
+    cid = msg.srcID
+    sid = msg.get("sessionID", int)
+    tid = msg.get("trackID", int)
 
     if sid is None or tid is None:
         LOGGER.error("sid or tid not given in message")
@@ -453,60 +928,376 @@ async def handle_110(msg):
     sock = CTRL.get_socket(cid)
 
     if CTRL.relinquish_track(cid, sid, tid):
-        LOGGER.debug("Client " + str(cid) + " relinquished track " + str(sid) + ':' + str(tid))
+        LOGGER.debug("Client %s relinquished track %s:%s", cid, sid, tid)
         #sock.send(make_msg(SERVER_ID, 100, {'session': CTRL.get_session(sid)}))
     else:
-        LOGGER.error("Client " + str(cid) + " failed to relinquish track " + str(sid) + ':' + str(tid))
+        LOGGER.error("Client %s failed to relinquish track %s:%s", cid, sid, tid)
         #sock.send(error_msg("Error: Failed to relinquish track"))
 
     sess = CTRL.sessions.get(sid)
     if sess is None:
-        LOGGER.error("Session " + str(sid) + " not found by handle_110() after calling CTRL.relinquish_track()")
+        LOGGER.error("Session %s not found by handle_110() after calling CTRL.relinquish_track()", sid)
     else:
-        await broadcast(make_msg(SERVER_ID, 100, {'session': sess.export()}), [x[0] for x in sess.clientlist])
+        await CLOCK.snapshot(sess)
 
 
 async def handle_112(msg):
     """
     Handler for msgID 112: Client Connect
 
-    :param msg: the message dict
-    :return: a json-serialized object
+    :param msg: a codec.Request
+    :return: a wire.Message
     """
     LOGGER.debug("handle_112():Client Connect started")
 
-    addr = msg.get('addr')
+    addr = msg.addr
+    sock = msg.socket
 
-    cid = CTRL.get_cid_by_address(addr)
+    cid = CTRL.get_cid_by_socket(sock)
 
     if cid:
-        LOGGER.debug("Duplicate 112 detected from host " + str(addr))
-        return make_msg(SERVER_ID, 113, {'clientID': cid, 'sessionIDs': list(CTRL.sessions.keys())})
+        LOGGER.debug("Duplicate 112 detected from host %s", addr)
+        version, sessionIDs = DIRECTORY.listing()
+        return make_msg(SERVER_ID, 113, {'clientID': cid, 'sessionIDs': sessionIDs, 'directoryVersion': version,
+                                         'resumeToken': CTRL.tokens.get(cid)})
+
+    encoding = wire.negotiate(msg.get('encodings'))
+
+    # A client that lost its connection takes up where it left off if it proves it's the same one
+    resumed = msg.get('clientID', str)
+    if resumed is not None and not TRUST_PROXY:
+        if CTRL.resume(resumed, msg.get('resumeToken', str)):
+            return resume(sock, resumed, encoding)
+        LOGGER.info("Client at %s couldn't resume %s; connecting it as a new client", addr, resumed[:UUID_SLICE])
 
     # No check for sourceID in this function b/c a new Client will not yet have one
-    nick = msg.get("payload").get('nickname')
+    nick = msg.get('nickname', str)
 
     if nick is None:
         LOGGER.error("Client did not provide nickname")
         return error_msg("Error: Nickname not provided")
 
-    clientID = CTRL.new_client(nick)
-    CTRL.log_cid_by_address(clientID, addr)
-    CTRL.set_TTL(clientID)
-    LOGGER.debug("New client ID: " + clientID + " assigned to " + str(addr))
+    # A router hands every worker it forwards a client to the same clientID
+    assigned = msg.get('assignClientID', str) if TRUST_PROXY else None
+
+    clientID = CTRL.new_client(nick, assigned)
+
+    follow = msg.get('directory')
+    if follow in directory.MODES:
+        DIRECTORY.follow(clientID, follow)
+    LOGGER.debug("New client ID: %s assigned to %s using encoding %s", clientID, addr, encoding)
+
+    # The reply goes out in JSON; everything after it uses the negotiated encoding
+    # Directory updates reach the client from now on, before it has sent anything with its ID
+    CTRL.log_socket(clientID, sock)
+    version, sessionIDs = DIRECTORY.listing()
+    FANOUT.send(sock, make_msg(SERVER_ID, 113, {'clientID':clientID, 'sessionIDs': sessionIDs,
+                                                'directoryVersion': version, 'encoding': encoding,
+                                                'resumeToken': CTRL.tokens[clientID]}))
+    FANOUT.set_encoding(sock, encoding)
 
-    return make_msg(SERVER_ID, 113, {'clientID':clientID, 'sessionIDs': list(CTRL.sessions.keys())})
+def resume(sock, cid, encoding):
+    """
+    Binds a new connection to a client that has proved it held an older one. The client keeps its
+    sessions, tracks and directory mode, and nobody else is told, since nothing they can see has
+    changed; the client catches up on its sessions with 116s.
+
+    :param sock: the new connection
+    :param cid: the client's clientID
+    :param encoding: one of wire.ENCODINGS
+    :return: None
+    """
+    old = CTRL.get_socket(cid)
+    CTRL.log_socket(cid, sock)
+    if old is not None and old is not sock and not isinstance(old, backplane.Remote) and old.open:
+        # The old connection is dead but hasn't noticed yet
+        FANOUT.unregister(old)
+        asyncio.ensure_future(old.close(code=1000, reason="resumed on another connection"))
+
+    LOGGER.info("Client %s--%s resumed its connection", CTRL.clients.get(cid), cid[:UUID_SLICE])
+    version, sessionIDs = DIRECTORY.listing()
+    FANOUT.send(sock, make_msg(SERVER_ID, 113, {'clientID': cid, 'sessionIDs': sessionIDs,
+                                                'directoryVersion': version, 'encoding': encoding,
+                                                'resumeToken': CTRL.tokens[cid], 'resumed': True,
+                                                'memberOf': sorted(CTRL.client_sessions.get(cid, ()))}))
+    FANOUT.set_encoding(sock, encoding)
+
+async def handle_115(msg):
+    """
+    Handler for msgID 115: Update Cells
+
+    Applies the changed cells and broadcasts only those cells, tagged with the session versions
+    they lead from and to, to all clients in the session.
+
+    :param msg: a codec.Request
+    :return: a wire.Message, or None
+    """
+    LOGGER.debug("handle_115(): Update Cells started")
+
+    cid = msg.srcID
+    sid = msg.get("sessionID", int)
+    cells = msg.get("cells", list)
+
+    if sid is None or cells is None:
+        LOGGER.error("sid or cells not given in message")
+        return error_msg("Error: sessionID and a list of cells required")
+
+    sess, base, changed = CTRL.update_cells(cid, sid, cells)
+
+    if sess is None:
+        return error_msg("Error: Could not update session " + str(sid))
+
+    if changed:
+        await CLOCK.cells(sess, base, changed)
+
+async def handle_116(msg):
+    """
+    Handler for msgID 116: Request Session
+
+    Catches up a client that joined late or missed versions, for instance while reconnecting. A
+    client that says which version it last saw is sent the cells changed since in a msgID 115 if
+    the session's history goes back that far; otherwise it is sent a full msgID 100 snapshot.
+
+    :param msg: a codec.Request
+    :return: a wire.Message
+    """
+    LOGGER.debug("handle_116(): Request Session started")
+
+    cid = msg.srcID
+    sid = msg.get("sessionID", int)
+
+    if sid is None:
+        LOGGER.error("sid not provided")
+        return error_msg("Error: sessionID must be provided in payload")
+
+    sessionIDs = CTRL.client_sessions.get(cid)
+    sess = CTRL.sessions.get(sid)
+
+    if sess is None or not sessionIDs or sid not in sessionIDs:
+        LOGGER.error("Client %s requested session %s it isn't a member of", cid, sid)
+        return error_msg("Error: Not a member of session " + str(sid))
+
+    version = msg.get("version", int)
+    if version is not None:
+        cells = sess.changes_since(version)
+        if cells is not None:
+            RESYNCS.inc(('cells',))
+            return make_msg(SERVER_ID, 115, {'sessionID': sid, 'baseVersion': version, 'version': sess.version, 'cells': cells})
+
+    RESYNCS.inc(('snapshot',))
+    return session_msg(sess)
+
+async def handle_118(msg):
+    """
+    Handler for msgID 118: Follow Directory
+
+    Changes how the client is kept up to date with the session directory. Clients switching to
+    whole lists or diffs get the current list in a 105 to start from.
+
+    :param msg: a codec.Request
+    :return: a wire.Message, or None
+    """
+    LOGGER.debug("handle_118(): Follow Directory started")
+
+    cid = msg.srcID
+    mode = msg.get("directory")
+
+    if mode not in directory.MODES:
+        LOGGER.error("Client %s asked to follow the directory as %s", cid, mode)
+        return error_msg("Error: directory must be one of " + ', '.join(directory.MODES))
+
+    DIRECTORY.follow(cid, mode)
+    if mode == directory.MODE_NONE:
+        return None
+
+    version, sessionIDs = DIRECTORY.listing()
+    return make_msg(SERVER_ID, 105, {'sessionIDs': sessionIDs, 'version': version})
+
+async def handle_119(msg):
+    """
+    Handler for msgID 119: Request Grid
+
+    Sends one page of a track's grid in a msgID 120, for sessions too large to carry their grids in
+    snapshots. A page is as many whole rows, starting at the requested tone, as fit in
+    controller.PAGE_CELLS cells.
+
+    :param msg: a codec.Request
+    :return: a wire.Message
+    """
+    LOGGER.debug("handle_119(): Request Grid started")
+
+    cid = msg.srcID
+    sid = msg.get("sessionID", int)
+    tid = msg.get("trackID", int)
+    tone = msg.get("tone", int, 0)
+
+    if sid is None or tid is None:
+        LOGGER.error("sid or tid not given in message")
+        return error_msg("Error: sessionID and trackID required")
+
+    sess, page = CTRL.get_page(cid, sid, tid, tone)
+
+    if sess is None:
+        return error_msg("Error: No grid page at tone {} of track {}:{}".format(tone, sid, tid))
+
+    return make_msg(SERVER_ID, 120, {'sessionID': sid, 'trackID': tid, 'version': sess.version,
+                                     'tone': tone, 'beat': 0, 'grid': page})
+
+async def handle_121(msg):
+    """
+    Handler for msgID 121: Update Region
+
+    Overwrites a rectangle of an owned track and broadcasts the cells that changed, like a msgID 115.
+    Regions changing more than a page of cells are sent as a snapshot instead.
+
+    :param msg: a codec.Request
+    :return: a wire.Message, or None
+    """
+    LOGGER.debug("handle_121(): Update Region started")
+
+    cid = msg.srcID
+    sid = msg.get("sessionID", int)
+    tid = msg.get("trackID", int)
+    tone = msg.get("tone", int, 0)
+    beat = msg.get("beat", int, 0)
+    grid = msg.get("grid")
+
+    if sid is None or tid is None or grid is None:
+        LOGGER.error("sid, tid or grid not given in message")
+        return error_msg("Error: sessionID, trackID and grid required")
+
+    sess, base, changed = CTRL.update_region(cid, sid, tid, tone, beat, grid)
+
+    if sess is None:
+        return error_msg("Error: Could not update region of track {}:{}".format(sid, tid))
+
+    if len(changed) > controller.PAGE_CELLS:
+        await CLOCK.snapshot(sess)
+    elif changed:
+        await CLOCK.cells(sess, base, changed)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Initialize Server")
     #parser.add_argument('-t', '--test', action='store_true', help='Port to listen on.')
     parser.add_argument('-p', '--port', help='Port to serve on')
+    parser.add_argument('-q', '--queue-size', type=int, default=fanout.DEFAULT_QUEUE_SIZE,
+                        help='Outgoing messages queued per connection before the slow-client policy applies')
+    parser.add_argument('--slow-policy', choices=fanout.POLICIES, default=fanout.DEFAULT_POLICY,
+                        help='What to do with clients whose outgoing queue is full')
+    parser.add_argument('-t', '--tick', type=float, default=frameclock.DEFAULT_TICK * 1000,
+                        help='Milliseconds over which changes to a session are merged into one update (0 to disable)')
+    parser.add_argument('--observer-tick', type=float, default=frameclock.DEFAULT_OBSERVER_TICK * 1000,
+                        help='Milliseconds over which updates are merged for clients owning no track (0 to send them every update)')
+    parser.add_argument('--directory-window', type=float, default=directory.DEFAULT_WINDOW * 1000,
+                        help='Milliseconds over which session list changes are merged into one update')
+    parser.add_argument('--heartbeat', type=float, default=heartbeat.DEFAULT_INTERVAL,
+                        help='Seconds between pings of every connection')
+    parser.add_argument('--heartbeat-timeout', type=float, default=heartbeat.DEFAULT_TIMEOUT,
+                        help='Seconds to wait for a pong before evicting a connection')
+    parser.add_argument('-m', '--max-sessions', type=int, default=controller.MAX_SESS_ID,
+                        help='Number of session IDs available, and so the most sessions that can exist at once')
+    parser.add_argument('--unix', help='Serve on this unix socket as a worker behind shard.py')
+    parser.add_argument('--session-ids', help='LOW:HIGH range of session IDs this worker hands out')
+    parser.add_argument('--backplane',
+                        help='Share sessions with other servers through the broker at tcp://host:port or unix:///path; needs --session-ids')
+    parser.add_argument('--node', help="This server's name on the backplane (defaults to a fresh UUID)")
+    parser.add_argument('-j', '--journal',
+                        help='Directory to keep sessions in across restarts (they are lost on exit otherwise)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve metrics in the Prometheus text format on this port (off by default)')
+    parser.add_argument('--rate-limits', type=ratelimit.parse_limits, default={},
+                        help='Per-client limits by msgID as rate/burst, e.g. 100=10/20,115=60/120')
+    parser.add_argument('--session-rate-limits', type=ratelimit.parse_limits, default={},
+                        help='Per-session limits by msgID as rate/burst, e.g. 100=30/60')
+    parser.add_argument('--admission', type=ratelimit.parse_limit,
+                        default='{}/{}'.format(*ratelimit.DEFAULT_ADMISSION),
+                        help='New clients admitted per second (as rate/burst) while the server is overloaded')
+    parser.add_argument('--compression-threshold', type=int, default=compress.DEFAULT_THRESHOLD,
+                        help='Bytes below which messages are sent uncompressed to clients that negotiated permessage-deflate')
+    parser.add_argument('--no-compression', action='store_true', help='Turn off permessage-deflate')
+    parser.add_argument('--no-rate-limits', action='store_true', help='Turn off rate limiting and admission control')
+    parser.add_argument('--log-file', default=logpipe.LOG_NAME, help='File to write the log to')
+    parser.add_argument('--log-level', default=logging.getLevelName(logpipe.DEFAULT_LEVEL),
+                        help='Level of every subsystem without its own --log-levels entry')
+    parser.add_argument('--log-levels', type=logpipe.parse_levels, default={},
+                        help='Per-subsystem levels, e.g. controller=DEBUG,traffic=WARNING')
+    parser.add_argument('--log-sample', type=logpipe.parse_levels, default={},
+                        help='Keep one record in N for noisy subsystems, e.g. traffic=100')
     nspace = vars(parser.parse_args())
+    if nspace.get('backplane') and not nspace.get('session_ids'):
+        parser.error("--backplane needs a --session-ids range that no other server on the backplane uses")
+    listener = logpipe.configure(nspace.get('log_file'), nspace.get('log_level').upper(),
+                                 {k: v.upper() for k, v in nspace.get('log_levels').items()},
+                                 nspace.get('log_sample'))
     #testing = nspace.get('test')
     port = nspace.get('port')
     if port is None:
         port = 8795
-    LOGGER.debug("websocket server started on port " + str(port))
-    asyncio.get_event_loop().run_until_complete(
-        websockets.serve(handle, 'localhost', port))
-    asyncio.get_event_loop().run_forever()
+    FANOUT.maxsize = nspace.get('queue_size')
+    FANOUT.policy = nspace.get('slow_policy')
+    CLOCK.tick = nspace.get('tick') / 1000
+    OBSERVERS.tick = nspace.get('observer_tick') / 1000
+    DIRECTORY.window = nspace.get('directory_window') / 1000
+    CTRL.session_ids = controller.IDAllocator(controller.MIN_SESS_ID, nspace.get('max_sessions'))
+    if nspace.get('session_ids'):
+        low, high = nspace.get('session_ids').split(':')
+        CTRL.session_ids = controller.IDAllocator(int(low), int(high))
+    HEARTBEAT.interval = nspace.get('heartbeat')
+    HEARTBEAT.timeout = nspace.get('heartbeat_timeout')
+    if nspace.get('no_rate_limits'):
+        LIMITER, ADMISSION = None, None
+    else:
+        LIMITER = ratelimit.RateLimiter(dict(ratelimit.CLIENT_LIMITS, **nspace.get('rate_limits')),
+                                        dict(ratelimit.SESSION_LIMITS, **nspace.get('session_rate_limits')))
+        ADMISSION = ratelimit.TokenBucket(*nspace.get('admission'), time.monotonic())
+    if nspace.get('node'):
+        NODE = nspace.get('node')
+    BACKPLANE = backplane.connect(nspace.get('backplane'))
+    BACKPLANE.subscribe('directory', on_directory)
+    BACKPLANE.subscribe('node.' + NODE, on_message)
+    BACKPLANE.subscribe('clients', on_exit)
+    if nspace.get('journal'):
+        CTRL.journal = journal.Journal(nspace.get('journal'), CTRL.dump)
+        # Collection passes over the objects being loaded only slow the load down
+        gc.disable()
+        try:
+            state, records = CTRL.journal.load()
+            CTRL.restore(state, records)
+        finally:
+            gc.enable()
+        # Restored clients have no connection yet; they are dropped unless they come back in time
+        for cid in CTRL.clients:
+            CTRL.set_TTL(cid)
+        CTRL.journal.snapshot()
+        DIRECTORY.changed()
+        LOGGER.info("Restored %s clients and %s sessions", len(CTRL.clients), len(CTRL.sessions))
+    # Messages are compressed once for every client that negotiated the same deflate window
+    extensions = None if nspace.get('no_compression') else [compress.SharedDeflateFactory(nspace.get('compression_threshold'))]
+    if nspace.get('unix'):
+        TRUST_PROXY = True
+        LOGGER.debug("websocket worker started on %s", nspace.get('unix'))
+        asyncio.get_event_loop().run_until_complete(
+            websockets.unix_serve(handle, nspace.get('unix'), ping_interval=None, create_protocol=compress.Protocol,
+                                  extensions=extensions, compression=None))
+    else:
+        LOGGER.debug("websocket server started on port %s", port)
+        asyncio.get_event_loop().run_until_complete(
+            websockets.serve(handle, 'localhost', port, ping_interval=None, create_protocol=compress.Protocol,
+                             extensions=extensions, compression=None))
+    # Servers announce themselves whenever they reach the broker, in case others missed them while away
+    BACKPLANE.on_connect(announce)
+    asyncio.get_event_loop().run_until_complete(BACKPLANE.start())
+    asyncio.ensure_future(reap())
+    asyncio.ensure_future(HEARTBEAT.run())
+    asyncio.ensure_future(LAG.run())
+    if nspace.get('metrics_port'):
+        asyncio.get_event_loop().run_until_complete(metrics.serve('localhost', nspace.get('metrics_port')))
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_event_loop().add_signal_handler(signum, asyncio.get_event_loop().stop)
+    try:
+        asyncio.get_event_loop().run_forever()
+    finally:
+        BACKPLANE.close()
+        if CTRL.journal is not None:
+            CTRL.journal.close()
+        listener.stop()
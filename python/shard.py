@@ -0,0 +1,421 @@
+"""
+Lunar Rocks Shard Router
+
+Runs the server as N worker processes, each owning a contiguous range of session IDs, behind a
+router that accepts client connections on the public port.
+
+The router opens a connection to a worker (over its unix socket) the first time a client sends a
+message about one of that worker's sessions, and from then on forwards that client's frames to it
+unchanged. Frames coming back are relayed to the client as they are; each worker's own outboxes
+and slow-consumer policy apply to them.
+
+A client gets the same clientID on every worker: the router assigns one at msgID 112 and replays
+the client's 112 to each worker it opens, with the ID in 'assignClientID', which workers honour
+because they only listen on a local socket. Each worker reports its session list to the router
+over a control connection; the router merges the lists and keeps the directory itself, so every
+client sees every session. It sends the list in msgID 113, and whole lists (msgID 105) or diffs
+(msgID 117) as each client chose in its msgID 112 or 118, which the router answers itself.
+
+Example:
+
+    python shard.py -p 8795 -w 15 -- --tick 20
+
+Python >= 3.5 required.
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import uuid
+import websockets
+from websockets.exceptions import ConnectionClosed
+import codec
+import controller
+import directory
+import fanout
+import logpipe
+import wire
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+STARTUP_TIMEOUT = 10        # seconds to wait for a worker to accept connections
+SESSION_MSG_IDS = (103, 104, 109, 110, 115, 116, 119, 121)
+ROUTER_ID = str(uuid.uuid1())
+CONTROL_PATH = '/control'               # path on which the router subscribes to a worker's session list
+FORWARDED_HEADER = 'X-Forwarded-For'    # tells a worker the address of the client a connection is for
+
+LOGGER = logging.getLogger('lunar.shard')
+
+def session_ranges(workers, max_sess_id=controller.MAX_SESS_ID):
+    """
+    Splits the session IDs between the workers
+
+    :param workers: Int, number of workers
+    :param max_sess_id: Int, highest session ID
+    :return: list of (low, high) inclusive ranges, one per worker
+    """
+    span = (max_sess_id - controller.MIN_SESS_ID + 1) // workers
+    if span < 1:
+        raise ValueError("Not enough session IDs for " + str(workers) + " workers")
+    ranges = []
+    for index in range(workers):
+        low = controller.MIN_SESS_ID + index * span
+        high = max_sess_id if index == workers - 1 else low + span - 1
+        ranges.append((low, high))
+    return ranges
+
+class Worker:
+
+    def __init__(self, index, path, low, high):
+        self.index = index          # Int
+        self.path = path            # String, the worker's unix socket
+        self.low = low              # Int, lowest session ID the worker hands out
+        self.high = high            # Int, highest session ID the worker hands out
+        self.proc = None            # Popen
+        self.sessions = []          # sessionIDs the worker last reported
+
+    def start(self, args):
+        """
+        Launches the worker process
+
+        :param args: list of extra arguments for server.py
+        :return: None
+        """
+        here = os.path.dirname(os.path.abspath(__file__))
+        cmd = [sys.executable, os.path.join(here, 'server.py'), '--unix', self.path,
+               '--session-ids', str(self.low) + ':' + str(self.high),
+               '--log-file', 'server-' + str(self.index) + '.log'] + args
+        self.proc = subprocess.Popen(cmd, cwd=here)
+
+    async def connect(self, path='/', addr=None):
+        """
+        :param path: request path, CONTROL_PATH for the control connection
+        :param addr: address of the client the connection is for
+        :return: websocket
+        """
+        headers = {FORWARDED_HEADER: str(addr)} if addr is not None else {}
+        # Compressing between processes on one host costs CPU and saves nothing
+        return await websockets.unix_connect(self.path, 'ws://localhost' + path, extra_headers=headers,
+                                             ping_interval=None, max_size=None, compression=None)
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class Connection:
+
+    def __init__(self, sock):
+        self.sock = sock            # the client's websocket
+        self.cid = None             # UUID String
+        self.hello = None           # JSON String, the client's msgID 112 with its assigned clientID
+        self.home = None            # Worker index for messages about no particular session
+        self.upstreams = {}         # Worker index: websocket
+        self.replays = set()        # Worker indexes that were sent the 112 again, whose 113 is dropped
+        self.awaiting = set()       # Worker indexes whose 113 reply hasn't been relayed yet
+        self.relays = []            # Tasks
+
+class Router:
+
+    def __init__(self, workers):
+        self.workers = workers                          # list of Workers
+        self.fanout = fanout.FanOut()                   # for messages that come from the router itself
+        self.connections = {}                           # client websocket: Connection
+        self.placement = itertools.cycle(range(len(workers)))  # workers new sessions are created on
+        # Workers already merge their own changes over a window, so the router passes them straight on
+        self.directory = directory.Directory(lambda: self.sessions(), lambda *x: self.publish(*x), window=0)
+
+    def owner(self, sid):
+        """
+        :param sid: sessionID
+        :return: index of the worker owning sid, or None
+        """
+        for worker in self.workers:
+            if isinstance(sid, int) and worker.low <= sid <= worker.high:
+                return worker.index
+        return None
+
+    async def start(self, args):
+        """
+        Launches the workers and subscribes to their session lists
+
+        :param args: list of extra arguments for server.py
+        :return: None
+        """
+        for worker in self.workers:
+            worker.start(args)
+        for worker in self.workers:
+            for _ in range(STARTUP_TIMEOUT * 10):
+                if os.path.exists(worker.path):
+                    try:
+                        sock = await worker.connect(CONTROL_PATH)
+                        break
+                    except OSError:
+                        pass
+                await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("Worker " + str(worker.index) + " did not start")
+            asyncio.ensure_future(self.subscribe(worker, sock))
+
+    async def subscribe(self, worker, sock):
+        """
+        Follows the session list of a worker over its control connection
+        """
+        try:
+            async for frame in sock:
+                msg = wire.decode(frame)
+                if msg.get('messageID') == 105:
+                    worker.sessions = msg['payload'].get('sessionIDs', [])
+                    self.directory.changed()
+        except ConnectionClosed:
+            pass
+        LOGGER.error("Lost control connection to worker %s", worker.index)
+
+    def sessions(self):
+        """
+        :return: sessionIDs of every worker
+        """
+        return [sid for worker in self.workers for sid in worker.sessions]
+
+    async def publish(self, version, sessionIDs, added, removed):
+        """
+        Sends a new version of the merged session directory to the clients following it
+
+        :param version: the directory's new version
+        :param sessionIDs: sorted list of every sessionID
+        :param added: sessionIDs created since the previous version
+        :param removed: sessionIDs deleted since the previous version
+        :return: None
+        """
+        socks = {conn.cid: sock for sock, conn in self.connections.items() if conn.cid is not None}
+        lists, diffs = self.directory.recipients(socks)
+        listmsg = wire.Message(ROUTER_ID, 105, {'sessionIDs': sessionIDs, 'version': version})
+        self.fanout.broadcast([socks[cid] for cid in lists], listmsg, 105)
+        if diffs:
+            # Diffs build on one another, so unlike whole lists they must never be dropped
+            diffmsg = wire.Message(ROUTER_ID, 117, {'version': version, 'added': added, 'removed': removed})
+            self.fanout.broadcast([socks[cid] for cid in diffs], diffmsg)
+
+    def follow(self, conn, mode):
+        """
+        Handles a client's msgID 118 as a lone server would, with the merged directory
+
+        :param conn: the client's Connection
+        :param mode: the mode the client asked for
+        :return: None
+        """
+        if mode not in directory.MODES:
+            error = "Error: directory must be one of " + ', '.join(directory.MODES)
+            self.fanout.send(conn.sock, wire.Message(ROUTER_ID, 114, {'error': error}))
+            return
+
+        self.directory.follow(conn.cid, mode)
+        if mode != directory.MODE_NONE:
+            version, sessionIDs = self.directory.listing()
+            self.fanout.send(conn.sock, wire.Message(ROUTER_ID, 105, {'sessionIDs': sessionIDs, 'version': version}))
+
+    async def handle(self, sock, path):
+        conn = Connection(sock)
+        self.connections[sock] = conn
+        self.fanout.register(sock)
+        try:
+            async for frame in sock:
+                try:
+                    msg = wire.decode(frame)
+                except wire.WireError as e:
+                    self.fanout.send(sock, wire.Message(ROUTER_ID, 114, {'error': "Error: " + str(e)}))
+                    continue
+                for index, out in self.route(conn, frame, msg):
+                    upstream = await self.upstream(conn, index)
+                    await upstream.send(out)
+        except ConnectionClosed:
+            pass
+        finally:
+            del self.connections[sock]
+            self.fanout.unregister(sock)
+            if conn.cid is not None:
+                self.directory.forget(conn.cid)
+            # Closing the upstreams starts the client's time to live on each worker
+            for upstream in conn.upstreams.values():
+                await upstream.close()
+            for task in conn.relays:
+                task.cancel()
+
+    def route(self, conn, frame, msg):
+        """
+        Decides which workers a client's message goes to
+
+        :param conn: the client's Connection
+        :param frame: the message as received
+        :param msg: the decoded message dict
+        :return: list of (worker index, frame) pairs
+        """
+        mid = msg.get('messageID')
+        payload = msg.get('payload')
+        if not isinstance(payload, dict):
+            payload = {}
+        if msg.get('sourceID') and conn.cid is None:
+            conn.cid = msg.get('sourceID')
+        if conn.home is None:
+            conn.home = next(self.placement)
+
+        if mid == 112:
+            if conn.hello is None:
+                conn.cid = str(uuid.uuid4())
+                payload['assignClientID'] = conn.cid
+                msg['payload'] = payload
+                conn.hello = codec.dumps_text(msg)
+                if payload.get('directory') in directory.MODES:
+                    self.directory.follow(conn.cid, payload['directory'])
+            conn.awaiting.add(conn.home)
+            return [(conn.home, conn.hello)]
+
+        if mid == 101:
+            return [(next(self.placement), frame)]
+
+        if mid == 118:
+            if conn.hello is None:
+                self.fanout.send(conn.sock, wire.Message(ROUTER_ID, 114, {'error': "Error: SrcID must be provided"}))
+            else:
+                self.follow(conn, payload.get('directory'))
+            return []
+
+        if mid == 100:
+            sess = payload.get('session')
+            sid = sess.get('sessionID') if isinstance(sess, dict) else None
+            return [(self.pick(conn, sid), frame)]
+
+        if mid in SESSION_MSG_IDS:
+            return [(self.pick(conn, payload.get('sessionID')), frame)]
+
+        if mid == 108 and isinstance(payload.get('sessionIDs'), list):
+            groups = {}
+            for sid in payload['sessionIDs']:
+                groups.setdefault(self.pick(conn, sid), []).append(sid)
+            if len(groups) == 1:
+                return [(index, frame) for index in groups]
+            encoding = wire.ENCODING_JSON if isinstance(frame, str) else wire.ENCODING_BINARY
+            return [(index, wire.Message(msg.get('sourceID'), 108, dict(payload, sessionIDs=sids)).frame(encoding))
+                    for index, sids in groups.items()]
+
+        if mid == 106:
+            return [(index, frame) for index in (conn.upstreams or [conn.home])]
+
+        return [(conn.home, frame)]
+
+    def pick(self, conn, sid):
+        """
+        :return: index of the worker owning sid, or the client's home worker for unknown sessions
+        """
+        index = self.owner(sid)
+        return conn.home if index is None else index
+
+    async def upstream(self, conn, index):
+        """
+        Finds or opens the connection to a worker on behalf of a client
+
+        :return: websocket
+        """
+        upstream = conn.upstreams.get(index)
+        if upstream is not None:
+            return upstream
+
+        upstream = await self.workers[index].connect(addr=conn.sock.remote_address)
+        conn.upstreams[index] = upstream
+        conn.relays.append(asyncio.ensure_future(self.relay(conn, index, upstream)))
+        if conn.hello is not None and index != conn.home:
+            conn.replays.add(index)
+            conn.awaiting.add(index)
+            await upstream.send(conn.hello)
+        return upstream
+
+    async def relay(self, conn, index, upstream):
+        """
+        Passes a worker's frames on to the client
+        """
+        try:
+            async for frame in upstream:
+                if index in conn.awaiting and self.connected(conn, index, frame):
+                    continue
+                await conn.sock.send(frame)
+        except ConnectionClosed:
+            pass
+        if conn.sock.open:
+            LOGGER.info("Worker %s closed its connection to a client; closing the client too", index)
+            await conn.sock.close(code=1011, reason="worker connection lost")
+
+    def connected(self, conn, index, frame):
+        """
+        Handles a worker's msgID 113 reply, which carries only that worker's sessions
+
+        :return: boolean - whether frame was a 113 and has been dealt with
+        """
+        msg = wire.decode(frame) if isinstance(frame, str) else None
+        if msg is None or msg.get('messageID') != 113:
+            return False
+
+        conn.awaiting.discard(index)
+        if index in conn.replays:
+            conn.replays.discard(index)
+            return True
+
+        version, sessionIDs = self.directory.listing()
+        payload = dict(msg['payload'], sessionIDs=sessionIDs, directoryVersion=version)
+        self.fanout.send(conn.sock, wire.Message(msg.get('sourceID'), 113, payload))
+        self.fanout.set_encoding(conn.sock, payload.get('encoding', wire.ENCODING_JSON))
+        return True
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the server as several worker processes behind a router")
+    parser.add_argument('-p', '--port', type=int, default=8795, help='Port to serve on')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS, help='Number of worker processes')
+    parser.add_argument('-m', '--max-sessions', type=int, default=controller.MAX_SESS_ID,
+                        help='Number of session IDs available, split evenly between the workers')
+    parser.add_argument('--socket-dir', default=tempfile.gettempdir(), help='Directory for the workers\' unix sockets')
+    parser.add_argument('--log-file', default='shard.log', help='File to write the router\'s log to')
+    parser.add_argument('--log-level', default=logging.getLevelName(logpipe.DEFAULT_LEVEL),
+                        help='Level of the router\'s log')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help='Arguments after -- are passed on to every worker\'s server.py')
+    args = parser.parse_args()
+    if args.server_args[:1] == ['--']:
+        args.server_args = args.server_args[1:]
+
+    listener = logpipe.configure(args.log_file, args.log_level.upper())
+    workers = []
+    for index, (low, high) in enumerate(session_ranges(args.workers, args.max_sessions)):
+        path = os.path.join(args.socket_dir, 'lunar-' + str(os.getpid()) + '-' + str(index) + '.sock')
+        workers.append(Worker(index, path, low, high))
+    router = Router(workers)
+
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, loop.stop)
+    try:
+        loop.run_until_complete(router.start(args.server_args))
+        loop.run_until_complete(websockets.serve(router.handle, 'localhost', args.port, max_size=None))
+        LOGGER.info("Routing port %s to %s workers", args.port, len(workers))
+        loop.run_forever()
+    finally:
+        router.stop()
+        listener.stop()
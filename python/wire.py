@@ -0,0 +1,350 @@
+"""
+Lunar Rocks Wire Formats
+
+This module converts messages to and from the frames sent over websockets. JSON text frames are the
+default; clients may negotiate a compact binary framing during the msgID 112 handshake.
+
+A binary frame starts with a fixed header (network byte order):
+
+    messageID   uint16
+    body        uint8   one of the BODY_* constants
+    sourceID    16 bytes, the raw UUID (all zeros if there is none)
+
+followed by the body: the UTF-8 JSON payload, a packed session (msgIDs 100 and 102), packed
+cells (msgID 115), or a packed grid region (msgIDs 120 and 121).
+"""
+
+import codec
+import compress
+import struct
+import uuid
+import numpy as np
+import metrics
+
+__author__ = "Cody Shepherd & Brian Ginsburg"
+__copyright__ = "Copyright 2017, Cody Shepherd & Brian Ginsburg"
+__credits__ = ["Cody Shepherd", "Brian Ginsburg"]
+#__license__ =
+__version__ = "1.0"
+__maintainer__ = "Cody Shepherd"
+__email__ = "cody.shepherd@gmail.com"
+__status__ = "Alpha"
+
+ENCODING_JSON = 'json'
+ENCODING_BINARY = 'binary'
+ENCODINGS = [ENCODING_JSON, ENCODING_BINARY]       # in order of preference, least preferred first
+
+BODY_JSON = 0
+BODY_SESSION = 1
+BODY_CELLS = 2
+BODY_GRID = 3
+SESSION_MSG_IDS = (100, 102)
+CELLS_MSG_IDS = (115,)
+GRID_MSG_IDS = (120, 121)
+
+HEADER = struct.Struct('!HB16s')
+SESSION_HEADER = struct.Struct('!IIHHB')      # sessionID, version, tempo, #clients, #tracks
+TRACK_HEADER = struct.Struct('!HHHBI16s')     # trackID, tones, beats, bytes per cell (0: no grid), gridVersion, clientID
+CELLS_HEADER = struct.Struct('!IIII')         # sessionID, baseVersion, version, #cells
+GRID_HEADER = struct.Struct('!IHIHHHHB')      # sessionID, trackID, version, tone, beat, rows, columns, bytes per cell
+CELL = struct.Struct('!HHHH')                 # trackID, tone, beat, value
+STR_LEN = struct.Struct('!H')
+NO_ID = bytes(16)
+CELL_DTYPES = {1: np.dtype('u1'), 2: np.dtype('>u2')}
+
+ENCODED_FRAMES = metrics.REGISTRY.counter('lunar_encoded_frames_total', "Messages serialized, by encoding", ('encoding',))
+ENCODED_BYTES = metrics.REGISTRY.counter('lunar_encoded_bytes_total', "Bytes of messages serialized, by encoding", ('encoding',))
+
+class WireError(ValueError):
+    """
+    Raised for frames that can't be decoded
+    """
+
+class Message:
+    """
+    An outgoing message, serialized at most once for each encoding no matter how many clients it
+    is sent to.
+    """
+
+    def __init__(self, srcID, msgID, payload):
+        self.srcID = srcID          # UUID String
+        self.msgID = msgID          # Int
+        self.payload = payload      # json-serializable dict
+        self.frames = {}            # encoding: str or bytes; (encoding, window bits): compress.Deflated
+        self.sizes = {}             # encoding: Int, bytes of the frame before compression
+
+    def frame(self, encoding=ENCODING_JSON):
+        """
+        The message as sent to clients using the given encoding
+
+        :param encoding: one of ENCODINGS
+        :return: str for JSON text frames, bytes for binary frames
+        """
+        frame = self.frames.get(encoding)
+        if frame is None:
+            if encoding == ENCODING_BINARY:
+                frame = data = encode_binary(self.srcID, self.msgID, self.payload)
+            else:
+                data = codec.dumps({
+                    "sourceID": self.srcID,
+                    "messageID": self.msgID,
+                    "payload": self.payload
+                })
+                frame = data.decode('utf-8')
+            self.frames[encoding] = frame
+            self.sizes[encoding] = len(data)
+            ENCODED_FRAMES.inc((encoding,))
+            ENCODED_BYTES.inc((encoding,), len(data))
+        return frame
+
+    def size(self, encoding=ENCODING_JSON):
+        """
+        :param encoding: one of ENCODINGS
+        :return: Int, bytes the message takes on the wire before compression; text frames count
+            their UTF-8 bytes, not their characters
+        """
+        if encoding not in self.sizes:
+            self.frame(encoding)
+        return self.sizes[encoding]
+
+    def deflated(self, encoding, window_bits):
+        """
+        The message compressed for clients using the given encoding and deflate window
+
+        :param encoding: one of ENCODINGS
+        :param window_bits: the window size the client negotiated
+        :return: a compress.Deflated
+        """
+        key = (encoding, window_bits)
+        deflated = self.frames.get(key)
+        if deflated is None:
+            deflated = self.frames[key] = compress.deflate(self.frame(encoding), window_bits)
+        return deflated
+
+    def __str__(self):
+        return self.frame(ENCODING_JSON)
+
+def negotiate(offered):
+    """
+    Picks the encoding to use with a client from those it offered in its msgID 112
+
+    :param offered: list of encoding names, or None
+    :return: one of ENCODINGS
+    """
+    if not isinstance(offered, list):
+        return ENCODING_JSON
+    for encoding in reversed(ENCODINGS):
+        if encoding in offered:
+            return encoding
+    return ENCODING_JSON
+
+def decode(frame):
+    """
+    Decodes an incoming frame of either encoding
+
+    :param frame: str (JSON text frame) or bytes (binary frame)
+    :return: message dict, with the same keys as a JSON message
+    """
+    if isinstance(frame, str):
+        try:
+            return codec.loads(frame)
+        except ValueError as e:
+            raise WireError("Malformed JSON: " + str(e))
+    return decode_binary(frame)
+
+def encode_binary(srcID, msgID, payload):
+    """
+    Packs a message into a binary frame
+
+    :return: bytes
+    """
+    if msgID in SESSION_MSG_IDS and 'session' in payload:
+        body, data = BODY_SESSION, pack_session(payload['session'])
+    elif msgID in CELLS_MSG_IDS and 'cells' in payload:
+        body, data = BODY_CELLS, pack_cells(payload)
+    elif msgID in GRID_MSG_IDS and 'grid' in payload:
+        body, data = BODY_GRID, pack_grid(payload)
+    else:
+        body, data = BODY_JSON, codec.dumps(payload)
+    return HEADER.pack(msgID, body, pack_id(srcID)) + data
+
+def decode_binary(frame):
+    """
+    Unpacks a binary frame
+
+    :param frame: bytes
+    :return: message dict, with the same keys as a JSON message
+    """
+    try:
+        msgID, body, srcID = HEADER.unpack_from(frame)
+        offset = HEADER.size
+        if body == BODY_SESSION:
+            payload = {'session': unpack_session(frame, offset)}
+        elif body == BODY_CELLS:
+            payload = unpack_cells(frame, offset)
+        elif body == BODY_GRID:
+            payload = unpack_grid(frame, offset)
+        elif body == BODY_JSON:
+            payload = codec.loads(memoryview(frame)[offset:])
+        else:
+            raise WireError("Unknown body type " + str(body))
+    except (struct.error, ValueError) as e:
+        raise WireError("Malformed binary frame: " + str(e))
+
+    return {
+        "sourceID": unpack_id(srcID),
+        "messageID": msgID,
+        "payload": payload
+    }
+
+def pack_id(cid):
+    if not cid:
+        return NO_ID
+    return uuid.UUID(cid).bytes
+
+def unpack_id(data):
+    if data == NO_ID:
+        return ''
+    return str(uuid.UUID(bytes=data))
+
+def pack_str(txt):
+    data = txt.encode('utf-8')
+    return STR_LEN.pack(len(data)) + data
+
+def unpack_str(frame, offset):
+    (length,) = STR_LEN.unpack_from(frame, offset)
+    offset += STR_LEN.size
+    return bytes(frame[offset:offset + length]).decode('utf-8'), offset + length
+
+def pack_session(sess):
+    """
+    :param sess: a session dict, as output by Session.export()
+    :return: bytes
+    """
+    parts = [SESSION_HEADER.pack(sess['sessionID'], sess.get('version', 0), sess.get('tempo', 0),
+                                 len(sess.get('clients', [])), len(sess['board']))]
+    parts.extend(pack_str(nick) for nick in sess.get('clients', []))
+    for trk in sess['board']:
+        if trk.get('grid') is None:
+            # Left out of the snapshot; the client fetches it with msgID 119
+            grid, itemsize, (tones, beats) = None, 0, (trk['tones'], trk['beats'])
+        else:
+            grid = np.asarray(trk['grid'])
+            itemsize = cell_size(grid)
+            tones, beats = grid.shape
+        parts.append(TRACK_HEADER.pack(trk['trackID'], tones, beats, itemsize, trk.get('gridVersion', 0),
+                                       pack_id(trk.get('clientID'))))
+        parts.append(pack_str(trk.get('nickname', '')))
+        parts.append(pack_str(trk.get('instrument', '')))
+        if grid is not None:
+            parts.append(grid.astype(CELL_DTYPES[itemsize]).tobytes())
+    return b''.join(parts)
+
+def cell_size(grid):
+    """
+    :param grid: numpy array
+    :return: bytes needed per cell to hold every value of grid
+    """
+    return 1 if grid.size == 0 or grid.max() <= 0xff else 2
+
+def unpack_cell_array(frame, offset, rows, columns, itemsize, what):
+    """
+    :return: (numpy array of rows x columns cells, offset past it)
+    """
+    dtype = CELL_DTYPES.get(itemsize)
+    if dtype is None:
+        raise WireError("Unsupported cell size " + str(itemsize))
+    size = rows * columns * itemsize
+    if len(frame) < offset + size:
+        raise WireError("Truncated grid for " + what)
+    grid = np.frombuffer(frame, dtype=dtype, count=rows * columns, offset=offset).reshape((rows, columns))
+    return grid, offset + size
+
+def unpack_session(frame, offset):
+    """
+    :return: a session dict; its grids are numpy arrays rather than lists
+    """
+    sid, version, tempo, nclients, ntracks = SESSION_HEADER.unpack_from(frame, offset)
+    offset += SESSION_HEADER.size
+    clients = []
+    for _ in range(nclients):
+        nick, offset = unpack_str(frame, offset)
+        clients.append(nick)
+    board = []
+    for _ in range(ntracks):
+        tid, tones, beats, itemsize, gridVersion, cid = TRACK_HEADER.unpack_from(frame, offset)
+        offset += TRACK_HEADER.size
+        nick, offset = unpack_str(frame, offset)
+        instrument, offset = unpack_str(frame, offset)
+        grid = None
+        if itemsize:
+            grid, offset = unpack_cell_array(frame, offset, tones, beats, itemsize, "track " + str(tid))
+        board.append({
+            "trackID": tid,
+            "clientID": unpack_id(cid),
+            "nickname": nick,
+            "instrument": instrument,
+            "tones": tones,
+            "beats": beats,
+            "gridVersion": gridVersion,
+            "grid": grid
+        })
+    return {
+        "sessionID": sid,
+        "version": version,
+        "clients": clients,
+        "tempo": tempo,
+        "board": board
+    }
+
+def pack_cells(payload):
+    """
+    :param payload: a msgID 115 payload dict
+    :return: bytes
+    """
+    cells = payload['cells']
+    parts = [CELLS_HEADER.pack(payload['sessionID'], payload.get('baseVersion', 0),
+                               payload.get('version', 0), len(cells))]
+    parts.extend(CELL.pack(*cell) for cell in cells)
+    return b''.join(parts)
+
+def unpack_cells(frame, offset):
+    """
+    :return: a msgID 115 payload dict
+    """
+    sid, base, version, ncells = CELLS_HEADER.unpack_from(frame, offset)
+    offset += CELLS_HEADER.size
+    cells = [list(CELL.unpack_from(frame, offset + i * CELL.size)) for i in range(ncells)]
+    return {
+        "sessionID": sid,
+        "baseVersion": base,
+        "version": version,
+        "cells": cells
+    }
+
+def pack_grid(payload):
+    """
+    :param payload: a msgID 120 or 121 payload dict
+    :return: bytes
+    """
+    grid = np.asarray(payload['grid'])
+    itemsize = cell_size(grid)
+    rows, columns = grid.shape
+    header = GRID_HEADER.pack(payload['sessionID'], payload['trackID'], payload.get('version', 0),
+                              payload.get('tone', 0), payload.get('beat', 0), rows, columns, itemsize)
+    return header + grid.astype(CELL_DTYPES[itemsize]).tobytes()
+
+def unpack_grid(frame, offset):
+    """
+    :return: a msgID 120 or 121 payload dict; its grid is a numpy array rather than a list
+    """
+    sid, tid, version, tone, beat, rows, columns, itemsize = GRID_HEADER.unpack_from(frame, offset)
+    grid, offset = unpack_cell_array(frame, offset + GRID_HEADER.size, rows, columns, itemsize, "track " + str(tid))
+    return {
+        "sessionID": sid,
+        "trackID": tid,
+        "version": version,
+        "tone": tone,
+        "beat": beat,
+        "grid": grid
+    }